@@ -1,33 +1,40 @@
-import requests
-import torch
 import os
 import io
 from PIL import Image
-import soundfile as sf
-from transformers import AutoModelForCausalLM, AutoProcessor, GenerationConfig
-from urllib.request import urlopen
-import pandas as pd
 import time
+import sys
+
+# 复用xeo-app后端的截图嵌入缓存
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "xeo-app", "backend"))
+from embedding_cache import get_embedding_cache
+from gaze_crop import crop_gaze_images
+from ui_cache import set_image_digest
+from model_registry import model_registry
 
 class PhiUserIntentWorkflow:
-    def __init__(self, model_path="/home/lab/phi4/phi4", verbose=True):
+    def __init__(self, model_path="/home/lab/phi4/phi4", verbose=True, backend="auto",
+                 cpu_threads=None, quantization=None):
         """
         初始化多模态LLM推理工作流
         
         Args:
             model_path: Phi-4模型路径
             verbose: 是否显示详细调试信息
+            backend: 推理后端，'cuda'、'cpu'或'auto'（有可用的GPU时使用cuda）
+            cpu_threads: CPU后端的计算线程数
+            quantization: CPU后端的权重量化方式，None、'int8'或'int4'
         """
         print("🔄 初始化模型...")
-        self.processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path, 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True,
-            _attn_implementation='flash_attention_2',
-        ).cuda()
-        self.generation_config = GenerationConfig.from_pretrained(model_path)
+        # 同一模型在进程内只加载一次，与后端服务和其他工作流共用
+        self.loaded_model = model_registry.acquire(model_path, backend=backend, threads=cpu_threads,
+                                                   quantization=quantization)
+        self.backend = self.loaded_model.backend
+        self.processor = self.loaded_model.processor
+        self.model = self.loaded_model.model
+        self.generation_config = self.loaded_model.generation_config
+        
+        # 同一截图的预处理像素和图像嵌入只计算一次
+        self.embedding_cache = get_embedding_cache(self.processor, self.model)
         
         # 定义提示词结构
         self.user_prompt = '<|user|>'
@@ -36,6 +43,12 @@ class PhiUserIntentWorkflow:
         self.verbose = verbose
         print("✅ 模型加载完成")
     
+    def close(self):
+        """释放对共享模型的引用（没有其他使用者时模型被卸载）"""
+        model_registry.release(self.loaded_model)
+        self.loaded_model = None
+        self.model = None
+    
     def log(self, message, level="INFO"):
         """调试输出函数"""
         if self.verbose:
@@ -59,15 +72,16 @@ class PhiUserIntentWorkflow:
             text=prompt,
             images=image,
             return_tensors='pt'
-        ).to('cuda:0')
+        ).to(self.backend.device)
         
         # 计时并生成响应
         start_time = time.time()
-        generate_ids = self.model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            generation_config=self.generation_config,
-        )
+        with self.embedding_cache.activate(image):
+            generate_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                generation_config=self.generation_config,
+            )
         generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
         response = self.processor.batch_decode(
             generate_ids,
@@ -133,7 +147,11 @@ class PhiUserIntentWorkflow:
         
         try:
             # 步骤1: 加载图像
-            full_image = Image.open(image_path)
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+            full_image = Image.open(io.BytesIO(image_bytes))
+            # 以文件字节的摘要作为缓存键，概览和意图推断两次调用共用编码结果
+            set_image_digest(full_image, image_bytes)
             self.log(f"图像尺寸: {full_image.size[0]}x{full_image.size[1]}", "INFO")
         except Exception as e:
             self.log(f"加载图像失败: {str(e)}", "ERROR")
@@ -154,23 +172,17 @@ class PhiUserIntentWorkflow:
         if gaze_data and len(gaze_data) > 0:
             self.log(f"裁剪{len(gaze_data)}个眼动关注区域", "STEP")
             
-            for i, gaze in enumerate(gaze_data):
-                self.log(f"裁剪眼动点 #{i+1}: 坐标({gaze['coordinates']['x']:.2f}, {gaze['coordinates']['y']:.2f})", "INFO")
-                
-                # 裁剪眼动注视区域
-                cropped_image = self.crop_image_at_gaze(
-                    full_image, 
-                    gaze['coordinates'], 
-                    gaze['radius']
-                )
-                
+            # 所有裁剪框向量化计算，各区域直接从截图裁剪
+            crops, boxes = crop_gaze_images(full_image, gaze_data)
+            for i, (gaze, cropped_image, box) in enumerate(zip(gaze_data, crops, boxes)):
+                self.log(f"眼动点 #{i+1}: 坐标({gaze['coordinates']['x']:.2f}, {gaze['coordinates']['y']:.2f}), 裁剪框{tuple(box.tolist())}", "INFO")
                 cropped_images.append({
                     'gaze_id': i+1,
                     'coordinates': gaze['coordinates'],
                     'cropped_image': cropped_image
                 })
-                
-                self.log(f"眼动区域 #{i+1} 裁剪完成", "SUCCESS")
+            
+            self.log(f"{len(cropped_images)}个眼动区域裁剪完成", "SUCCESS")
         else:
             self.log("未提供眼动数据，跳过图像裁剪步骤", "INFO")
         
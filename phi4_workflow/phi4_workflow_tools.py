@@ -1,13 +1,20 @@
 import base64
 import json
-import torch
+import os
+import sys
 from PIL import Image
 import io
 import re
-from transformers import AutoModelForCausalLM, AutoProcessor, GenerationConfig
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Circle
+
+# 复用xeo-app后端的工具调用解析器
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "xeo-app", "backend"))
+from tool_call_parser import extract_tool_calls
+from lazy_import import lazy_import
+from model_registry import model_registry
+
+# 可视化依赖在用到时才导入，只用工具定义和解析时不加载它们
+plt = lazy_import("matplotlib.pyplot")
+patches = lazy_import("matplotlib.patches")
 
 class ToolManager:
     """工具管理类，处理工具定义、调用和结果处理"""
@@ -369,34 +376,38 @@ class ToolManager:
     
     def parse_tool_calls(self, response):
         """从响应中解析工具调用"""
-        tool_call_pattern = r'```tool_call\n(.*?)\n```'
-        matches = re.finditer(tool_call_pattern, response, re.DOTALL)
-        tool_calls = []
-        
-        for match in matches:
-            try:
-                tool_call_json = json.loads(match.group(1))
-                tool_calls.append(tool_call_json)
-            except json.JSONDecodeError:
-                print(f"无法解析工具调用JSON: {match.group(1)}")
-        
+        _, tool_calls = extract_tool_calls(response, framings=(("```tool_call", "```"),))
         return tool_calls
 
 
 class Phi4WorkflowWithTools:
-    def __init__(self, model_path="/home/lab/phi4/phi4"):
-        """初始化工作流"""
-        self.processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path, 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True,
-            _attn_implementation='flash_attention_2',
-        ).cuda()
+    def __init__(self, model_path="/home/lab/phi4/phi4", backend="auto", cpu_threads=None, quantization=None):
+        """
+        初始化工作流
+        
+        Args:
+            model_path: Phi-4模型路径
+            backend: 推理后端，'cuda'、'cpu'或'auto'（有可用的GPU时使用cuda）
+            cpu_threads: CPU后端的计算线程数
+            quantization: CPU后端的权重量化方式，None、'int8'或'int4'
+        """
+        # 同一模型在进程内只加载一次，与后端服务和其他工作流共用
+        self.loaded_model = model_registry.acquire(model_path, backend=backend, threads=cpu_threads,
+                                                   quantization=quantization)
+        self.backend = self.loaded_model.backend
+        self.processor = self.loaded_model.processor
+        self.model = self.loaded_model.model
+        # 生成配置只在加载时读取一次，不在每次推理时重新读取
+        self.generation_config = self.loaded_model.generation_config
         self.tool_manager = ToolManager()
         self.results = {}  # 存储工作流各步骤的结果
     
+    def close(self):
+        """释放对共享模型的引用（没有其他使用者时模型被卸载）"""
+        model_registry.release(self.loaded_model)
+        self.loaded_model = None
+        self.model = None
+    
     def _encode_image_to_base64(self, image):
         """将PIL图像编码为base64字符串"""
         buffered = io.BytesIO()
@@ -416,14 +427,12 @@ class Phi4WorkflowWithTools:
             text=prompt_with_tools,
             images=images,
             return_tensors='pt'
-        ).to('cuda:0')
-        
-        generation_config = GenerationConfig.from_pretrained("microsoft/Phi-4-multimodal-instruct")
+        ).to(self.backend.device)
         
         generate_ids = self.model.generate(
             **inputs,
             max_new_tokens=1024,
-            generation_config=generation_config,
+            generation_config=self.generation_config,
         )
         generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
         
@@ -441,14 +450,12 @@ class Phi4WorkflowWithTools:
             text=prompt,
             images=images,
             return_tensors='pt'
-        ).to('cuda:0')
-        
-        generation_config = GenerationConfig.from_pretrained("microsoft/Phi-4-multimodal-instruct")
+        ).to(self.backend.device)
         
         generate_ids = self.model.generate(
             **inputs,
             max_new_tokens=512,
-            generation_config=generation_config,
+            generation_config=self.generation_config,
         )
         generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
         
@@ -602,7 +609,7 @@ class Phi4WorkflowWithTools:
         radius_pixel = gaze_data.get("radius", 0.05) * min(width, height)
         
         # 添加表示视线的圆圈
-        gaze_circle = Circle((x_pixel, y_pixel), radius_pixel, 
+        gaze_circle = patches.Circle((x_pixel, y_pixel), radius_pixel, 
                              color='red', alpha=0.5, fill=True)
         ax.add_patch(gaze_circle)
         
@@ -655,7 +662,7 @@ class Phi4WorkflowWithTools:
         radius_pixel = gaze_data.get("radius", 0.05) * min(width, height)
         
         # 添加表示视线的圆圈
-        gaze_circle = Circle((x_pixel, y_pixel), radius_pixel, 
+        gaze_circle = patches.Circle((x_pixel, y_pixel), radius_pixel, 
                              color='red', alpha=0.3, fill=True)
         ax.add_patch(gaze_circle)
         
@@ -0,0 +1,179 @@
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("admission")
+
+
+class AdmissionRejected(Exception):
+    """请求超出准入限制被拒绝"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Superseded(Exception):
+    """排队中的请求已被同一客户端的新请求取代"""
+
+
+class AdmissionTicket:
+    """一个已准入的推理请求"""
+
+    __slots__ = ("kind", "client_id", "payload", "state", "admitted")
+
+    def __init__(self, kind, payload, client_id=None):
+        self.kind = kind
+        self.client_id = client_id
+        self.payload = payload
+        self.state = "queued"  # queued -> running -> done；或superseded / cancelled
+        self.admitted = time.time()
+
+
+class AdmissionController:
+    """
+    推理请求的准入控制
+
+    - 同时执行的推理数不超过max_in_flight，等待执行的请求数不超过max_queue，
+      超出时立即拒绝，并根据近期推理耗时估算Retry-After
+    - 同一客户端同类请求开启合并时，新请求取代尚未开始执行的旧请求，
+      旧请求释放队列名额并丢弃其负载（图像数据）
+    """
+
+    def __init__(self, max_in_flight=1, max_queue=8, initial_service_time=2.0, ewma_alpha=0.2):
+        """
+        Args:
+            max_in_flight: 同时执行的推理数上限
+            max_queue: 等待执行的请求数上限
+            initial_service_time: 还没有统计数据时假定的单次推理耗时（秒）
+            ewma_alpha: 推理耗时指数滑动平均的系数
+        """
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queue = max(0, int(max_queue))
+        self.ewma_alpha = ewma_alpha
+
+        self._slots = threading.Semaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._latest = {}  # (kind, client_id) -> 最新的AdmissionTicket
+        self._service_time = initial_service_time
+        self._stats = {"admitted": 0, "rejected": 0, "coalesced": 0, "cancelled": 0, "completed": 0}
+
+    def admit(self, kind, payload, client_id=None, coalesce=False):
+        """
+        准入一个请求
+
+        Args:
+            kind: 请求类型
+            payload: 执行时需要的数据，执行前一直由票据持有
+            client_id: 客户端标识
+            coalesce: 是否让该请求取代同一客户端同类型的排队请求
+
+        Returns:
+            AdmissionTicket
+
+        Raises:
+            AdmissionRejected: 超出并发或队列限制
+        """
+        key = (kind, client_id)
+        with self._lock:
+            prior = self._latest.get(key) if coalesce and client_id is not None else None
+            freed = 1 if prior is not None and prior.state == "queued" else 0
+
+            if self._in_flight + self._queued - freed >= self.max_in_flight + self.max_queue:
+                self._stats["rejected"] += 1
+                retry_after = self._retry_after_locked()
+                raise AdmissionRejected(
+                    f"推理请求过多（执行中{self._in_flight}个，排队{self._queued}个），请稍后重试",
+                    retry_after
+                )
+
+            if freed:
+                prior.state = "superseded"
+                prior.payload = None
+                self._queued -= 1
+                self._stats["coalesced"] += 1
+                logger.info(f"客户端{client_id}的{kind}请求已被新请求取代")
+
+            ticket = AdmissionTicket(kind, payload, client_id)
+            self._queued += 1
+            self._stats["admitted"] += 1
+            if coalesce and client_id is not None:
+                self._latest[key] = ticket
+            return ticket
+
+    @contextmanager
+    def run(self, ticket):
+        """
+        占用一个执行名额运行请求，产出请求负载
+
+        Raises:
+            Superseded: 请求在开始执行前已被取代
+        """
+        if ticket.state != "queued":
+            raise Superseded()
+
+        self._slots.acquire()
+        with self._lock:
+            if ticket.state != "queued":
+                # 等待名额期间被取代或取消
+                self._slots.release()
+                raise Superseded()
+            ticket.state = "running"
+            self._queued -= 1
+            self._in_flight += 1
+            payload, ticket.payload = ticket.payload, None
+
+        start_time = time.time()
+        try:
+            yield payload
+        finally:
+            duration = time.time() - start_time
+            with self._lock:
+                ticket.state = "done"
+                self._in_flight -= 1
+                self._stats["completed"] += 1
+                self._service_time += self.ewma_alpha * (duration - self._service_time)
+                key = (ticket.kind, ticket.client_id)
+                if self._latest.get(key) is ticket:
+                    del self._latest[key]
+            self._slots.release()
+
+    def release(self, ticket):
+        """取消尚未开始执行的请求（如排队超时），已执行或已取代的请求不受影响"""
+        with self._lock:
+            if ticket.state != "queued":
+                return
+            ticket.state = "cancelled"
+            ticket.payload = None
+            self._queued -= 1
+            self._stats["cancelled"] += 1
+            key = (ticket.kind, ticket.client_id)
+            if self._latest.get(key) is ticket:
+                del self._latest[key]
+
+    def retry_after(self):
+        """按当前积压和平均推理耗时估算的重试等待秒数"""
+        with self._lock:
+            return self._retry_after_locked()
+
+    def _retry_after_locked(self):
+        backlog = self._in_flight + self._queued
+        return max(1, math.ceil(self._service_time * backlog / self.max_in_flight))
+
+    def stats(self):
+        """返回准入控制统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "avg_service_time": self._service_time,
+                "retry_after": self._retry_after_locked(),
+            })
+        return stats
@@ -1,6 +1,6 @@
-from flask import Flask, jsonify, request, send_from_directory, render_template
+from flask import Flask, jsonify, request, send_from_directory, render_template, Response, stream_with_context
 from flask_cors import CORS
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit
 import json
 import os
 import sys
@@ -11,6 +11,15 @@ from PIL import Image
 import io
 import logging
 
+from tool_call_parser import ToolCallParser
+from inference_pool import InferencePool, QueueFullError
+from admission import AdmissionController, AdmissionRejected, Superseded
+from model_lifecycle import ModelUnavailable, UNLOADED, READY, DEGRADED
+from gaze_fixation import GazeSessionStore
+from state_store import StateStore
+from tool_registry import DEVICES, SETTINGS
+from model_registry import model_registry
+
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("app")
@@ -25,48 +34,182 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 # 获取前端文件目录的绝对路径
 frontend_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
-# 初始化设备状态
-devices = {
-    "about-xeo": {"connected": False, "name": "About XEO"},
-    "apple-tv": {"connected": False, "name": "Apple TV"},
-    "playstation": {"connected": False, "name": "Play Station 5"},
-    "nintendo": {"connected": False, "name": "Nintendo Switch"}
-}
-
-# 初始化设置状态
-settings = {
-    "volume": 80,
-    "ipd": 65,
-    "magic": 80,
-    "seat": 50,
-    "ventilation": 100
-}
+# 设备和设置状态：写入经StateStore记录版本，广播窗口内的变更合并成一条state_delta推送
+state_store = StateStore(
+    {
+        "devices": {device_id: {"connected": False, "name": name} for device_id, name in DEVICES.items()},
+        "settings": {
+            "volume": 80,
+            "ipd": 65,
+            "magic": 80,
+            "seat": 50,
+            "ventilation": 100
+        }
+    },
+    max_log=int(os.environ.get("STATE_LOG_SIZE", "1024")),
+    broadcast_window=float(os.environ.get("STATE_BROADCAST_WINDOW_MS", "50")) / 1000,
+    on_delta=lambda delta: socketio.emit('state_delta', delta)
+)
+# 只读引用，写入必须通过state_store
+devices = state_store.data["devices"]
+settings = state_store.data["settings"]
 
 # 保存对话历史记录
 conversation_history = []
 
 # 导入MCP工具执行器
 try:
-    from mcp_executor import set_state_reference, tool_executor, parse_tool_calls
+    from mcp_executor import set_state_reference, create_tool_executor, parse_tool_calls
     # 传递状态引用
-    set_state_reference(devices, settings)
+    set_state_reference(devices, settings, state_store)
+    # 工具执行模式：local在本进程内直接修改状态；remote通过HTTP调用TOOL_API_BASE_URL（执行器在其他进程时使用）
+    tool_executor = create_tool_executor(
+        mode=os.environ.get("TOOL_EXECUTOR_MODE", "local"),
+        api_base_url=os.environ.get("TOOL_API_BASE_URL", "http://localhost:5000/api"),
+        timeout=float(os.environ.get("TOOL_API_TIMEOUT", "5")),
+        pool_size=int(os.environ.get("TOOL_API_POOL_SIZE", "4"))
+    )
+    
+    from tool_engine import ToolEngine
+    # 同一响应中的多个工具调用：不同设备/设置并发执行，状态变化合并广播；TOOL_TRANSACTIONAL为True时全部成功才生效
+    tool_engine = ToolEngine(tool_executor, state_store, max_workers=int(os.environ.get("TOOL_ENGINE_WORKERS", "4")))
+    tool_transactional = os.environ.get("TOOL_TRANSACTIONAL", "False").lower() == "true"
     logger.info("已加载MCP工具执行器")
 except ImportError as e:
     logger.error(f"导入MCP工具执行器失败: {str(e)}")
     tool_executor = None
+    tool_engine = None
 
 # 导入Phi4意图处理器
 try:
     phi_model_path = os.environ.get("PHI_MODEL_PATH", "/home/lab/phi4/phi4")
     use_local_model = os.environ.get("USE_LOCAL_MODEL", "True").lower() == "true"
+    # 微批处理配置：PHI_BATCH_MAX_SIZE为1时不启用
+    batch_max_size = int(os.environ.get("PHI_BATCH_MAX_SIZE", "1"))
+    batch_max_wait_ms = float(os.environ.get("PHI_BATCH_MAX_WAIT_MS", "10"))
+    
+    from ui_cache import create_ui_cache
+    # UI分析缓存配置：设置PHI_UI_CACHE_PATH时使用可跨进程共享的SQLite存储
+    ui_cache_ttl = os.environ.get("PHI_UI_CACHE_TTL")
+    ui_cache = create_ui_cache(
+        path=os.environ.get("PHI_UI_CACHE_PATH"),
+        max_entries=int(os.environ.get("PHI_UI_CACHE_MAX_ENTRIES", "1024")),
+        max_bytes=int(os.environ.get("PHI_UI_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+        ttl=float(ui_cache_ttl) if ui_cache_ttl else None
+    )
+    
+    # 工具调用完成后提前停止生成（意图推理和聊天两个调用处分别配置）；
+    # 停止时只保留工具调用块之后的第一句话，其后的工具调用和确认文本会丢失，两处默认都不提前停止
+    intent_stop_on_tool_call = os.environ.get("PHI_INTENT_STOP_ON_TOOL_CALL", "False").lower() == "true"
+    chat_stop_on_tool_call = os.environ.get("PHI_CHAT_STOP_ON_TOOL_CALL", "False").lower() == "true"
+    
+    from crop_sink import create_crop_sink
+    # 裁剪图像异步保存：设置PHI_CROP_SINK_DIR时启用，否则裁剪图像只保留在内存中
+    crop_sink_max_age = os.environ.get("PHI_CROP_SINK_MAX_AGE")
+    crop_sink = create_crop_sink(
+        directory=os.environ.get("PHI_CROP_SINK_DIR"),
+        max_queue=int(os.environ.get("PHI_CROP_SINK_MAX_QUEUE", "64")),
+        sample_rate=float(os.environ.get("PHI_CROP_SINK_SAMPLE_RATE", "1.0")),
+        max_files=int(os.environ.get("PHI_CROP_SINK_MAX_FILES", "1000")),
+        max_age=float(crop_sink_max_age) if crop_sink_max_age else None,
+        image_format=os.environ.get("PHI_CROP_SINK_FORMAT", "png"),
+        compress_level=int(os.environ.get("PHI_CROP_SINK_COMPRESS_LEVEL", "1")),
+        quality=int(os.environ.get("PHI_CROP_SINK_QUALITY", "85"))
+    )
+    
+    # 模型加载方式；推理请求遇到加载中的模型时最多等待PHI_MODEL_LOAD_WAIT秒，之后返回503
+    model_load_mode = os.environ.get("PHI_MODEL_LOAD_MODE", "warm")
+    model_load_wait = float(os.environ.get("PHI_MODEL_LOAD_WAIT", "0"))
+    # 模型加载失败降级为模拟模式时就绪探针默认返回503，让编排系统发现；PHI_READY_WHEN_DEGRADED为True时仍视为就绪
+    ready_when_degraded = os.environ.get("PHI_READY_WHEN_DEGRADED", "False").lower() == "true"
+    
+    # 推理后端：PHI_BACKEND为auto时有可用的GPU则用cuda，否则用cpu；为onnx时用ONNX Runtime加载PHI_ONNX_MODEL_PATH；
+    # CPU后端可设置线程数和权重量化（PHI_QUANTIZATION为int8或int4，为空时不量化）
+    cpu_threads = os.environ.get("PHI_CPU_THREADS")
+    quantization = os.environ.get("PHI_QUANTIZATION")
+    
+    # 感知哈希近似重复查找：PHI_PHASH_THRESHOLD为空时不启用
+    phash_threshold = os.environ.get("PHI_PHASH_THRESHOLD", "4")
     
     from phi_intent import get_intent_processor
-    intent_processor = get_intent_processor(model_path=phi_model_path, use_local_model=use_local_model)
-    logger.info(f"已加载Phi4意图处理器，使用模型路径: {phi_model_path}")
+    intent_processor = get_intent_processor(
+        model_path=phi_model_path,
+        use_local_model=use_local_model,
+        max_batch_size=batch_max_size,
+        max_batch_wait_ms=batch_max_wait_ms,
+        ui_cache=ui_cache,
+        phash_threshold=int(phash_threshold) if phash_threshold else None,
+        phash_method=os.environ.get("PHI_PHASH_METHOD", "dhash"),
+        stop_on_tool_call=intent_stop_on_tool_call,
+        use_prefix_cache=os.environ.get("PHI_PREFIX_CACHE", "True").lower() == "true",
+        intent_mode=os.environ.get("PHI_INTENT_MODE", "two_pass"),
+        # 截图预处理与视觉编码缓存，字节预算对像素和嵌入两部分分别生效
+        use_embedding_cache=os.environ.get("PHI_EMBEDDING_CACHE", "True").lower() == "true",
+        embedding_cache_max_bytes=int(os.environ.get("PHI_EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+        crop_sink=crop_sink,
+        # 工具调用块按工具定义约束解码（加载模型时需要解码一遍词表）
+        constrained_tool_calls=os.environ.get("PHI_CONSTRAINED_TOOL_CALLS", "False").lower() == "true",
+        # 模型在后台加载：warm在启动时开始加载，lazy在第一次推理请求时才加载
+        load_mode=model_load_mode,
+        fallback_to_mock=os.environ.get("PHI_MODEL_FALLBACK_MOCK", "True").lower() == "true",
+        backend=os.environ.get("PHI_BACKEND", "auto"),
+        cpu_threads=int(cpu_threads) if cpu_threads else None,
+        quantization=quantization or None,
+        onnx_model_path=os.environ.get("PHI_ONNX_MODEL_PATH")
+    )
+    logger.info(f"已创建Phi4意图处理器，使用模型路径: {phi_model_path}，模型状态: {intent_processor.lifecycle.state}")
 except ImportError as e:
     logger.error(f"导入Phi4意图处理器失败: {str(e)}")
     intent_processor = None
 
+def job_payload(job):
+    """任务状态的JSON表示，任务结果(响应体, HTTP状态码)拆成result和status_code"""
+    data = job.to_dict()
+    if "result" in data:
+        data["result"], data["status_code"] = data["result"]
+    return data
+
+def notify_job_done(job):
+    """通过Socket.IO把任务结果推送给提交任务的客户端"""
+    # 排队期间超时的任务不会执行，归还其准入名额
+    ticket = job.meta.get("ticket")
+    if ticket is not None:
+        admission.release(ticket)
+    sid = job.meta.get("sid")
+    if sid:
+        socketio.emit('phi_job_done', job_payload(job), to=sid)
+
+# 推理线程池：模型推理不占用Flask请求线程，设备/设置等状态接口保持低延迟；
+# 启用微批处理时每个工作线程在call_model中等待一个批次，默认线程数（及执行中的推理数上限）等于最大批大小，
+# 否则同时只有一个请求到达调度器，凑不成批
+pool_workers = int(os.environ.get("PHI_POOL_WORKERS", str(batch_max_size)))
+pool_timeout = os.environ.get("PHI_POOL_TIMEOUT", "120")
+inference_pool = InferencePool(
+    workers=pool_workers,
+    max_queue=int(os.environ.get("PHI_POOL_MAX_QUEUE", "32")),
+    default_timeout=float(pool_timeout) if pool_timeout else None,
+    result_ttl=float(os.environ.get("PHI_JOB_RESULT_TTL", "300")),
+    on_complete=notify_job_done
+)
+inference_pool.start()
+
+# 准入控制：限制执行中和排队的推理数，超出时返回429
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get("PHI_MAX_IN_FLIGHT", str(pool_workers))),
+    max_queue=int(os.environ.get("PHI_MAX_QUEUE_DEPTH", "8"))
+)
+
+# 眼动注视检测：客户端通过gaze_samples事件上传原始采样，意图请求未提供gaze时使用该客户端的前k个注视簇
+gaze_top_k = int(os.environ.get("PHI_GAZE_TOP_K", "3"))
+gaze_fixation_radius = float(os.environ.get("PHI_GAZE_FIXATION_RADIUS", "0.1"))
+gaze_sessions = GazeSessionStore(
+    max_sessions=int(os.environ.get("PHI_GAZE_MAX_SESSIONS", "256")),
+    velocity_threshold=float(os.environ.get("PHI_GAZE_VELOCITY_THRESHOLD", "1.0")),
+    min_duration=float(os.environ.get("PHI_GAZE_MIN_FIXATION_MS", "100")) / 1000,
+    merge_radius=float(os.environ.get("PHI_GAZE_MERGE_RADIUS", "0.05")),
+    decay_seconds=float(os.environ.get("PHI_GAZE_DECAY_SECONDS", "5"))
+)
+
 # 路由：提供前端文件
 @app.route('/')
 def index():
@@ -95,15 +238,9 @@ def connect_device(device_id):
     if device_id not in devices:
         return jsonify({"error": "Device not found"}), 404
     
-    # 切换连接状态
-    devices[device_id]['connected'] = not devices[device_id]['connected']
-    status = "connected" if devices[device_id]['connected'] else "disconnected"
-    
-    # 通过WebSocket广播状态变化
-    socketio.emit('device_status_change', {
-        'device_id': device_id,
-        'connected': devices[device_id]['connected']
-    })
+    # 切换连接状态（变化通过state_delta广播）
+    connected = state_store.update(("devices", device_id, "connected"), lambda value: not value)
+    status = "connected" if connected else "disconnected"
     
     return jsonify({
         "status": status,
@@ -130,24 +267,12 @@ def update_setting(setting_id):
         value = int(data['value'])
         
         # 根据不同设置类型进行验证
-        if setting_id == "volume" and 0 <= value <= 100:
-            settings[setting_id] = value
-        elif setting_id == "ipd" and 50 <= value <= 80:
-            settings[setting_id] = value
-        elif setting_id == "magic" and 0 <= value <= 100:
-            settings[setting_id] = value
-        elif setting_id == "seat" and 0 <= value <= 100:
-            settings[setting_id] = value
-        elif setting_id == "ventilation" and 0 <= value <= 100:
-            settings[setting_id] = value
-        else:
+        min_value, max_value = SETTINGS[setting_id][:2]
+        if not min_value <= value <= max_value:
             return jsonify({"error": "Invalid value range"}), 400
         
-        # 通过WebSocket广播设置变化
-        socketio.emit('setting_change', {
-            'setting_id': setting_id,
-            'value': settings[setting_id]
-        })
+        # 写入状态（变化通过state_delta广播）
+        state_store.set(("settings", setting_id), value)
         
         return jsonify({
             "setting_id": setting_id,
@@ -156,6 +281,19 @@ def update_setting(setting_id):
     except ValueError:
         return jsonify({"error": "Value must be a number"}), 400
 
+# 路由：带版本号的完整状态，或since指定版本之后的增量
+# 变更日志已不包含since之后的全部版本时返回完整状态（full为true）
+@app.route('/api/state', methods=['GET'])
+def get_state():
+    since = request.args.get('since', type=int)
+    if since is not None:
+        delta = state_store.since(since)
+        if delta is not None:
+            delta["full"] = False
+            return jsonify(delta)
+    version, state = state_store.snapshot()
+    return jsonify({"version": version, "state": state, "full": True})
+
 # ===========================================
 # MCP集成路由
 # ===========================================
@@ -178,8 +316,10 @@ def mcp_chat_api():
     if not data or 'message' not in data:
         return jsonify({"error": "Message is required"}), 400
     
-    user_message = data['message']
-    
+    return run_inference_job("chat", chat_job, (data['message'],), request_client_id(data))
+
+def chat_job(user_message):
+    """聊天推理任务，在推理线程池中执行，返回(响应体, HTTP状态码)"""
     # 添加用户消息到历史记录
     conversation_history.append({"role": "user", "content": user_message})
     
@@ -213,79 +353,368 @@ def mcp_chat_api():
         conversation_history.pop(0)
         conversation_history.pop(0)
     
-    return jsonify({
+    return {
         "message": assistant_message,
         "tools_called": tools_called
-    })
+    }, 200
+
+def request_client_id(data=None):
+    """客户端标识：请求体中的client_id或X-Client-Id请求头，用于合并同一客户端的请求"""
+    return (data or {}).get('client_id') or request.headers.get('X-Client-Id')
+
+def admit_inference_job(kind, fn, args, client_id=None, timeout=None, sid=None):
+    """
+    经准入控制后提交推理任务
+    
+    同一客户端的意图请求会合并：新的手势请求取代该客户端尚未开始执行的旧请求。
+    
+    Raises:
+        ModelUnavailable: 模型加载中或加载失败
+        AdmissionRejected: 超出执行中或排队的推理数限制
+    """
+    check_model_ready()
+    ticket = admission.admit(kind, args, client_id=client_id, coalesce=(kind == "intent"))
+    try:
+        return inference_pool.submit(kind, run_admitted_job, ticket, fn, timeout=timeout,
+                                     meta={"sid": sid, "ticket": ticket})
+    except QueueFullError as e:
+        admission.release(ticket)
+        raise AdmissionRejected(str(e), admission.retry_after())
+
+def run_admitted_job(ticket, fn):
+    """在推理线程池中占用执行名额运行任务"""
+    try:
+        with admission.run(ticket) as args:
+            return fn(*args)
+    except Superseded:
+        return {"error": "已被同一客户端的新请求取代", "superseded": True}, 409
+
+def resolve_gaze(gaze_data, client_id=None):
+    """请求未提供gaze时，使用该客户端眼动流中最显著的注视簇（没有则为None）"""
+    if gaze_data or client_id is None:
+        return gaze_data
+    return gaze_sessions.top_fixations(client_id, gaze_top_k, gaze_fixation_radius) or None
+
+def check_model_ready():
+    """推理请求入口的就绪检查：按需加载模式下触发加载，模型不可用时抛出ModelUnavailable"""
+    if intent_processor is not None:
+        intent_processor.lifecycle.check(wait=model_load_wait)
+
+def unavailable_response(e):
+    """模型不可用时的503响应，加载中时带Retry-After"""
+    body = {"error": str(e), "model_state": e.state}
+    if e.retry_after is not None:
+        body["retry_after"] = e.retry_after
+    response = jsonify(body)
+    if e.retry_after is not None:
+        response.headers["Retry-After"] = str(e.retry_after)
+    return response, 503
+
+def rejected_response(e):
+    """准入被拒绝时的429响应"""
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 429
+
+def run_inference_job(kind, fn, args, client_id=None):
+    """提交推理任务并在当前请求中等待结果（同步接口使用）"""
+    try:
+        job = admit_inference_job(kind, fn, args, client_id)
+    except ModelUnavailable as e:
+        return unavailable_response(e)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    
+    job.wait()
+    if job.status == "timeout":
+        return jsonify({"error": job.error, "job_id": job.job_id}), 504
+    if job.status == "failed":
+        return jsonify({"error": job.error}), 500
+    body, status = job.result
+    return jsonify(body), status
+
+# 路由：提交异步推理任务，立即返回任务ID
+@app.route('/api/phi/jobs', methods=['POST'])
+def submit_phi_job():
+    data = request.get_json(silent=True) or {}
+    try:
+        job, error = submit_inference_job(data, client_id=request_client_id(data), sid=data.get('sid'))
+    except ModelUnavailable as e:
+        return unavailable_response(e)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+    return jsonify(job_payload(job)), 202
+
+# 路由：轮询异步推理任务的状态和结果
+@app.route('/api/phi/jobs/<job_id>', methods=['GET'])
+def get_phi_job(job_id):
+    job = inference_pool.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在或结果已过期"}), 404
+    return jsonify(job_payload(job))
+
+# 路由：推理线程池统计
+@app.route('/api/phi/jobs', methods=['GET'])
+def phi_job_stats():
+    return jsonify(inference_pool.stats())
+
+# 路由：推理服务指标（准入控制、线程池、微批处理）
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    data = {
+        "admission": admission.stats(),
+        "inference_pool": inference_pool.stats()
+    }
+    if intent_processor is not None and intent_processor.batch_scheduler is not None:
+        data["batching"] = intent_processor.batch_scheduler.stats()
+    if intent_processor is not None and intent_processor.crop_sink is not None:
+        data["crop_sink"] = intent_processor.crop_sink.stats()
+    if intent_processor is not None:
+        data["model"] = intent_processor.lifecycle.status()
+        if intent_processor.backend is not None:
+            data["model"]["backend"] = intent_processor.backend.describe()
+    data["model_registry"] = model_registry.stats()
+    data["gaze_sessions"] = len(gaze_sessions)
+    data["state_store"] = state_store.stats()
+    return jsonify(data)
+
+# 路由：存活探针，进程能处理请求即返回200（不依赖模型是否加载完成）
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"})
+
+# 路由：就绪探针，模型可用（或按需加载模式下尚未加载）时返回200，加载中、加载失败或降级为模拟模式时返回503
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    if intent_processor is None:
+        return jsonify({"status": "ready", "model": None})
+    model = intent_processor.lifecycle.status()
+    ready_states = (READY, DEGRADED, UNLOADED) if ready_when_degraded else (READY, UNLOADED)
+    if model["state"] in ready_states:
+        return jsonify({"status": model["state"], "model": model})
+    return jsonify({"status": model["state"], "model": model}), 503
+
+# 路由：客户端眼动流的注视检测结果
+@app.route('/api/gaze/fixations', methods=['GET'])
+def gaze_fixations():
+    client_id = request.args.get('client_id') or request.headers.get('X-Client-Id')
+    detector = gaze_sessions.get(client_id) if client_id else None
+    if detector is None:
+        return jsonify({"error": "该客户端没有眼动数据"}), 404
+    k = request.args.get('k', gaze_top_k, type=int)
+    data = {
+        "fixations": gaze_sessions.top_fixations(client_id, k, gaze_fixation_radius),
+        "stats": detector.stats()
+    }
+    if request.args.get('heatmap', '').lower() == 'true':
+        data["heatmap"] = detector.heatmap.round(4).tolist()
+    return jsonify(data)
+
+def submit_inference_job(data, client_id=None, sid=None):
+    """
+    按请求体中的type提交异步推理任务
+    
+    Args:
+        data: {"type": "intent"|"analyze_ui"|"chat", ...各类型的参数, "timeout": 可选超时秒数}
+        client_id: 客户端标识，用于合并同一客户端的意图请求（可选）
+        sid: 结果推送的Socket.IO会话ID（可选）
+    
+    Returns:
+        (job, None)或(None, (错误响应体, HTTP状态码))
+    
+    Raises:
+        ModelUnavailable: 模型加载中或加载失败
+        AdmissionRejected: 超出准入限制
+    """
+    job_type = data.get('type')
+    if job_type == 'chat':
+        if not data.get('message'):
+            return None, ({"error": "Message is required"}, 400)
+        fn, args = chat_job, (data['message'],)
+    elif job_type in ('intent', 'analyze_ui'):
+        if not data.get('image'):
+            return None, ({"error": "未提供图像数据"}, 400)
+        if not intent_processor:
+            return None, ({"error": "Phi4意图处理器未初始化"}, 500)
+        if job_type == 'intent':
+            gaze_data = resolve_gaze(data.get('gaze'), client_id)
+            fn, args = intent_job, (data['image'], data.get('gesture', 'unknown'), gaze_data, data.get('mode'))
+        else:
+            fn, args = analyze_ui_job, (data['image'],)
+    else:
+        return None, ({"error": "type必须是'intent'、'analyze_ui'或'chat'"}, 400)
+    
+    job = admit_inference_job(job_type, fn, args, client_id, timeout=data.get('timeout'), sid=sid)
+    return job, None
+
+# 路由：MCP流式聊天（Server-Sent Events）
+@app.route('/api/mcp/chat/stream', methods=['GET', 'POST'])
+def mcp_chat_stream_api():
+    # EventSource只能发GET请求，因此同时支持查询参数和JSON请求体
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = request.args
+    user_message = data.get('message')
+    
+    if not user_message:
+        return jsonify({"error": "Message is required"}), 400
+    try:
+        ticket = admit_chat_stream(user_message, client_id=request_client_id(data))
+    except ModelUnavailable as e:
+        return unavailable_response(e)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    
+    def event_stream():
+        for event, payload in run_chat_stream(ticket):
+            yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    
+    response = Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # 客户端在流开始前断开时，归还排队名额
+    response.call_on_close(lambda: admission.release(ticket))
+    return response
+
+def admit_chat_stream(user_message, client_id=None):
+    """
+    流式聊天的准入
+    
+    流式生成需要独占一次generate，不经过推理线程池，但与其他推理请求共用准入控制的执行名额，
+    同时执行的推理总数不超过max_in_flight。
+    
+    Raises:
+        ModelUnavailable: 模型加载中或加载失败
+        AdmissionRejected: 超出执行中或排队的推理数限制
+    """
+    check_model_ready()
+    return admission.admit("chat_stream", (user_message,), client_id=client_id)
+
+def run_chat_stream(ticket):
+    """占用执行名额流式生成聊天回复，流结束（或客户端断开）时归还名额"""
+    try:
+        with admission.run(ticket) as (user_message,):
+            yield from stream_chat_with_tools(user_message)
+    except Superseded:
+        # 排队期间已被取消（客户端断开）
+        return
+
+def stream_chat_with_tools(user_message):
+    """
+    流式处理带工具的聊天请求
+    
+    工具调用块一闭合就立即执行，不必等待整段生成结束。
+    
+    Yields:
+        (event, payload)事件：
+        - ('delta', {"text"}): 助手回复的文本增量
+        - ('tool_call', {"name", "arguments", "result"}): 已执行的工具调用
+        - ('done', {"message", "tools_called"}): 生成结束
+    """
+    conversation_history.append({"role": "user", "content": user_message})
+    message_parts = []
+    tools_called = []
+    
+    try:
+        if intent_processor is not None:
+            prompt = f"<|user|>{user_message}<|end|>"
+            parser = ToolCallParser()
+            
+            def run_calls(calls):
+                # 工具调用一闭合就执行，不等整个工具调用块结束
+                calls = intent_processor.filter_tool_calls(calls)
+                for tool_call, result in zip(calls, execute_tools(calls)):
+                    tools_called.append(tool_call["name"])
+                    yield "tool_call", {
+                        "name": tool_call["name"],
+                        "arguments": result.get("arguments", {}),
+                        "result": result
+                    }
+            
+            for chunk in intent_processor.call_model_stream(prompt, image=None, max_new_tokens=250, use_tools=True,
+                                                            stop_on_tool_call=chat_stop_on_tool_call):
+                text, calls = parser.feed(chunk)
+                if text:
+                    message_parts.append(text)
+                    yield "delta", {"text": text}
+                yield from run_calls(calls)
+            
+            text, calls = parser.flush()
+            if text:
+                message_parts.append(text)
+                yield "delta", {"text": text}
+            yield from run_calls(calls)
+        else:
+            # 如果没有phi_intent处理器，使用简单回复
+            text = generate_fallback_message(user_message)
+            message_parts.append(text)
+            yield "delta", {"text": text}
+    
+    except Exception as e:
+        text = f"在处理您的请求时出错: {str(e)}"
+        logger.error(f"流式处理消息出错: {str(e)}")
+        message_parts.append(text)
+        yield "delta", {"text": text}
+    
+    assistant_message = "".join(message_parts).strip()
+    conversation_history.append({"role": "assistant", "content": assistant_message})
+    
+    # 只保留最近的10条对话
+    if len(conversation_history) > 20:
+        conversation_history.pop(0)
+        conversation_history.pop(0)
+    
+    yield "done", {"message": assistant_message, "tools_called": tools_called}
 
 def process_chat_with_tools(prompt):
     """使用phi_intent处理器处理带工具的聊天请求"""
     # 调用模型进行推理
-    response_text, _ = intent_processor.call_model(prompt, image=None, max_new_tokens=250, use_tools=True)
+    response_text, _ = intent_processor.call_model(
+        prompt, image=None, max_new_tokens=250, use_tools=True,
+        stop_on_tool_call=chat_stop_on_tool_call
+    )
     
-    # 解析工具调用
-    tool_calls = intent_processor.parse_tool_calls(response_text)
+    # 解析工具调用，响应文本去除工具调用部分
+    text, tool_calls = intent_processor.split_tool_calls(response_text)
     
     # 执行工具调用
     if tool_calls:
-        tool_results = []
-        for tool_call in tool_calls:
-            try:
-                # 调用工具
-                result = execute_tool(
-                    tool_call["name"], 
-                    tool_call.get("parameters", {})
-                )
-                tool_results.append(result)
-            except Exception as e:
-                print(f"执行工具调用时出错: {str(e)}")
-        
-        # 提取响应文本（去除工具调用部分）
-        import re
-        response_text = re.sub(r'<\|tool_call\|>.*?<\|/tool_call\|>', '', response_text, flags=re.DOTALL).strip()
+        execute_tools(tool_calls)
+        response_text = text
     
     return response_text, [tool.get("name") for tool in tool_calls]
 
+def execute_tools(tool_calls):
+    """
+    执行一次模型响应中的全部工具调用
+    
+    Returns:
+        与tool_calls一一对应的执行结果
+    """
+    if not tool_calls:
+        return []
+    if not tool_engine:
+        return [{"error": "工具执行器未初始化"} for _ in tool_calls]
+    
+    outcome = tool_engine.run(tool_calls, transactional=tool_transactional)
+    if outcome["rolled_back"]:
+        logger.warning("工具调用部分失败，已回滚本次响应中的全部状态变化")
+    return outcome["results"]
+
 def execute_tool(tool_name, parameters):
     """执行工具调用"""
     if not tool_executor:
         return {"error": "工具执行器未初始化"}
     
-    # 调用工具执行器处理
-    device_mapping = {
-        "connect_device": {
-            "about-xeo": "connect_about_xeo",
-            "apple-tv": "connect_apple_tv",
-            "playstation": "connect_playstation",
-            "nintendo": "connect_nintendo"
-        },
-        "adjust_setting": {
-            "volume": "adjust_volume",
-            "ipd": "adjust_ipd",
-            "magic": "adjust_magic",
-            "seat": "adjust_seat",
-            "ventilation": "adjust_ventilation"
-        }
-    }
-    
     try:
-        if tool_name == "connect_device":
-            device_id = parameters.get("device_id", "")
-            mapped_tool = device_mapping["connect_device"].get(device_id)
-            if mapped_tool:
-                return tool_executor.execute_tool(mapped_tool, {})
-        
-        elif tool_name == "adjust_setting":
-            setting_id = parameters.get("setting_id", "")
-            value = parameters.get("value", 0)
-            mapped_tool = device_mapping["adjust_setting"].get(setting_id)
-            if mapped_tool:
-                return tool_executor.execute_tool(mapped_tool, {"value": value})
-    
+        return tool_executor.execute_tool(tool_name, parameters or {})
     except Exception as e:
         return {"error": str(e)}
-    
-    return {"error": "未实现的工具或无效参数"}
 
 def generate_fallback_message(user_message):
     """生成备用回复，当没有工具调用时使用"""
@@ -310,8 +739,91 @@ def handle_connect():
 # WebSocket事件：客户端断开
 @socketio.on('disconnect')
 def handle_disconnect():
+    gaze_sessions.drop(request.sid)
     print('Client disconnected')
 
+# WebSocket事件：状态同步
+# data = {"since": 客户端已有的版本号}，回复state_delta（增量）或state_snapshot（完整状态）
+@socketio.on('state_sync')
+def handle_state_sync(data):
+    since = (data or {}).get('since')
+    delta = state_store.since(since) if isinstance(since, int) else None
+    if delta is not None:
+        emit('state_delta', delta)
+        return
+    version, state = state_store.snapshot()
+    emit('state_snapshot', {"version": version, "state": state})
+
+# WebSocket事件：MCP流式聊天
+@socketio.on('mcp_chat_stream')
+def handle_mcp_chat_stream(data):
+    user_message = (data or {}).get('message')
+    if not user_message:
+        emit('mcp_chat_error', {"error": "Message is required"})
+        return
+    try:
+        ticket = admit_chat_stream(user_message, client_id=(data or {}).get('client_id'))
+    except ModelUnavailable as e:
+        emit('mcp_chat_error', {"error": str(e), "model_state": e.state, "retry_after": e.retry_after})
+        return
+    except AdmissionRejected as e:
+        emit('mcp_chat_error', {"error": str(e), "retry_after": e.retry_after})
+        return
+    
+    sid = request.sid
+    
+    def run():
+        for event, payload in run_chat_stream(ticket):
+            socketio.emit(f'mcp_chat_{event}', payload, to=sid)
+    
+    # 在后台任务中生成，避免阻塞该客户端的其他Socket.IO事件
+    socketio.start_background_task(run)
+
+# WebSocket事件：提交异步推理任务，结果通过phi_job_done推送
+@socketio.on('phi_job_submit')
+def handle_phi_job_submit(data):
+    submit_socket_job(data or {})
+
+# WebSocket事件：二进制图像的意图推理
+# data = {"image": 图像字节（二进制附件）, "gesture", "gaze", "mode", "client_id"}，结果通过phi_job_done推送
+@socketio.on('phi_intent_binary')
+def handle_phi_intent_binary(data):
+    data = dict(data or {})
+    data.setdefault('type', 'intent')
+    submit_socket_job(data)
+
+# WebSocket事件：原始眼动采样流
+# data = {"samples": [[t, x, y], ...]或[{"t", "x", "y"}, ...], "client_id"}，t为秒，x/y为0~1
+# 有注视结束时向客户端推送gaze_fixations（当前的前k个注视簇）
+@socketio.on('gaze_samples')
+def handle_gaze_samples(data):
+    data = data or {}
+    client_id = data.get('client_id') or request.sid
+    try:
+        closed = gaze_sessions.feed(client_id, data.get('samples') or [])
+    except (KeyError, TypeError, ValueError) as e:
+        emit('gaze_error', {"error": f"眼动采样格式错误: {str(e)}"})
+        return
+    if closed:
+        emit('gaze_fixations', {
+            "fixations": gaze_sessions.top_fixations(client_id, gaze_top_k, gaze_fixation_radius)
+        })
+
+def submit_socket_job(data):
+    """提交Socket.IO客户端的推理任务，回复phi_job_accepted或phi_job_error"""
+    try:
+        job, error = submit_inference_job(data, client_id=data.get('client_id') or request.sid, sid=request.sid)
+    except ModelUnavailable as e:
+        emit('phi_job_error', {"error": str(e), "model_state": e.state, "retry_after": e.retry_after})
+        return
+    except AdmissionRejected as e:
+        emit('phi_job_error', {"error": str(e), "retry_after": e.retry_after})
+        return
+    if error is not None:
+        emit('phi_job_error', error[0])
+        return
+    emit('phi_job_accepted', job_payload(job))
+
 # 创建必要的模板文件
 def create_templates():
     """创建必要的模板文件"""
@@ -419,26 +931,14 @@ def handle_state_change(change_type, change_data):
         connected = change_data.get("connected")
         
         if device_id in devices:
-            devices[device_id]["connected"] = connected
-            
-            # 广播状态更新
-            socketio.emit('device_status_change', {
-                'device_id': device_id,
-                'connected': connected
-            })
+            state_store.set(("devices", device_id, "connected"), connected)
     
     elif change_type == "setting":
         setting_id = change_data.get("setting_id")
         value = change_data.get("value")
         
         if setting_id in settings:
-            settings[setting_id] = value
-            
-            # 广播状态更新
-            socketio.emit('setting_change', {
-                'setting_id': setting_id,
-                'value': value
-            })
+            state_store.set(("settings", setting_id), value)
 
 # 路由：统一首页路由
 @app.route('/index.html')
@@ -449,64 +949,136 @@ def index_html():
 @app.route('/api/phi/analyze_ui', methods=['POST'])
 def analyze_ui():
     # 检查是否有图像文件
-    if not request.json or 'image' not in request.json:
+    image_data, params = parse_image_request()
+    if not image_data:
         return jsonify({"error": "未提供图像数据"}), 400
     
-    image_data = request.json['image']
-    
     # 检查intent_processor是否可用
     if not intent_processor:
         return jsonify({"error": "Phi4意图处理器未初始化"}), 500
     
+    return run_inference_job("analyze_ui", analyze_ui_job, (image_data,), request_client_id(params))
+
+def parse_image_request():
+    """
+    解析带图像的推理请求，支持三种格式：
+    - JSON：{"image": base64 data URL, ...其他参数}
+    - multipart/form-data：image文件字段，其他参数为表单字段（gaze为JSON字符串）
+    - 二进制（image/*或application/octet-stream）：请求体即图像，其他参数放在查询字符串中
+    
+    Returns:
+        (image_data, params)：image_data为base64字符串或bytes，缺失时为None
+    """
+    if request.is_json:
+        params = request.get_json(silent=True) or {}
+        return params.get('image'), params
+    
+    if request.mimetype == 'multipart/form-data':
+        params = request.form.to_dict()
+        upload = request.files.get('image')
+        image_data = upload.read() if upload else None
+    else:
+        params = request.args.to_dict()
+        image_data = request.get_data(cache=False) or None
+    
+    if isinstance(params.get('gaze'), str):
+        try:
+            params['gaze'] = json.loads(params['gaze'])
+        except json.JSONDecodeError:
+            params['gaze'] = None
+    return image_data, params
+
+def load_request_image(image_data):
+    """JSON接口的base64字符串按原方式解码，二进制上传的bytes直接交给PIL"""
+    if isinstance(image_data, str):
+        return intent_processor.process_base64_image(image_data)
+    return intent_processor.process_image_bytes(image_data)
+
+def analyze_ui_job(image_data):
+    """UI分析任务，在推理线程池中执行，返回(响应体, HTTP状态码)"""
     try:
         # 处理图像数据
-        image = intent_processor.process_base64_image(image_data)
+        image = load_request_image(image_data)
         if not image:
-            return jsonify({"error": "无法处理图像数据"}), 400
+            return {"error": "无法处理图像数据"}, 400
         
         # 分析UI
         result = intent_processor.analyze_ui(image)
         
         if "error" in result:
-            return jsonify({"error": result["error"]}), 500
+            return {"error": result["error"]}, 500
         
         # 返回分析结果
-        return jsonify({
+        return {
             "success": True,
             "analysis": result["analysis"],
             "response_time": result.get("response_time", 0)
-        })
+        }, 200
     
     except Exception as e:
         logger.error(f"UI分析错误: {str(e)}")
-        return jsonify({"error": f"分析UI时出错: {str(e)}"}), 500
+        return {"error": f"分析UI时出错: {str(e)}"}, 500
+
+# 路由：UI分析缓存统计
+@app.route('/api/phi/cache/stats', methods=['GET'])
+def ui_cache_stats():
+    if not intent_processor:
+        return jsonify({"error": "Phi4意图处理器未初始化"}), 500
+    stats = intent_processor.ui_analysis_cache.stats()
+    if intent_processor.phash_index is not None:
+        stats["phash"] = {
+            "entries": len(intent_processor.phash_index),
+            "max_distance": intent_processor.phash_index.max_distance,
+            "near_hits": intent_processor.phash_near_hits
+        }
+    if intent_processor.embedding_cache is not None:
+        stats["embedding"] = intent_processor.embedding_cache.stats()
+    return jsonify(stats)
+
+# 路由：工具模式生成的提前停止统计
+@app.route('/api/phi/generation/stats', methods=['GET'])
+def generation_stats():
+    if not intent_processor:
+        return jsonify({"error": "Phi4意图处理器未初始化"}), 500
+    stats = dict(intent_processor.early_stop_stats)
+    if intent_processor.prefix_cache is not None:
+        stats["prefix_cache"] = intent_processor.prefix_cache.stats()
+    return jsonify(stats)
 
 # 路由：Phi4意图分析接口
 @app.route('/api/phi/intent', methods=['POST'])
 def phi_intent_analysis():
     # 检查是否有图像文件
-    if not request.json or 'image' not in request.json:
+    image_data, params = parse_image_request()
+    if not image_data:
         return jsonify({"error": "未提供图像数据"}), 400
     
-    image_data = request.json['image']
-    gesture = request.json.get('gesture', 'unknown')
-    gaze_data = request.json.get('gaze', None)
+    gesture = params.get('gesture', 'unknown')
+    client_id = request_client_id(params)
+    # 未提供gaze时使用该客户端眼动流的注视检测结果
+    gaze_data = resolve_gaze(params.get('gaze', None), client_id)
+    # 意图推理模式：'two_pass'或'fused'，不传时使用服务端默认配置
+    mode = params.get('mode', None)
     
     # 检查intent_processor是否可用
     if not intent_processor:
         return jsonify({"error": "Phi4意图处理器未初始化"}), 500
     
+    return run_inference_job("intent", intent_job, (image_data, gesture, gaze_data, mode), client_id)
+
+def intent_job(image_data, gesture, gaze_data=None, mode=None):
+    """意图分析任务，在推理线程池中执行，返回(响应体, HTTP状态码)"""
     try:
         # 处理图像数据
-        image = intent_processor.process_base64_image(image_data)
+        image = load_request_image(image_data)
         if not image:
-            return jsonify({"error": "无法处理图像数据"}), 400
+            return {"error": "无法处理图像数据"}, 400
         
         # 进行意图分析
-        result = intent_processor.infer_intent(image, gesture, gaze_data)
+        result = intent_processor.infer_intent(image, gesture, gaze_data, mode=mode)
         
         if "error" in result:
-            return jsonify({"error": result["error"]}), 500
+            return {"error": result["error"]}, 500
         
         # 重新编码裁剪图像（如果有）
         if "cropped_images" in result:
@@ -516,17 +1088,19 @@ def phi_intent_analysis():
                     del cropped["cropped_image"]
         
         # 返回分析结果
-        return jsonify({
+        return {
             "success": True,
             "ui_analysis": result.get("ui_analysis", ""),
             "intent_description": result.get("intent_description", ""),
             "tool_calls": result.get("tool_calls", []),
+            "mode": result.get("mode"),
+            "generation": result.get("generation", {}),
             "response_time": result.get("response_time", {})
-        })
+        }, 200
     
     except Exception as e:
         logger.error(f"意图分析错误: {str(e)}")
-        return jsonify({"error": f"分析意图时出错: {str(e)}"}), 500
+        return {"error": f"分析意图时出错: {str(e)}"}, 500
 
 # 确保模板存在
 create_templates()
@@ -0,0 +1,176 @@
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger("batching")
+
+
+class BatchRequest:
+    """批处理队列中的单个推理请求"""
+
+    __slots__ = ("prompt", "image", "max_new_tokens", "use_tools", "stop_on_tool_call",
+                 "enqueue_time", "done", "response", "error", "timing", "generation_info")
+
+    def __init__(self, prompt, image=None, max_new_tokens=500, use_tools=False, stop_on_tool_call=False):
+        self.prompt = prompt
+        self.image = image
+        self.max_new_tokens = max_new_tokens
+        self.use_tools = use_tools
+        self.stop_on_tool_call = stop_on_tool_call
+        self.generation_info = {}
+        self.enqueue_time = time.time()
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.timing = {}
+
+
+class MicroBatchScheduler:
+    """
+    动态微批处理调度器
+
+    将并发到达的推理请求放入队列，后台线程按最大批大小或最大等待时间
+    把请求组合成一批，调用一次batch_fn完成推理，再把各自的结果分发回调用方。
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10):
+        """
+        初始化调度器
+
+        Args:
+            batch_fn: 批量推理函数，接收BatchRequest列表，返回[(response, response_time), ...]
+            max_batch_size: 每批最多包含的请求数
+            max_wait_ms: 第一个请求入队后最多等待多少毫秒来凑批
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "requests": 0, "max_batch_size_seen": 0}
+
+    def start(self):
+        """启动后台批处理线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._worker_loop, name="phi-batcher", daemon=True)
+        self._thread.start()
+        logger.info(f"批处理调度器已启动: max_batch_size={self.max_batch_size}, "
+                    f"max_wait_ms={self.max_wait * 1000:.0f}")
+
+    def stop(self):
+        """停止后台线程（队列中剩余的请求会先处理完）"""
+        self._stop.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit_request(self, prompt, image=None, max_new_tokens=500, use_tools=False,
+                       timeout=None, stop_on_tool_call=False):
+        """
+        提交请求并等待结果
+
+        Returns:
+            已完成的BatchRequest，包含response、timing和generation_info
+        """
+        if self._thread is None:
+            self.start()
+
+        request = BatchRequest(prompt, image, max_new_tokens, use_tools, stop_on_tool_call)
+        self._queue.put(request)
+
+        if not request.done.wait(timeout):
+            raise TimeoutError(f"批处理请求等待超时 ({timeout}秒)")
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def submit(self, prompt, image=None, max_new_tokens=500, use_tools=False, timeout=None, stop_on_tool_call=False):
+        """提交请求，返回与call_model一致的(response, response_time)"""
+        request = self.submit_request(prompt, image, max_new_tokens, use_tools, timeout, stop_on_tool_call)
+        return request.response, request.timing["total"]
+
+    def stats(self):
+        """返回批处理统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_batch_size"] = stats["requests"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def _collect_batch(self, first):
+        """以第一个请求为起点，在等待窗口内尽量凑满一批"""
+        batch = [first]
+        deadline = first.enqueue_time + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 停止信号，放回队列让主循环退出
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _worker_loop(self):
+        """后台线程：取请求、凑批、推理、分发结果"""
+        while True:
+            first = self._queue.get()
+            if first is None:
+                if self._stop.is_set() and self._queue.empty():
+                    break
+                continue
+
+            batch = self._collect_batch(first)
+            batch_start = time.time()
+
+            try:
+                results = self.batch_fn(batch)
+            except Exception as e:
+                logger.error(f"批量推理失败: {str(e)}")
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            batch_end = time.time()
+            results = list(results)
+            if len(results) != len(batch):
+                logger.error(f"批量推理返回了{len(results)}个结果，与请求数{len(batch)}不一致")
+            # 没有对应结果的请求以错误结束，不能让调用方一直等待
+            error = RuntimeError(f"批量推理只返回了{len(results)}个结果（批大小{len(batch)}）")
+            for request in batch[len(results):]:
+                request.error = error
+                request.done.set()
+
+            with self._lock:
+                self._stats["batches"] += 1
+                self._stats["requests"] += len(batch)
+                self._stats["max_batch_size_seen"] = max(self._stats["max_batch_size_seen"], len(batch))
+
+            for request, (response, inference_time) in zip(batch, results):
+                request.response = response
+                request.timing = {
+                    "queue_wait": batch_start - request.enqueue_time,
+                    "inference": inference_time,
+                    "total": batch_end - request.enqueue_time,
+                    "batch_size": len(batch),
+                }
+                request.done.set()
+
+            if self._stop.is_set() and self._queue.empty():
+                break
@@ -0,0 +1,1318 @@
+"""
+XEO后端性能基准测试
+
+用法:
+    python benchmark.py batching --requests 64 --concurrency 16 --batch-sizes 1,4,8,16
+    python benchmark.py phash --entries 50000 --max-distance 4
+    python benchmark.py intent-modes --iterations 10
+    python benchmark.py upload --width 1920 --height 1080
+    python benchmark.py crops --points 50 --size 64
+    python benchmark.py gaze --rate 250 --seconds 60
+    python benchmark.py tools --calls 500
+    python benchmark.py registry --tools 5000
+    python benchmark.py toolcalls --lengths 10000,50000,200000 --chunk 4
+    python benchmark.py constrained --requests 300 --slip 0.002
+    python benchmark.py importtime --modules app,phi_intent --budget-ms 1500
+    python benchmark.py backends --backends cpu,cpu-int8,cpu-int4 --threads 4
+    python benchmark.py onnx --model-path /home/lab/phi4/phi4 --onnx-model-path /home/lab/phi4/phi4-onnx
+    python benchmark.py embedding --image-tokens 1024
+    python benchmark.py onnx-check --new-tokens 8
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+
+def bench_batching(args):
+    """比较不同微批大小下模拟模式的吞吐量"""
+    from phi_intent import PhiIntentProcessor
+
+    print(f"请求数: {args.requests}, 并发数: {args.concurrency}, 模拟延迟: {args.mock_latency}秒")
+    print(f"{'批大小':>8} {'总耗时(秒)':>12} {'吞吐(请求/秒)':>14} {'平均延迟(秒)':>14}")
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        processor = PhiIntentProcessor(
+            use_local_model=False,
+            max_batch_size=batch_size,
+            max_batch_wait_ms=args.max_wait_ms
+        )
+        processor.mock_latency = args.mock_latency
+
+        latencies = []
+        lock = threading.Lock()
+        counter = iter(range(args.requests))
+
+        def worker():
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                start = time.time()
+                processor.call_model(f"<|user|>请求{i}<|end|>", max_new_tokens=64)
+                with lock:
+                    latencies.append(time.time() - start)
+
+        start = time.time()
+        threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        if processor.batch_scheduler is not None:
+            processor.batch_scheduler.stop()
+
+        print(f"{batch_size:>8} {elapsed:>12.2f} {args.requests / elapsed:>14.2f} "
+              f"{sum(latencies) / len(latencies):>14.3f}")
+
+
+def bench_phash(args):
+    """测量感知哈希索引在大量条目下的近邻查询延迟"""
+    from phash import PerceptualHashIndex
+
+    rng = random.Random(0)
+    index = PerceptualHashIndex(max_distance=args.max_distance, max_entries=args.entries)
+    hashes = [rng.getrandbits(64) for _ in range(args.entries)]
+
+    start = time.perf_counter()
+    for i, h in enumerate(hashes):
+        index.add(h, i)
+    build_time = time.perf_counter() - start
+
+    # 一半查询是已有条目翻转若干位，一半是随机哈希
+    queries = []
+    for _ in range(args.queries // 2):
+        h = rng.choice(hashes)
+        for bit in rng.sample(range(64), rng.randint(0, args.max_distance)):
+            h ^= 1 << bit
+        queries.append(h)
+    queries += [rng.getrandbits(64) for _ in range(args.queries - len(queries))]
+
+    found = 0
+    start = time.perf_counter()
+    for q in queries:
+        if index.nearest(q) is not None:
+            found += 1
+    lookup_time = time.perf_counter() - start
+
+    print(f"条目数: {args.entries}, 最大汉明距离: {args.max_distance}")
+    print(f"建索引耗时: {build_time:.2f}秒")
+    print(f"平均查询耗时: {lookup_time / len(queries) * 1000:.4f}毫秒 ({found}/{len(queries)}命中)")
+
+
+def bench_intent_modes(args):
+    """A/B比较两段式与融合式意图推理的延迟（每次使用不同截图，避免命中UI分析缓存）"""
+    import numpy as np
+    from PIL import Image
+    from phi_intent import PhiIntentProcessor
+
+    processor = PhiIntentProcessor(use_local_model=not args.mock, model_path=args.model_path)
+    processor.mock_latency = args.mock_latency
+    rng = np.random.RandomState(0)
+
+    print(f"{'模式':>10} {'平均总耗时(秒)':>16} {'平均生成token':>14}")
+    for mode in ("two_pass", "fused"):
+        totals = []
+        tokens = []
+        for _ in range(args.iterations):
+            image = Image.fromarray(rng.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+            result = processor.infer_intent(image, args.gesture, mode=mode)
+            totals.append(result["response_time"]["total"])
+            tokens.append(result["generation"].get("generated_tokens", 0))
+        print(f"{mode:>10} {sum(totals) / len(totals):>16.3f} {sum(tokens) / len(tokens):>14.1f}")
+
+
+def bench_upload(args):
+    """比较base64 JSON上传与二进制上传在服务端解码路径上的Python内存分配（近似复制的字节数）"""
+    import io
+    import json
+    import base64
+    import tracemalloc
+    import numpy as np
+    from PIL import Image
+    from phi_intent import PhiIntentProcessor
+
+    processor = PhiIntentProcessor(use_local_model=False)
+    rng = np.random.RandomState(0)
+    # 截图大部分区域平坦，叠加少量噪声使压缩后大小接近真实截图
+    pixels = np.full((args.height, args.width, 3), 200, dtype=np.uint8)
+    noisy = rng.randint(0, 256, (args.height // 4, args.width, 3), dtype=np.uint8)
+    pixels[:noisy.shape[0]] = noisy
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format=args.format)
+    raw = buffer.getvalue()
+    json_body = json.dumps({"image": f"data:image/{args.format.lower()};base64," + base64.b64encode(raw).decode()}).encode()
+
+    def json_path():
+        data = json.loads(json_body)
+        image = processor.process_base64_image(data["image"])
+        image.load()
+
+    def binary_path():
+        # 请求体读出后即为bytes，与request.get_data()一致
+        image = processor.process_image_bytes(raw)
+        image.load()
+
+    print(f"图像: {args.width}x{args.height} {args.format}, 原始大小 {len(raw)} 字节")
+    print(f"{'路径':>8} {'传输字节':>12} {'Python分配峰值(字节)':>22} {'相对原图':>10} {'平均耗时(毫秒)':>16}")
+    for name, fn, wire in (("json", json_path, len(json_body)), ("binary", binary_path, len(raw))):
+        fn()  # 预热
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        elapsed = (time.perf_counter() - start) / args.iterations
+
+        print(f"{name:>8} {wire:>12} {peak:>22} {peak / len(raw):>9.2f}x {elapsed * 1000:>16.2f}")
+
+
+def bench_crops(args):
+    """
+    比较逐点裁剪（原实现：逐个眼动点计算裁剪框再裁剪）与批量裁剪的耗时，并校验结果一致
+
+    分三种输出：PIL图像、(高, 宽, 3)数组、缩放到统一尺寸后堆叠的数组。返回数组视图时截图需要整体转换一次，
+    因此分别列出截图已经是数组和需要从PIL图像转换两种情况。
+    """
+    import numpy as np
+    from PIL import Image
+    from gaze_crop import crop_gaze_regions, crop_gaze_images, gaze_boxes, normalize_gaze_points
+
+    rng = np.random.RandomState(0)
+    pixels = rng.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    points = [{"x": float(x), "y": float(y), "radius": args.radius} for x, y in rng.rand(args.points, 2)]
+    boxes = gaze_boxes(args.width, args.height, *normalize_gaze_points(points)).tolist()
+    size = args.size
+
+    def point_box(point):
+        # 与PhiIntentProcessor.crop_image_at_gaze相同
+        x_pixel, y_pixel = int(point["x"] * args.width), int(point["y"] * args.height)
+        r_pixel = int(point["radius"] * min(args.width, args.height))
+        return (max(0, x_pixel - r_pixel), max(0, y_pixel - r_pixel),
+                min(args.width, x_pixel + r_pixel), min(args.height, y_pixel + r_pixel))
+
+    def timed(fn):
+        fn()
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        return (time.perf_counter() - start) / args.iterations * 1000
+
+    # 批量裁剪与逐点PIL裁剪的结果逐像素相同
+    assert boxes == [list(point_box(point)) for point in points], "裁剪框与逐点计算不一致"
+    crops, _ = crop_gaze_images(image, points)
+    assert all(np.array_equal(np.asarray(crop), np.asarray(image.crop(tuple(b)))) for crop, b in zip(crops, boxes)), \
+        "批量裁剪与PIL裁剪不一致"
+    for source in (image, pixels):
+        views, _ = crop_gaze_regions(source, points)
+        assert all(np.array_equal(view, np.asarray(image.crop(tuple(b)))) for view, b in zip(views, boxes)), \
+            "视图与PIL裁剪不一致"
+        stack, _ = crop_gaze_regions(source, points, size=size)
+        assert np.array_equal(stack, np.stack([
+            np.asarray(image.crop(tuple(b)).resize((size, size), Image.NEAREST)) for b in boxes
+        ])), "缩放堆叠与PIL裁剪+缩放不一致"
+
+    print(f"截图: {args.width}x{args.height}, 注视点: {args.points}, 统一尺寸: {size}")
+    print(f"{'方式':>28} {'平均耗时(毫秒)':>16}")
+    results = [
+        ("逐点裁剪(PIL图像)", lambda: [image.crop(point_box(point)) for point in points]),
+        ("批量裁剪(PIL图像)", lambda: crop_gaze_images(image, points)),
+        ("逐点裁剪(数组)", lambda: [np.asarray(image.crop(point_box(point))) for point in points]),
+        ("批量视图(截图已是数组)", lambda: crop_gaze_regions(pixels, points)),
+        ("批量视图(含PIL截图整体转换)", lambda: crop_gaze_regions(image, points)),
+        ("逐点裁剪+缩放+堆叠", lambda: np.stack([
+            np.asarray(image.crop(point_box(point)).resize((size, size), Image.NEAREST)) for point in points
+        ])),
+        ("批量缩放堆叠(PIL图像)", lambda: crop_gaze_regions(image, points, size=size)),
+        ("批量缩放堆叠(截图已是数组)", lambda: crop_gaze_regions(pixels, points, size=size)),
+    ]
+    for name, fn in results:
+        print(f"{name:>28} {timed(fn):>16.2f}")
+
+
+def bench_gaze(args):
+    """流式注视检测的吞吐量和内存：模拟眼动仪的采样流（注视 + 扫视 + 噪声），按批送入检测器"""
+    import tracemalloc
+    import numpy as np
+    from gaze_fixation import FixationDetector
+
+    rng = np.random.RandomState(0)
+    count = int(args.rate * args.seconds)
+    t = np.arange(count) / args.rate
+    # 每150~600毫秒跳到一个新的注视位置
+    dwell = rng.randint(int(0.15 * args.rate), int(0.6 * args.rate), size=count // int(0.15 * args.rate) + 1)
+    targets = np.repeat(rng.rand(len(dwell), 2), dwell, axis=0)[:count]
+    samples = np.column_stack([t, targets + rng.normal(0, args.noise, (count, 2))])
+
+    def run(detector, on_chunk=None):
+        for i in range(0, count, args.chunk):
+            detector.feed(samples[i:i + args.chunk])
+            if on_chunk is not None:
+                on_chunk(i // args.chunk)
+        return detector
+
+    start = time.perf_counter()
+    detector = run(FixationDetector())
+    elapsed = time.perf_counter() - start
+
+    # 内存单独测一遍（tracemalloc会拖慢计时）
+    peaks = {}
+    tracemalloc.start()
+    run(FixationDetector(), lambda n: n == 10 and peaks.setdefault("warm", tracemalloc.get_traced_memory()[1]))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stats = detector.stats()
+    top = detector.top_fixations(args.top_k)
+    print(f"采样: {count}个（{args.rate}Hz x {args.seconds}秒），每批{args.chunk}个")
+    print(f"吞吐: {count / elapsed:,.0f}采样/秒，单批平均{elapsed / (count / args.chunk) * 1e6:.1f}微秒")
+    print(f"检测到注视: {stats['fixations']}次，注视簇: {stats['clusters']}个，送入裁剪/提示词: {len(top)}个注视点")
+    print(f"内存峰值: 前10批{peaks['warm'] / 1024:.1f}KB，全部{peak / 1024:.1f}KB（与采样数无关）")
+
+
+def bench_tools(args):
+    """比较工具调用的进程内执行、连接池HTTP和逐次新建连接HTTP（原回环调用方式）的延迟"""
+    import os
+    import logging
+    import threading
+    import requests
+    from werkzeug.serving import make_server
+
+    os.environ.setdefault("USE_LOCAL_MODEL", "False")
+    logging.disable(logging.INFO)
+    import app as xeo_app
+    from mcp_executor import create_tool_executor
+
+    server = make_server("127.0.0.1", 0, xeo_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/api"
+
+    def unpooled_call(i):
+        response = requests.put(f"{base_url}/settings/volume", json={"value": i % 100}, timeout=args.timeout)
+        response.raise_for_status()
+
+    local = create_tool_executor("local")
+    remote = create_tool_executor("remote", api_base_url=base_url, timeout=args.timeout)
+    modes = [
+        ("进程内", lambda i: local.execute_tool("adjust_setting", {"setting_id": "volume", "value": i % 100})),
+        ("HTTP连接池", lambda i: remote.execute_tool("adjust_setting", {"setting_id": "volume", "value": i % 100})),
+        ("HTTP逐次连接", unpooled_call),
+    ]
+
+    print(f"调用次数: {args.calls}（adjust_setting）")
+    print(f"{'方式':>12} {'平均(毫秒)':>12} {'p50(毫秒)':>12} {'p99(毫秒)':>12}")
+    try:
+        for name, fn in modes:
+            fn(0)  # 预热
+            latencies = []
+            for i in range(args.calls):
+                start = time.perf_counter()
+                fn(i)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            print(f"{name:>12} {sum(latencies) / len(latencies):>12.3f} "
+                  f"{latencies[len(latencies) // 2]:>12.3f} {latencies[int(len(latencies) * 0.99)]:>12.3f}")
+    finally:
+        server.shutdown()
+        xeo_app.state_store.flush()
+
+
+def bench_registry(args):
+    """比较逐个扫描工具列表+遍历原始schema校验与编译后注册表的单次校验耗时"""
+    from tool_registry import ToolRegistry, ToolParameter
+
+    rng = random.Random(0)
+    schemas = []
+    registry = ToolRegistry()
+    for i in range(args.tools):
+        enum = [f"target-{j}" for j in range(8)]
+        schemas.append({
+            "name": f"tool_{i}",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "target": {"type": "string", "enum": enum},
+                    "value": {"type": "integer", "minimum": 0, "maximum": 100},
+                },
+                "required": ["target", "value"],
+            },
+        })
+        registry.register(f"tool_{i}", "", [
+            ToolParameter("target", "str", enum=enum),
+            ToolParameter("value", "int", minimum=0, maximum=100),
+        ])
+
+    def linear_validate(name, arguments):
+        # 原mcp_tools的做法：线性查找工具，每次遍历schema字典
+        tool = next((t for t in schemas if t["name"] == name), None)
+        if tool is None:
+            return False
+        parameters = tool["parameters"]
+        for param in parameters.get("required", []):
+            if param not in arguments:
+                return False
+        for param, spec in parameters.get("properties", {}).items():
+            if param not in arguments:
+                continue
+            value = arguments[param]
+            if spec.get("type") == "integer" and (not isinstance(value, int) or isinstance(value, bool)):
+                return False
+            if spec.get("type") == "string" and not isinstance(value, str):
+                return False
+            if "enum" in spec and value not in spec["enum"]:
+                return False
+            if spec.get("minimum") is not None and value < spec["minimum"]:
+                return False
+            if spec.get("maximum") is not None and value > spec["maximum"]:
+                return False
+        return True
+
+    calls = [{"name": f"tool_{rng.randrange(args.tools)}",
+              "arguments": {"target": f"target-{rng.randrange(8)}", "value": rng.randrange(120)}}
+             for _ in range(args.calls)]
+
+    print(f"工具数: {args.tools}, 校验次数: {args.calls}")
+    print(f"{'方式':>16} {'单次校验(微秒)':>16}")
+    for name, fn in (("线性查找+原始schema", lambda c: linear_validate(c["name"], c["arguments"])),
+                     ("编译注册表", registry.is_valid_call)):
+        start = time.perf_counter()
+        for call in calls:
+            fn(call)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>16} {elapsed / len(calls) * 1e6:>16.2f}")
+    assert [linear_validate(c["name"], c["arguments"]) for c in calls] == [registry.is_valid_call(c) for c in calls]
+
+
+def bench_toolcalls(args):
+    """
+    工具调用解析：随机生成夹杂残缺JSON和未闭合块的长输出，校验增量解析器的结果，
+    并比较旧版正则（非贪婪DOTALL匹配+裸JSON回退）与增量解析器在不同输出长度下的耗时
+    """
+    import re
+    import json
+    from tool_call_parser import ToolCallParser, extract_tool_calls
+
+    rng = random.Random(0)
+    block_pattern = re.compile(r'<\|tool_call\|>(.*?)<\|/tool_call\|>', re.DOTALL)
+    bare_pattern = re.compile(r'\[\s*\{.*?\}\s*\]|\{\s*"name"\s*:.*?\}', re.DOTALL)
+
+    def regex_parse(text):
+        # 原phi_intent/mcp_executor的做法
+        calls = []
+        for match in block_pattern.findall(text):
+            try:
+                value = json.loads(match)
+            except json.JSONDecodeError:
+                continue
+            calls.extend(value if isinstance(value, list) else [value])
+        if not calls:
+            for match in bare_pattern.findall(text):
+                try:
+                    value = json.loads(match)
+                except json.JSONDecodeError:
+                    continue
+                calls.extend(value if isinstance(value, list) else [value])
+        return calls
+
+    def random_call():
+        return {"name": rng.choice(["connect_device", "adjust_setting"]),
+                "arguments": {"value": rng.randrange(100), "note": rng.choice(["{", "]", '"}', "a\\b", "正常"]),
+                              "nested": [{"k": [1, 2]}]}}
+
+    def generate(length):
+        """返回(模型输出, 其中完整闭合的工具调用)"""
+        parts, expected, size = [], [], 0
+        while size < length:
+            kind = rng.random()
+            if kind < 0.5:
+                piece = "".join(rng.choice("普通文本 abc {}[]<|>\n") for _ in range(rng.randrange(20, 200)))
+            elif kind < 0.75:
+                calls = [random_call() for _ in range(rng.randrange(1, 4))]
+                expected.extend(calls)
+                piece = f"<|tool_call|>{json.dumps(calls, ensure_ascii=False)}<|/tool_call|>"
+            elif kind < 0.9:
+                # 残缺JSON：括号不匹配
+                piece = '<|tool_call|>[{"name": "connect_device", "arguments": {"device_id": "x"]}]<|/tool_call|>'
+            else:
+                # 开括号不闭合的长调用
+                piece = '<|tool_call|>[{"name": "adjust_setting", "arguments": {"value": [' + "1, " * rng.randrange(50) + "<|/tool_call|>"
+            parts.append(piece)
+            size += len(piece)
+        return "".join(parts), expected
+
+    # 正确性：一次性解析与逐片段解析都得到全部闭合的调用
+    for _ in range(args.fuzz):
+        text, expected = generate(rng.randrange(200, 5000))
+        _, calls = extract_tool_calls(text)
+        assert calls == expected, "一次性解析结果不一致"
+        parser = ToolCallParser()
+        streamed = []
+        for i in range(0, len(text), args.chunk):
+            streamed.extend(parser.feed(text[i:i + args.chunk])[1])
+        streamed.extend(parser.flush()[1])
+        assert streamed == expected, "逐片段解析结果不一致"
+    print(f"随机用例{args.fuzz}个：一次性解析与逐{args.chunk}字符解析结果均正确")
+
+    def unclosed(length):
+        # 最坏情况：没有框定的调用，正文中大量未闭合的裸JSON，正则回退时每个起点都扫描到末尾
+        piece = '说明 [{"name": "adjust_setting", "arguments": {"value": 1} 后续文本 '
+        return piece * (length // len(piece) + 1)
+
+    print(f"{'场景':>8} {'输出长度':>10} {'正则(毫秒)':>12} {'增量一次性(毫秒)':>18} {'增量逐片段(毫秒)':>18}")
+    for length in [int(n) for n in args.lengths.split(",")]:
+        for scenario, text in (("混合输出", generate(length)[0]), ("未闭合", unclosed(length))):
+            start = time.perf_counter()
+            regex_parse(text)
+            regex_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            extract_tool_calls(text, bare_json=True)
+            whole_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            parser = ToolCallParser()
+            for i in range(0, len(text), args.chunk):
+                parser.feed(text[i:i + args.chunk])
+            parser.flush()
+            stream_time = time.perf_counter() - start
+
+            print(f"{scenario:>8} {len(text):>10} {regex_time * 1000:>12.1f} "
+                  f"{whole_time * 1000:>18.1f} {stream_time * 1000:>18.1f}")
+
+def bench_constrained(args):
+    """
+    工具调用约束解码：用模拟tokenizer和模拟模型（CPU）比较有无约束时
+    工具调用的解析失败率、校验失败率、每个调用的token数和每步开销
+    """
+    import json
+    import logging
+    import torch
+    from tool_registry import tool_registry, DEVICES, SETTINGS
+    from tool_call_parser import extract_tool_calls
+    from constrained_decoding import ToolCallGrammar, GrammarTokenIndex, ToolCallLogitsProcessor
+
+    # 无约束时的解析失败会大量输出警告
+    logging.getLogger("tool_call_parser").setLevel(logging.ERROR)
+
+    rng = random.Random(0)
+    torch.manual_seed(0)
+    start_marker, end_marker, eos = "<|tool_call|>", "<|/tool_call|>", "<|end|>"
+    prompt_text = "<|user|>turn on the device<|end|>"
+
+    # 模拟词表：可打印ASCII单字符 + 常见JSON片段 + 特殊token + 随机填充token（接近真实词表规模）
+    pieces = [chr(c) for c in range(32, 127)]
+    pieces += ['{"', '":', '":"', '","', '"}', '}}', '}]', '},', ', "', ': "', '"name"', '"arguments"',
+               "name", "arguments", "connect", "_device", "adjust", "_setting", "device", "_id", "setting",
+               "value", "apple", "-tv", "play", "station", "nintendo", "about", "-xeo", "xeo", "volume",
+               "ipd", "magic", "seat", "ventilation", "xbox"]
+    pieces += [str(n) for n in range(0, 201)]
+    pieces += [start_marker, end_marker, eos, "<|user|>"]
+    letters = "abcdefghijklmnopqrstuvwxyz_"
+    pieces += ["".join(rng.choice(letters) for _ in range(rng.randrange(2, 8))) for _ in range(args.extra_tokens)]
+    vocab = list(dict.fromkeys(pieces))
+    token_ids = {piece: i for i, piece in enumerate(vocab)}
+    max_piece = max(len(piece) for piece in vocab)
+    eos_id = token_ids[eos]
+
+    def tokenize(text):
+        # 最长匹配
+        ids, pos = [], 0
+        while pos < len(text):
+            for length in range(min(max_piece, len(text) - pos), 0, -1):
+                token_id = token_ids.get(text[pos:pos + length])
+                if token_id is not None:
+                    ids.append(token_id)
+                    pos += length
+                    break
+            else:
+                raise ValueError(f"模拟词表中没有字符: {text[pos]!r}")
+        return ids
+
+    def target_output():
+        """模拟模型想要输出的文本：多数是合法调用，部分带有常见错误"""
+        calls = []
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            if rng.random() < 0.5:
+                calls.append({"name": "connect_device", "arguments": {"device_id": rng.choice(list(DEVICES))}})
+            else:
+                setting_id = rng.choice(list(SETTINGS))
+                minimum, maximum = SETTINGS[setting_id][:2]
+                calls.append({"name": "adjust_setting",
+                              "arguments": {"setting_id": setting_id, "value": rng.randint(minimum, maximum)}})
+        text = json.dumps(calls, separators=(",", ":"))
+        kind = rng.random()
+        if kind < 0.1:
+            text = text.replace('"', "'")                    # 单引号
+        elif kind < 0.2:
+            text = text[:-2] + "]"                           # 缺少右括号
+        elif kind < 0.3:
+            text = text.replace("apple-tv", "xbox").replace("nintendo", "xbox")  # 不存在的设备
+        elif kind < 0.4:
+            text = text.replace('"value":', '"value":"')[:-3] + '"}}]'  # 数值写成字符串
+        return f"OK. {start_marker}{text}{end_marker}"
+
+    closers = [token_ids[piece] for piece in ('"', "}", "]", '"}', "}}", "}]", end_marker)]
+
+    def generate(target, processor, max_new_tokens=120):
+        """
+        模拟模型的贪心解码：目标文本的前缀token分数最高（越长越高），闭合括号略有偏好，
+        叠加随机噪声，并在工具调用块内以slip的概率输出随机token
+        """
+        prompt = torch.tensor([tokenize(prompt_text)])
+        input_ids = prompt
+        cursor = 0
+        step_time = 0.0
+        for _ in range(max_new_tokens):
+            scores = torch.randn(1, len(vocab)) * args.noise
+            scores[0, closers] += 3
+            rest = target[cursor:]
+            if rest:
+                for length in range(1, min(max_piece, len(rest)) + 1):
+                    token_id = token_ids.get(rest[:length])
+                    if token_id is not None:
+                        scores[0, token_id] += 12 + length
+            else:
+                scores[0, eos_id] += 12
+            if cursor > target.find(start_marker) and rng.random() < args.slip:
+                # 只在工具调用块内出错（块外文本不受约束解码影响）
+                scores[0, rng.randrange(len(vocab))] += 30
+            if processor is not None:
+                start = time.perf_counter()
+                scores = processor(input_ids, scores)
+                step_time += time.perf_counter() - start
+            token_id = int(scores[0].argmax())
+            input_ids = torch.cat([input_ids, torch.tensor([[token_id]])], dim=1)
+            piece = vocab[token_id]
+            # 输出偏离目标时，在目标的后续几个字符中重新对齐
+            found = rest.find(piece, 0, len(piece) + 12)
+            cursor += found + len(piece) if found >= 0 else len(piece)
+            if token_id == eos_id or piece == end_marker:
+                break
+        generated = input_ids[0, prompt.shape[1]:].tolist()
+        return "".join(vocab[i] for i in generated), len(generated), step_time
+
+    start = time.perf_counter()
+    grammar = ToolCallGrammar.from_registry(tool_registry, end_marker=end_marker)
+    grammar_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index = GrammarTokenIndex(grammar, vocab)
+    index_time = time.perf_counter() - start
+    print(f"语法状态: {len(grammar)}, 生成语法 {grammar_time * 1000:.1f}毫秒, "
+          f"词表{len(vocab)}个token建立索引 {index_time * 1000:.1f}毫秒")
+
+    targets = [target_output() for _ in range(args.requests)]
+    print(f"{'方式':>8} {'解析失败率':>10} {'校验失败率':>10} {'每调用token':>12} {'每步约束开销(毫秒)':>18}")
+    for name, constrained in (("无约束", False), ("约束解码", True)):
+        parse_failures = invalid = calls_total = tokens_total = steps = 0
+        overhead = 0.0
+        for target in targets:
+            processor = ToolCallLogitsProcessor(index, len(tokenize(prompt_text)),
+                                                start_marker=start_marker) if constrained else None
+            text, tokens, step_time = generate(target, processor)
+            overhead += step_time
+            steps += tokens
+            _, calls = extract_tool_calls(text)
+            if not calls:
+                parse_failures += 1
+            elif not all(tool_registry.is_valid_call(call) for call in calls):
+                invalid += 1
+            calls_total += len(calls)
+            tokens_total += tokens
+        print(f"{name:>8} {parse_failures / len(targets):>10.1%} {invalid / len(targets):>10.1%} "
+              f"{tokens_total / max(calls_total, 1):>12.1f} {overhead / steps * 1000:>18.3f}")
+
+
+def _measure_import(module):
+    """
+    在子进程中用-X importtime导入模块（模拟模式）
+
+    Returns:
+        (总耗时毫秒, 该模块直接导入的各模块[(模块名, 累计耗时毫秒)], 导入过的全部模块名)
+    """
+    import subprocess
+    import tempfile
+
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=backend_dir, USE_LOCAL_MODEL="False")
+    # 在临时目录中运行，避免导入时创建的templates等目录留在后端目录
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=cwd, env=env, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入{module}失败:\n{result.stderr[-2000:]}")
+
+    total = 0.0
+    children = []
+    imported = set()
+    pending = []  # 上一个顶层模块之后出现的直接子模块（子模块先于父模块输出）
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # 格式: "import time: 自身耗时 | 累计耗时 | 模块名"，模块名按导入层级缩进两格
+        _, cumulative_us, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        cumulative_ms = int(cumulative_us) / 1000
+        imported.add(name)
+        if depth == 0:
+            total += cumulative_ms
+            if name == module:
+                children = pending
+            pending = []
+        elif depth == 1:
+            pending.append((name, cumulative_ms))
+    return total, children, imported
+
+
+def bench_importtime(args):
+    """测量模块的导入耗时，超出预算或导入了禁止的重量级依赖时返回非零"""
+    forbidden = [m for m in args.forbid.split(",") if m]
+    failed = False
+    for module in args.modules.split(","):
+        total, children, imported = _measure_import(module)
+        print(f"\n{module}: 导入耗时 {total:.1f}毫秒（预算 {args.budget_ms:.0f}毫秒）")
+        print(f"{'直接导入的模块':<40} {'累计耗时(毫秒)':>14}")
+        for name, cumulative_ms in sorted(children, key=lambda c: c[1], reverse=True)[:args.top]:
+            print(f"{name:<40} {cumulative_ms:>14.1f}")
+
+        if total > args.budget_ms:
+            print(f"超出预算: {total:.1f}毫秒 > {args.budget_ms:.0f}毫秒")
+            failed = True
+        heavy = [m for m in forbidden if m in imported]
+        if heavy:
+            print(f"导入了禁止的模块: {', '.join(heavy)}")
+            failed = True
+    return 1 if failed else 0
+
+
+def _state_dict_bytes(model):
+    """模型参数和缓冲区的字节数（动态量化层的打包权重为元组）"""
+    import torch
+
+    total = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        total += sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+    return total
+
+
+def _current_rss_mb():
+    """当前进程的常驻内存（Linux），峰值RSS之外反映量化转换完成后的稳定占用"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return float("nan")
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def _run_in_subprocess(target, *args):
+    """
+    在spawn子进程中运行target(*args, queue)，各后端的模型、全局缓存和峰值RSS互不影响
+
+    Returns:
+        (target放入队列的结果, 子进程退出码)；子进程异常退出时结果为None
+    """
+    import queue
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=target, args=(*args, results))
+    process.start()
+    result = None
+    while result is None and (process.is_alive() or not results.empty()):
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            pass
+    process.join()
+    return result, process.exitcode
+
+
+def _run_backend(spec, model_dir, args, queue):
+    """在子进程中用指定后端加载模型并生成，峰值RSS只反映这一个后端"""
+    import resource
+    import torch
+    import transformers  # noqa: F401 先导入，加载耗时不含导入时间
+    from inference_backend import create_backend
+
+    name, _, quantization = spec.partition("-")
+    backend = create_backend(name, threads=args["threads"], quantization=quantization or None)
+    start = time.perf_counter()
+    model = backend.load_model(model_dir)
+    load_seconds = time.perf_counter() - start
+
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, model.config.vocab_size, (1, args["prompt_tokens"]), generator=generator)
+    input_ids = input_ids.to(backend.device)
+    kwargs = dict(max_new_tokens=args["new_tokens"], min_new_tokens=args["new_tokens"], do_sample=False,
+                  pad_token_id=0)
+    with torch.no_grad():
+        model.generate(input_ids, max_new_tokens=2, do_sample=False, pad_token_id=0)  # 预热
+        times = []
+        for _ in range(args["runs"]):
+            start = time.perf_counter()
+            output = model.generate(input_ids, **kwargs)
+            times.append(time.perf_counter() - start)
+
+    queue.put({
+        "backend": backend.describe(),
+        "load_seconds": load_seconds,
+        "tokens_per_second": args["new_tokens"] / min(times),
+        "model_mb": _state_dict_bytes(model) / 1024 / 1024,
+        "rss_mb": _current_rss_mb(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "tokens": output[0, input_ids.shape[1]:].tolist(),
+    })
+
+
+def bench_backends(args):
+    """各推理后端在小型替代模型（随机权重的Llama结构）上的生成速度与峰值内存"""
+    import tempfile
+    import torch
+    import transformers
+
+    config = transformers.LlamaConfig(
+        vocab_size=args.vocab, hidden_size=args.hidden, intermediate_size=args.hidden * 11 // 4,
+        num_hidden_layers=args.layers, num_attention_heads=args.hidden // 64,
+        num_key_value_heads=args.hidden // 64, max_position_embeddings=2048
+    )
+    torch.manual_seed(0)
+    model = transformers.LlamaForCausalLM(config)
+    params = sum(p.numel() for p in model.parameters())
+    run_args = {"threads": args.threads, "prompt_tokens": args.prompt_tokens,
+                "new_tokens": args.new_tokens, "runs": args.runs}
+
+    print(f"替代模型: {args.layers}层, hidden {args.hidden}, 参数{params / 1e6:.1f}M; "
+          f"提示{args.prompt_tokens}个token, 生成{args.new_tokens}个token, CPU线程: {args.threads or torch.get_num_threads()}")
+    print(f"{'后端':<10} {'加载(秒)':>8} {'token/秒':>10} {'权重(MB)':>10} {'RSS(MB)':>10} {'峰值RSS(MB)':>12} {'与cpu一致':>10}")
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model.save_pretrained(model_dir)
+        del model
+        reference = None
+        for spec in args.backends.split(","):
+            if spec.startswith("cuda") and not torch.cuda.is_available():
+                print(f"{spec:<10} 跳过（没有可用的GPU）")
+                continue
+            result, exitcode = _run_in_subprocess(_run_backend, spec, model_dir, run_args)
+            if result is None:
+                print(f"{spec:<10} 失败（子进程退出码{exitcode}）")
+                continue
+
+            tokens = result["tokens"]
+            if spec == "cpu":
+                reference = tokens
+            agreement = "-"
+            if reference is not None:
+                # 与未量化CPU后端的贪心解码结果逐token比较，到第一个不同的token为止
+                same = next((i for i, (a, b) in enumerate(zip(tokens, reference)) if a != b), len(tokens))
+                agreement = f"{same / len(tokens):.0%}"
+            print(f"{spec:<10} {result['load_seconds']:>8.2f} {result['tokens_per_second']:>10.1f} "
+                  f"{result['model_mb']:>10.1f} {result['rss_mb']:>10.1f} {result['peak_rss_mb']:>12.1f} {agreement:>10}")
+
+
+# onnx基准测试的默认提示词（意图推理和工具调用两类）
+DEFAULT_BACKEND_PROMPTS = [
+    ("<|user|>用户注视设置页面的亮度滑块并做出上滑手势，推断用户意图。<|end|><|assistant|>", False),
+    ("<|user|>用户在设备列表页面注视头显条目并点击，推断用户意图。<|end|><|assistant|>", False),
+    ("<|user|>把亮度调到80<|end|><|assistant|>", True),
+    ("<|user|>连接手柄设备<|end|><|assistant|>", True),
+]
+
+
+def _run_intent_backend(spec, args, queue):
+    """在子进程中用指定后端创建PhiIntentProcessor，按同样的提示词调用call_model"""
+    import resource
+    from phi_intent import PhiIntentProcessor
+
+    name, _, quantization = spec.partition("-")
+    processor = PhiIntentProcessor(
+        model_path=args["model_path"],
+        backend=name,
+        quantization=quantization or None,
+        cpu_threads=args["threads"],
+        onnx_model_path=args["onnx_model_path"],
+        # ONNX后端没有前缀KV缓存和截图嵌入缓存，两边都关闭以便公平比较
+        use_prefix_cache=False,
+        use_embedding_cache=False,
+        fallback_to_mock=False
+    )
+    start = time.perf_counter()
+    processor.lifecycle.ensure()
+    load_seconds = time.perf_counter() - start
+
+    responses, latencies, tokens = [], [], 0
+    for prompt, use_tools in args["prompts"]:
+        stats = {}
+        response, latency = processor.call_model(prompt, max_new_tokens=args["new_tokens"], use_tools=use_tools,
+                                                 stop_on_tool_call=False, generation_stats=stats)
+        responses.append(response)
+        latencies.append(latency)
+        tokens += stats["generated_tokens"]
+
+    queue.put({
+        "backend": processor.backend.describe(),
+        "load_seconds": load_seconds,
+        "latencies": latencies,
+        "tokens_per_second": tokens / sum(latencies),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "responses": responses,
+    })
+
+
+def bench_onnx(args):
+    """ONNX Runtime后端与PyTorch后端在相同提示词上的延迟、吞吐和输出一致性（需要真实模型）"""
+    prompts = DEFAULT_BACKEND_PROMPTS
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts = [(line.rstrip("\n"), args.use_tools) for line in f if line.strip()]
+    run_args = {"model_path": args.model_path, "onnx_model_path": args.onnx_model_path, "threads": args.threads,
+                "new_tokens": args.new_tokens, "prompts": prompts}
+
+    print(f"提示词: {len(prompts)}条, 每条最多生成{args.new_tokens}个token, 线程: {args.threads or '默认'}")
+    print(f"{'后端':<10} {'加载(秒)':>8} {'平均延迟(秒)':>12} {'token/秒':>10} {'峰值RSS(MB)':>12} {'输出一致':>8}")
+    reference = None
+    for spec in args.backends.split(","):
+        result, exitcode = _run_in_subprocess(_run_intent_backend, spec, run_args)
+        if result is None:
+            print(f"{spec:<10} 失败（子进程退出码{exitcode}）")
+            continue
+        responses = result["responses"]
+        if reference is None:
+            reference = responses
+        same = sum(a == b for a, b in zip(responses, reference))
+        print(f"{spec:<10} {result['load_seconds']:>8.2f} {sum(result['latencies']) / len(prompts):>12.2f} "
+              f"{result['tokens_per_second']:>10.1f} {result['peak_rss_mb']:>12.1f} {same:>4}/{len(prompts):<3}")
+
+
+def bench_embedding(args):
+    """
+    图像嵌入缓存：用与Phi-4远程代码（modeling_phi4mm）和transformers内置实现forward签名相同的
+    模拟图像嵌入模块，校验同一截图第一次（未命中）和第二次（命中）的输出都与不加缓存时一致，
+    并比较两次的耗时
+    """
+    import types
+    import torch
+    from PIL import Image
+    from embedding_cache import ImageEmbeddingCache
+
+    torch.set_grad_enabled(False)
+    vocab, hidden, image_token_id = 1000, args.hidden, 999
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = torch.nn.ModuleList(torch.nn.Linear(hidden, hidden) for _ in range(args.layers))
+            self.calls = 0
+
+        def forward(self, pixels):
+            self.calls += 1
+            for layer in self.layers:
+                pixels = torch.nn.functional.gelu(layer(pixels))
+            return pixels
+
+    def merge(text_embeds, input_ids, features):
+        positions = torch.nonzero(input_ids == image_token_id, as_tuple=True)
+        return text_embeds.index_put(positions, features.to(text_embeds.dtype))
+
+    class RemoteImageEmbedding(torch.nn.Module):
+        """modeling_phi4mm.Phi4MMImageEmbedding：input_embeds是图像像素，文本嵌入由wte计算"""
+
+        def __init__(self):
+            super().__init__()
+            self.tower = VisionTower()
+            self.drop = torch.nn.Dropout(0.0)
+
+        def forward(self, input_ids, input_embeds, image_sizes=None, **kwargs):
+            return self.drop(merge(kwargs["wte"](input_ids), input_ids, self.tower(input_embeds)))
+
+    class BuiltinImageEmbedding(RemoteImageEmbedding):
+        """transformers的Phi4MultimodalImageEmbedding：inputs_embeds是文本嵌入"""
+
+        def forward(self, input_ids, inputs_embeds, image_pixel_values, image_sizes=None, image_attention_mask=None):
+            return self.drop(merge(inputs_embeds, input_ids, self.tower(image_pixel_values)))
+
+    torch.manual_seed(0)
+    wte = torch.nn.Embedding(vocab, hidden)
+    input_ids = torch.randint(0, image_token_id, (1, args.text_tokens + args.image_tokens))
+    input_ids[0, args.text_tokens // 2:args.text_tokens // 2 + args.image_tokens] = image_token_id
+    pixels = torch.randn(args.image_tokens, hidden)
+    image = Image.new("RGB", (64, 64), (12, 34, 56))
+
+    # 按两种实现中上层模型调用图像嵌入模块的方式调用
+    calls = {
+        "远程代码": (RemoteImageEmbedding, lambda m: m(input_ids=input_ids, input_embeds=pixels,
+                                                      image_sizes=None, wte=wte)),
+        "内置实现": (BuiltinImageEmbedding, lambda m: m(input_ids, wte(input_ids), image_pixel_values=pixels)),
+    }
+
+    print(f"文本token: {args.text_tokens}, 图像token: {args.image_tokens}, 模拟视觉塔: {args.layers}层x{hidden}")
+    print(f"{'实现':<8} {'未命中(毫秒)':>12} {'命中(毫秒)':>10} {'视觉塔调用':>10} {'输出一致':>8}")
+    for name, (module_class, call) in calls.items():
+        module = module_class().eval()
+        reference = call(module)
+        module.tower.calls = 0
+
+        cache = ImageEmbeddingCache(image_token_id=image_token_id)
+        cache.install(types.SimpleNamespace(image_processor=None), torch.nn.ModuleDict({"image_embed": module}))
+        timings = []
+        with cache.activate(image):
+            for _ in range(2):
+                start = time.perf_counter()
+                output = call(module)
+                timings.append(time.perf_counter() - start)
+                assert output.shape == reference.shape and torch.equal(output, reference), f"{name}: 输出与不加缓存时不一致"
+        stats = cache.embeddings.stats()
+        assert (stats["misses"], stats["hits"]) == (1, 1), f"{name}: 缓存统计不符: {stats}"
+        assert module.tower.calls == 1, f"{name}: 命中时仍调用了视觉塔"
+        print(f"{name:<8} {timings[0] * 1000:>12.2f} {timings[1] * 1000:>10.2f} {module.tower.calls:>10} {'是':>8}")
+
+    # 共享同一processor（同一缓存）的两个模型（如不同量化精度）各自计算图像嵌入，互不复用
+    processor, call = types.SimpleNamespace(image_processor=None), calls["远程代码"][1]
+    cache = ImageEmbeddingCache(image_token_id=image_token_id)
+    modules = [RemoteImageEmbedding().eval() for _ in range(2)]
+    references = [call(module) for module in modules]
+    for module in modules:
+        cache.install(processor, torch.nn.ModuleDict({"image_embed": module}))
+    with cache.activate(image):
+        for _ in range(2):
+            for module, reference in zip(modules, references):
+                assert torch.equal(call(module), reference), "共享processor的另一个模型复用了前一个模型的图像嵌入"
+    print(f"共享processor的{len(modules)}个模型: 图像嵌入分别缓存，输出一致")
+
+
+def bench_onnx_check(args):
+    """
+    ONNX后端的解码流程校验（不需要真实模型）：把小型的视觉、嵌入和带KV缓存的解码器三个模块
+    导出为genai_config.json格式的ONNX目录，与同样三个模块经transformers generate（每步完整重算）
+    的贪心输出比较，并检查图像特征只在第一步并入、之后每步只绑定新token的嵌入
+    """
+    import json
+    import shutil
+    import tempfile
+    import torch
+    import transformers
+    from onnx_backend import OnnxCausalLM
+
+    torch.manual_seed(0)
+    vocab, hidden, heads, layers, image_token_id = 96, 32, 2, 2, 95
+    head_dim = hidden // heads
+    pixel_dim = 24
+
+    class Vision(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.proj = torch.nn.Linear(pixel_dim, hidden)
+
+        def forward(self, pixel_values):
+            return torch.tanh(self.proj(pixel_values)).reshape(-1, hidden)
+
+    class Embedding(torch.nn.Module):
+        """文本嵌入，图像占位token依次替换为image_features的各行"""
+
+        def __init__(self):
+            super().__init__()
+            self.wte = torch.nn.Embedding(vocab, hidden)
+
+        def forward(self, input_ids, image_features):
+            is_image = input_ids == image_token_id
+            index = torch.cumsum(is_image.flatten().long(), 0).view_as(input_ids) * is_image
+            table = torch.cat([torch.zeros(1, hidden), image_features], 0)
+            return torch.where(is_image[..., None], table[index], self.wte(input_ids))
+
+    class Decoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.pos = torch.nn.Embedding(128, hidden)
+            self.qkv = torch.nn.ModuleList(torch.nn.Linear(hidden, 3 * hidden) for _ in range(layers))
+            self.out = torch.nn.ModuleList(torch.nn.Linear(hidden, hidden) for _ in range(layers))
+            self.head = torch.nn.Linear(hidden, vocab)
+
+        def forward(self, inputs_embeds, attention_mask, position_ids, *past):
+            batch, length = inputs_embeds.shape[:2]
+            x = inputs_embeds + self.pos(position_ids)
+            presents = []
+            for i in range(layers):
+                q, k, v = (t.view(batch, length, heads, head_dim).transpose(1, 2)
+                           for t in self.qkv[i](x).split(hidden, -1))
+                k, v = torch.cat((past[2 * i], k), 2), torch.cat((past[2 * i + 1], v), 2)
+                presents += [k, v]
+                total = k.shape[2]
+                allowed = torch.ones(length, total, dtype=torch.bool).tril(total - length)[None, None]
+                allowed = allowed & attention_mask[:, None, None, :].bool()
+                scores = (q @ k.transpose(-1, -2) / head_dim ** 0.5).masked_fill(~allowed, -1e9)
+                x = x + self.out[i]((scores.softmax(-1) @ v).transpose(1, 2).reshape(batch, length, hidden))
+            return (self.head(x), *presents)
+
+    vision, embedding, decoder = Vision().eval(), Embedding().eval(), Decoder().eval()
+    empty_past = lambda batch: [torch.zeros(batch, heads, 0, head_dim) for _ in range(2 * layers)]
+
+    class TinyMultimodal(transformers.PreTrainedModel, transformers.GenerationMixin):
+        """同样三个模块组成的transformers模型，不使用KV缓存，每步重新并入图像并完整计算"""
+        config_class = transformers.PretrainedConfig
+
+        def __init__(self, config):
+            super().__init__(config)
+            self.vision, self.embedding, self.decoder = vision, embedding, decoder
+
+        def forward(self, input_ids, attention_mask=None, pixel_values=None, **kwargs):
+            if attention_mask is None:
+                attention_mask = torch.ones_like(input_ids)
+            features = self.vision(pixel_values) if pixel_values is not None else torch.zeros(0, hidden)
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            logits = self.decoder(self.embedding(input_ids, features), attention_mask, position_ids,
+                                  *empty_past(input_ids.shape[0]))[0]
+            return transformers.modeling_outputs.CausalLMOutput(logits=logits)
+
+    reference_model = TinyMultimodal(transformers.PretrainedConfig(vocab_size=vocab)).eval()
+
+    # 导出为genai_config.json格式的目录（与Phi-4的ONNX版本相同的解码器/嵌入/视觉三个文件）
+    model_dir = tempfile.mkdtemp(prefix="onnx_check_")
+    past_names = [f"past_key_values.{i}.{kv}" for i in range(layers) for kv in ("key", "value")]
+    present_names = [name.replace("past_key_values.", "present.") for name in past_names]
+    ids = torch.randint(0, image_token_id, (1, 5))
+    with torch.no_grad():
+        torch.onnx.export(vision, (torch.randn(1, 3, pixel_dim),), os.path.join(model_dir, "vision.onnx"),
+                          input_names=["pixel_values"], output_names=["image_features"],
+                          dynamic_axes={"pixel_values": {0: "batch", 1: "patches"}, "image_features": {0: "tokens"}},
+                          dynamo=False)
+        torch.onnx.export(embedding, (ids, torch.randn(2, hidden)), os.path.join(model_dir, "embedding.onnx"),
+                          input_names=["input_ids", "image_features"], output_names=["inputs_embeds"],
+                          dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "image_features": {0: "tokens"},
+                                        "inputs_embeds": {0: "batch", 1: "sequence"}},
+                          dynamo=False)
+        dynamic_axes = {"inputs_embeds": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "total"},
+                        "position_ids": {0: "batch", 1: "sequence"}, "logits": {0: "batch", 1: "sequence"}}
+        dynamic_axes.update({name: {0: "batch", 2: "past"} for name in past_names})
+        dynamic_axes.update({name: {0: "batch", 2: "total"} for name in present_names})
+        torch.onnx.export(decoder, (torch.randn(1, 5, hidden), torch.ones(1, 5, dtype=torch.long),
+                                    torch.arange(5)[None], *empty_past(1)),
+                          os.path.join(model_dir, "decoder.onnx"),
+                          input_names=["inputs_embeds", "attention_mask", "position_ids", *past_names],
+                          output_names=["logits", *present_names], dynamic_axes=dynamic_axes, dynamo=False)
+    with open(os.path.join(model_dir, "genai_config.json"), "w", encoding="utf-8") as f:
+        json.dump({"model": {part: {"filename": f"{part}.onnx"} for part in ("decoder", "embedding", "vision")}}, f)
+
+    onnx_model = OnnxCausalLM(model_dir, threads=1)
+
+    # 记录各会话每次收到的输入形状
+    calls = {"vision": [], "embedding": [], "decoder": []}
+
+    class RecordingSession:
+        def __init__(self, session, log):
+            self._session, self._log = session, log
+
+        def __getattr__(self, name):
+            return getattr(self._session, name)
+
+        def run(self, output_names, feeds):
+            self._log.append({name: tuple(value.shape) for name, value in feeds.items()})
+            return self._session.run(output_names, feeds)
+
+        def io_binding(self):
+            return RecordingBinding(self._session.io_binding(), self._log)
+
+        def run_with_iobinding(self, binding):
+            self._log.append(binding.bound)
+            return self._session.run_with_iobinding(binding._binding)
+
+    class RecordingBinding:
+        def __init__(self, binding, log):
+            self._binding, self._log, self.bound = binding, log, {}
+
+        def __getattr__(self, name):
+            return getattr(self._binding, name)
+
+        def clear_binding_inputs(self):
+            self.bound = {}
+            self._binding.clear_binding_inputs()
+
+        def bind_cpu_input(self, name, value):
+            self.bound[name] = tuple(value.shape)
+            self._binding.bind_cpu_input(name, value)
+
+        def bind_ortvalue_input(self, name, value):
+            self.bound[name] = ("OrtValue",) + tuple(value.shape())
+            self._binding.bind_ortvalue_input(name, value)
+
+    onnx_model.vision = RecordingSession(onnx_model.vision, calls["vision"])
+    onnx_model.embedding = RecordingSession(onnx_model.embedding, calls["embedding"])
+    onnx_model.decoder = RecordingSession(onnx_model.decoder, calls["decoder"])
+
+    def prompt(text_tokens, image_tokens):
+        return [3, 4] + [image_token_id] * image_tokens + torch.randint(5, image_token_id, (text_tokens,)).tolist()
+
+    # 单条提示词和左填充的批量提示词（各行图像token数相同）
+    prompts = {"单条": [prompt(6, 3)], "左填充批量": [prompt(2, 3), prompt(9, 3)]}
+    generation_config = transformers.GenerationConfig(do_sample=False, eos_token_id=None, pad_token_id=0,
+                                                      max_new_tokens=args.new_tokens, use_cache=False)
+    print(f"新token数: {args.new_tokens}")
+    print(f"{'场景':<10} {'输出一致':>8} {'视觉模型调用':>12} {'嵌入/解码步数':>14}")
+    for name, rows in prompts.items():
+        length = max(len(row) for row in rows)
+        input_ids = torch.tensor([[0] * (length - len(row)) + row for row in rows])
+        attention_mask = torch.tensor([[0] * (length - len(row)) + [1] * len(row) for row in rows])
+        pixel_values = torch.randn(len(rows), 3, pixel_dim)
+        image_rows = int((input_ids == image_token_id).sum())
+
+        with torch.no_grad():
+            expected = reference_model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                                pixel_values=pixel_values, generation_config=generation_config)
+        for log in calls.values():
+            log.clear()
+        output = onnx_model.generate(input_ids, attention_mask, max_new_tokens=args.new_tokens,
+                                     generation_config=generation_config, pixel_values=pixel_values,
+                                     num_logits_to_keep=1)
+        assert torch.equal(output, expected), f"{name}: ONNX输出{output.tolist()}与transformers{expected.tolist()}不一致"
+
+        # 图像只经视觉模型编码一次，特征只在第一步并入
+        assert len(calls["vision"]) == 1, f"{name}: 视觉模型调用了{len(calls['vision'])}次"
+        first, *later = calls["embedding"]
+        assert first == {"input_ids": tuple(input_ids.shape), "image_features": (image_rows, hidden)}, first
+        assert all(step == {"input_ids": (len(rows), 1), "image_features": (0, hidden)} for step in later), later
+        # 第一步绑定整个提示词的嵌入和空的KV缓存，之后只绑定新token的嵌入，KV缓存为上一步的present
+        first, *later = calls["decoder"]
+        assert first["inputs_embeds"] == (len(rows), length, hidden)
+        assert all(first[past][2] == 0 for past in past_names)
+        for step, bound in enumerate(later, 1):
+            assert bound["inputs_embeds"] == (len(rows), 1, hidden), bound
+            assert bound["attention_mask"] == (len(rows), length + step), bound
+            assert all(bound[past][0] == "OrtValue" and bound[past][3] == length + step - 1 for past in past_names)
+        print(f"{name:<10} {'是':>8} {len(calls['vision']):>12} "
+              f"{len(calls['embedding']):>7}/{len(calls['decoder']):<6}")
+    shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="XEO后端性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("batching", help="微批处理吞吐量（模拟模式）")
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--batch-sizes", default="1,4,8,16")
+    p.add_argument("--max-wait-ms", type=float, default=10)
+    p.add_argument("--mock-latency", type=float, default=0.2)
+    p.set_defaults(func=bench_batching)
+
+    p = subparsers.add_parser("phash", help="感知哈希近邻查询延迟")
+    p.add_argument("--entries", type=int, default=50000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--max-distance", type=int, default=4)
+    p.set_defaults(func=bench_phash)
+
+    p = subparsers.add_parser("intent-modes", help="两段式/融合式意图推理延迟对比")
+    p.add_argument("--iterations", type=int, default=10)
+    p.add_argument("--gesture", default="pinch")
+    p.add_argument("--width", type=int, default=800)
+    p.add_argument("--height", type=int, default=600)
+    p.add_argument("--mock", action="store_true", help="使用模拟模式")
+    p.add_argument("--mock-latency", type=float, default=0.2)
+    p.add_argument("--model-path", default="/home/lab/phi4/phi4")
+    p.set_defaults(func=bench_intent_modes)
+
+    p = subparsers.add_parser("upload", help="base64 JSON与二进制图像上传的内存复制对比")
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--format", default="PNG")
+    p.add_argument("--iterations", type=int, default=20)
+    p.set_defaults(func=bench_upload)
+
+    p = subparsers.add_parser("crops", help="逐点裁剪与向量化批量裁剪对比")
+    p.add_argument("--points", type=int, default=50)
+    p.add_argument("--radius", type=float, default=0.1)
+    p.add_argument("--size", type=int, default=64)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--iterations", type=int, default=20)
+    p.set_defaults(func=bench_crops)
+
+    p = subparsers.add_parser("gaze", help="流式注视检测吞吐量和内存")
+    p.add_argument("--rate", type=int, default=250)
+    p.add_argument("--seconds", type=float, default=60)
+    p.add_argument("--chunk", type=int, default=25, help="每次Socket.IO消息携带的采样数")
+    p.add_argument("--noise", type=float, default=0.001)
+    p.add_argument("--top-k", type=int, default=3)
+    p.set_defaults(func=bench_gaze)
+
+    p = subparsers.add_parser("tools", help="工具调用进程内执行与HTTP回环的延迟对比")
+    p.add_argument("--calls", type=int, default=500)
+    p.add_argument("--timeout", type=float, default=5.0)
+    p.set_defaults(func=bench_tools)
+
+    p = subparsers.add_parser("registry", help="工具查找与参数校验耗时（大量工具）")
+    p.add_argument("--tools", type=int, default=5000)
+    p.add_argument("--calls", type=int, default=2000)
+    p.set_defaults(func=bench_registry)
+
+    p = subparsers.add_parser("toolcalls", help="工具调用解析正确性（随机用例）与耗时随输出长度的变化")
+    p.add_argument("--lengths", default="10000,50000,200000", help="逗号分隔的输出长度")
+    p.add_argument("--chunk", type=int, default=4, help="逐片段解析时每片的字符数")
+    p.add_argument("--fuzz", type=int, default=200, help="随机正确性用例数")
+    p.set_defaults(func=bench_toolcalls)
+
+    p = subparsers.add_parser("constrained", help="工具调用约束解码的失败率与开销（模拟tokenizer和模型）")
+    p.add_argument("--requests", type=int, default=300)
+    p.add_argument("--noise", type=float, default=1.0, help="模拟模型logits的噪声标准差")
+    p.add_argument("--slip", type=float, default=0.002, help="模拟模型每步输出随机token的概率")
+    p.add_argument("--extra-tokens", type=int, default=100000, help="词表中的随机填充token数")
+    p.set_defaults(func=bench_constrained)
+
+    p = subparsers.add_parser("importtime", help="模块导入耗时预算检查（模拟模式，超出预算时返回1）")
+    p.add_argument("--modules", default="app,phi_intent,mcp_executor")
+    p.add_argument("--budget-ms", type=float, default=1500)
+    p.add_argument("--forbid", default="torch,transformers,matplotlib", help="不允许在导入时加载的模块，逗号分隔")
+    p.add_argument("--top", type=int, default=10, help="显示耗时最多的直接导入模块数")
+    p.set_defaults(func=bench_importtime)
+
+    p = subparsers.add_parser("backends", help="各推理后端的生成速度与峰值RSS（随机权重的小型替代模型）")
+    p.add_argument("--backends", default="cpu,cpu-int8,cpu-int4,cuda", help="后端，可带量化方式如cpu-int8，逗号分隔")
+    p.add_argument("--threads", type=int, default=None, help="CPU后端的计算线程数")
+    p.add_argument("--hidden", type=int, default=512)
+    p.add_argument("--layers", type=int, default=8)
+    p.add_argument("--vocab", type=int, default=32000)
+    p.add_argument("--prompt-tokens", type=int, default=64)
+    p.add_argument("--new-tokens", type=int, default=64)
+    p.add_argument("--runs", type=int, default=3)
+    p.set_defaults(func=bench_backends)
+
+    p = subparsers.add_parser("onnx", help="ONNX Runtime与PyTorch后端在相同提示词上的对比（真实模型）")
+    p.add_argument("--model-path", required=True, help="transformers模型目录（processor也从这里加载）")
+    p.add_argument("--onnx-model-path", required=True, help="ONNX模型目录")
+    p.add_argument("--backends", default="cpu,onnx", help="参与比较的后端，第一个作为输出一致性的基准")
+    p.add_argument("--threads", type=int, default=None)
+    p.add_argument("--new-tokens", type=int, default=64)
+    p.add_argument("--prompts-file", default=None, help="每行一条提示词，默认使用内置的意图与工具调用提示词")
+    p.add_argument("--use-tools", action="store_true", help="--prompts-file中的提示词是否使用工具模式")
+    p.set_defaults(func=bench_onnx)
+
+    p = subparsers.add_parser("embedding", help="图像嵌入缓存命中与未命中的输出一致性和耗时（模拟图像嵌入模块）")
+    p.add_argument("--text-tokens", type=int, default=128)
+    p.add_argument("--image-tokens", type=int, default=1024)
+    p.add_argument("--hidden", type=int, default=256)
+    p.add_argument("--layers", type=int, default=8, help="模拟视觉塔的层数")
+    p.set_defaults(func=bench_embedding)
+
+    p = subparsers.add_parser("onnx-check", help="ONNX后端解码流程与transformers generate的一致性（导出的小型模型）")
+    p.add_argument("--new-tokens", type=int, default=8)
+    p.set_defaults(func=bench_onnx_check)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+import json
+import logging
+import itertools
+
+from lazy_import import lazy_import
+
+# 模拟模式下不需要真正的logits处理器，torch只在生成时才导入
+torch = lazy_import("torch", optional=True)
+
+logger = logging.getLogger("constrained_decoding")
+
+_MISSING = object()
+
+
+def _parameter_domain(param, int_bounds):
+    """参数所有可能的取值（可选参数含"不填"）"""
+    if param.enum is not None:
+        values = list(param._enum_order)
+    elif param.type == "bool":
+        values = [True, False]
+    elif param.type == "int":
+        minimum = param.minimum if param.minimum is not None else int_bounds[0]
+        maximum = param.maximum if param.maximum is not None else int_bounds[1]
+        values = list(range(minimum, maximum + 1))
+    else:
+        raise ValueError(f"参数{param.name}（{param.type}）没有有限的取值集合，无法生成语法")
+    if not param.required:
+        values.append(_MISSING)
+    return values
+
+
+def enumerate_tool_calls(registry, int_bounds=(-1000, 1000), max_calls=100000):
+    """
+    按注册表列出所有合法的单个工具调用（紧凑JSON文本）
+
+    枚举各参数取值的组合，再用工具定义（含跨参数校验）过滤，
+    因此如adjust_setting的取值范围随setting_id变化也能正确体现。
+
+    Args:
+        registry: ToolRegistry
+        int_bounds: 没有声明范围的整数参数的枚举范围
+        max_calls: 合法调用数上限，超过时抛出ValueError
+    """
+    calls = []
+    for name in registry.names():
+        tool = registry.get(name)
+        domains = [_parameter_domain(p, int_bounds) for p in tool.parameters]
+        for values in itertools.product(*domains):
+            arguments = {p.name: v for p, v in zip(tool.parameters, values) if v is not _MISSING}
+            if not tool.is_valid(arguments):
+                continue
+            calls.append(json.dumps({"name": name, "arguments": arguments}, ensure_ascii=False,
+                                    separators=(",", ":")))
+            if len(calls) > max_calls:
+                raise ValueError(f"合法的工具调用超过{max_calls}种，无法生成语法")
+    return calls
+
+
+class ToolCallGrammar:
+    """
+    工具调用块内容的字符级自动机
+
+    接受的语言为：[调用(,调用)*]结束标记，其中每个调用都是enumerate_tool_calls列出的紧凑JSON。
+    所有合法调用组成一棵字符前缀树，调用结束的节点可以接','回到树根或接']'进入结束标记。
+    每个非接受状态都能到达接受状态，因此按前缀约束生成不会走进死路。
+    """
+
+    def __init__(self, calls, end_marker="<|/tool_call|>"):
+        self._transitions = [{}]  # 状态 -> {字符: 下一个状态}
+        self.start = 0
+        call_root = self._new_state()
+        self._transitions[self.start]["["] = call_root
+
+        marker_start = self._new_state()
+        state = marker_start
+        for char in end_marker:
+            next_state = self._new_state()
+            self._transitions[state][char] = next_state
+            state = next_state
+        self.accept = state
+
+        for call in calls:
+            state = call_root
+            for char in call:
+                next_state = self._transitions[state].get(char)
+                if next_state is None:
+                    next_state = self._new_state()
+                    self._transitions[state][char] = next_state
+                state = next_state
+            self._transitions[state][","] = call_root
+            self._transitions[state]["]"] = marker_start
+
+    @classmethod
+    def from_registry(cls, registry, end_marker="<|/tool_call|>", **kwargs):
+        return cls(enumerate_tool_calls(registry, **kwargs), end_marker)
+
+    def __len__(self):
+        return len(self._transitions)
+
+    def next_chars(self, state):
+        """状态上允许的下一个字符"""
+        return self._transitions[state].keys()
+
+    def advance(self, state, text):
+        """
+        读入一段文本
+
+        Returns:
+            读完后的状态；文本不符合语法（或在接受状态之后还有字符）时返回None
+        """
+        transitions = self._transitions
+        for char in text:
+            if state == self.accept:
+                return None
+            state = transitions[state].get(char)
+            if state is None:
+                return None
+        return state
+
+    def _new_state(self):
+        self._transitions.append({})
+        return len(self._transitions) - 1
+
+
+class GrammarTokenIndex:
+    """
+    语法状态 -> 允许的token
+
+    词表按token文本的首字符分组，某状态下只需检查以允许字符开头的token；
+    每个状态的结果在第一次用到时计算并缓存，供所有请求共享。
+    """
+
+    def __init__(self, grammar, token_strings):
+        """
+        Args:
+            grammar: ToolCallGrammar
+            token_strings: token id -> 解码后的文本
+        """
+        self.grammar = grammar
+        self.token_strings = token_strings
+        self._by_first_char = {}
+        for token_id, text in enumerate(token_strings):
+            if text:
+                self._by_first_char.setdefault(text[0], []).append(token_id)
+        self._allowed = {}
+        self._tensors = {}
+
+    @classmethod
+    def from_tokenizer(cls, grammar, tokenizer):
+        """逐个解码词表中的token（包括特殊token，如结束标记）"""
+        token_strings = tokenizer.batch_decode(
+            [[token_id] for token_id in range(len(tokenizer))],
+            skip_special_tokens=False,
+            clean_up_tokenization_spaces=False
+        )
+        return cls(grammar, token_strings)
+
+    def allowed(self, state):
+        """状态上允许的token id列表"""
+        allowed = self._allowed.get(state)
+        if allowed is None:
+            allowed = []
+            for char in self.grammar.next_chars(state):
+                for token_id in self._by_first_char.get(char, ()):
+                    if self.grammar.advance(state, self.token_strings[token_id]) is not None:
+                        allowed.append(token_id)
+            self._allowed[state] = allowed
+        return allowed
+
+    def allowed_tensor(self, state, device):
+        key = (state, device)
+        tensor = self._tensors.get(key)
+        if tensor is None:
+            tensor = torch.tensor(self.allowed(state), dtype=torch.long, device=device)
+            self._tensors[key] = tensor
+        return tensor
+
+    def advance_token(self, state, token_id):
+        if token_id >= len(self.token_strings):
+            return None
+        return self.grammar.advance(state, self.token_strings[token_id])
+
+    def token_string(self, token_id):
+        return self.token_strings[token_id] if token_id < len(self.token_strings) else ""
+
+
+class ToolCallLogitsProcessor:
+    """
+    工具调用块内的约束解码
+
+    实现transformers的LogitsProcessor接口（同ToolCallStoppingCriteria，不继承以免导入时加载transformers）。
+
+    工具调用起始标记之前的文本不受约束；生成起始标记后，每一步只保留能使块内容
+    继续符合语法的token，直到生成结束标记。按行分别跟踪状态，支持批量生成。
+    """
+
+    def __init__(self, index, prompt_length, start_marker="<|tool_call|>", enabled_rows=None):
+        """
+        Args:
+            index: GrammarTokenIndex
+            prompt_length: 输入（含填充）的token长度，之后的token为生成内容
+            enabled_rows: 每行是否启用约束，None表示全部启用
+        """
+        self.index = index
+        self.prompt_length = prompt_length
+        self.start_marker = start_marker
+        self.enabled_rows = enabled_rows
+        self._rows = {}  # 行号 -> (已处理的token数, 块外文本的末尾, 语法状态或None)
+        self.stats = {"constrained_steps": 0, "blocks": 0, "unconstrained_fallbacks": 0}
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            if self.enabled_rows is not None and not self.enabled_rows[row]:
+                continue
+            state = self._update_row(row, input_ids[row])
+            if state is None:
+                continue
+
+            allowed = self.index.allowed_tensor(state, scores.device)
+            if allowed.numel() == 0:
+                # 词表无法表示语法要求的下一个字符，放弃约束以免所有token都被屏蔽
+                self.stats["unconstrained_fallbacks"] += 1
+                logger.warning(f"语法状态{state}没有可用的token，本步不做约束")
+                continue
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] = scores[row] + mask
+            self.stats["constrained_steps"] += 1
+        return scores
+
+    def _update_row(self, row, ids):
+        """读入该行新生成的token，返回当前的语法状态（不在工具调用块内时返回None）"""
+        seen, tail, state = self._rows.get(row, (0, "", None))
+        grammar = self.index.grammar
+        new_tokens = ids[self.prompt_length + seen:].tolist()
+        for token_id in new_tokens:
+            if state is not None:
+                state = self.index.advance_token(state, token_id)
+                if state is None or state == grammar.accept:
+                    # 块结束（或因放弃约束而偏离语法），回到不受约束的文本
+                    state = None
+                    tail = ""
+                continue
+            text = tail + self.index.token_string(token_id)
+            found = text.find(self.start_marker)
+            if found < 0:
+                tail = text[-(len(self.start_marker) - 1):]
+                continue
+            # 起始标记之后同一token中的剩余文本也要符合语法
+            self.stats["blocks"] += 1
+            state = grammar.advance(grammar.start, text[found + len(self.start_marker):])
+            tail = ""
+        self._rows[row] = (seen + len(new_tokens), tail, state)
+        return state
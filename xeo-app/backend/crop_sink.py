@@ -0,0 +1,193 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("crop_sink")
+
+# 格式 -> (文件扩展名, PIL格式名)
+FORMATS = {
+    "png": ("png", "PNG"),
+    "jpeg": ("jpg", "JPEG"),
+    "webp": ("webp", "WEBP"),
+}
+
+
+class CropSink:
+    """
+    眼动裁剪图像的异步持久化
+
+    请求线程只把裁剪图像放入有界队列，编码和写盘由后台线程完成；
+    队列满时直接丢弃，不阻塞推理。支持按比例采样、按文件数和存活时间轮转。
+    """
+
+    def __init__(self, directory, max_queue=64, sample_rate=1.0, max_files=1000, max_age=None,
+                 image_format="png", compress_level=1, quality=85):
+        """
+        Args:
+            directory: 保存目录
+            max_queue: 等待写盘的图像数上限
+            sample_rate: 保存比例（0~1）
+            max_files: 目录中最多保留的文件数，None表示不限
+            max_age: 文件最长保留秒数，None表示不限
+            image_format: 'png'、'jpeg'或'webp'
+            compress_level: PNG压缩级别（0~9，越大越慢）
+            quality: JPEG/WebP质量（1~100）
+        """
+        if image_format not in FORMATS:
+            raise ValueError(f"不支持的图像格式: {image_format}")
+
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.max_age = max_age
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.quality = quality
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._files = deque()  # (写入时间, 路径)，按时间排序
+        self._stats = {"submitted": 0, "sampled_out": 0, "dropped": 0, "written": 0,
+                       "write_errors": 0, "deleted": 0, "bytes_written": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_existing()
+
+    def start(self):
+        """启动后台写盘线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._writer_loop, name="crop-sink", daemon=True)
+        self._thread.start()
+        logger.info(f"裁剪图像异步保存已启用: {self.directory} ({self.image_format}, 采样率{self.sample_rate})")
+
+    def stop(self):
+        """写完队列中剩余的图像后停止"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, image, x=0, y=0):
+        """
+        提交一张裁剪图像，立即返回
+
+        Returns:
+            是否进入写盘队列（未被采样或队列已满时为False）
+        """
+        if self._thread is None:
+            self.start()
+
+        with self._lock:
+            self._stats["submitted"] += 1
+            if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+                self._stats["sampled_out"] += 1
+                return False
+            self._seq += 1
+            seq = self._seq
+
+        try:
+            self._queue.put_nowait((image, x, y, seq, time.time()))
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+            return False
+        return True
+
+    def stats(self):
+        """返回写盘统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["files"] = len(self._files)
+        stats.update({
+            "queue_depth": self._queue.qsize(),
+            "directory": self.directory,
+            "format": self.image_format,
+            "sample_rate": self.sample_rate,
+        })
+        return stats
+
+    def _load_existing(self):
+        """把目录中已有的裁剪图像纳入轮转"""
+        existing = []
+        for name in os.listdir(self.directory):
+            if name.startswith("gaze_crop_"):
+                path = os.path.join(self.directory, name)
+                try:
+                    existing.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        self._files.extend(sorted(existing))
+
+    def _filename(self, x, y, seq, created):
+        """文件名带毫秒时间戳和序号，同一秒内的多张裁剪不会互相覆盖"""
+        timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(created))
+        millis = int(created * 1000) % 1000
+        extension = FORMATS[self.image_format][0]
+        return f"gaze_crop_{timestamp}_{millis:03d}_{seq:06d}_{x}_{y}.{extension}"
+
+    def _save_kwargs(self):
+        if self.image_format == "png":
+            return {"compress_level": self.compress_level}
+        return {"quality": self.quality}
+
+    def _writer_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            image, x, y, seq, created = item
+            path = os.path.join(self.directory, self._filename(x, y, seq, created))
+            if self.image_format == "jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            try:
+                image.save(path, format=FORMATS[self.image_format][1], **self._save_kwargs())
+                size = os.path.getsize(path)
+            except Exception as e:
+                logger.error(f"保存裁剪图像失败: {str(e)}")
+                with self._lock:
+                    self._stats["write_errors"] += 1
+                continue
+
+            with self._lock:
+                self._files.append((time.time(), path))
+                self._stats["written"] += 1
+                self._stats["bytes_written"] += size
+            self._rotate()
+
+    def _rotate(self):
+        """删除超出文件数上限或超过存活时间的旧文件"""
+        now = time.time()
+        victims = []
+        with self._lock:
+            while self._files and (
+                (self.max_files is not None and len(self._files) > self.max_files)
+                or (self.max_age is not None and now - self._files[0][0] > self.max_age)
+            ):
+                victims.append(self._files.popleft()[1])
+
+        for path in victims:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            with self._lock:
+                self._stats["deleted"] += 1
+
+
+def create_crop_sink(directory=None, **kwargs):
+    """提供保存目录时创建并启动CropSink，否则返回None（裁剪图像只保留在内存中）"""
+    if not directory:
+        return None
+    sink = CropSink(directory, **kwargs)
+    sink.start()
+    return sink
@@ -0,0 +1,269 @@
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ui_cache import _CacheStats, image_digest
+
+from lazy_import import lazy_import
+
+# 只在安装缓存（加载了本地模型）后才会用到
+torch = lazy_import("torch", optional=True)
+
+logger = logging.getLogger("embedding_cache")
+
+# Phi-4多模态模型中图像占位token的ID
+DEFAULT_IMAGE_TOKEN_ID = 200010
+
+
+def _tensor_bytes(value):
+    """估算张量（或包含张量的字典）占用的字节数"""
+    if torch is not None and isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if hasattr(value, "items"):
+        return sum(_tensor_bytes(v) for _, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+class _TensorLRU(_CacheStats):
+    """按字节预算淘汰的张量LRU缓存"""
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count("misses")
+                return None
+            self._entries.move_to_end(key)
+            self._count("hits")
+            return entry[0]
+
+    def put(self, key, value):
+        size = _tensor_bytes(value)
+        if size > self.max_bytes:
+            logger.warning(f"缓存值过大({size}字节)，超出字节预算，不缓存")
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._count("evictions")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        })
+        return stats
+
+
+class _CachingImageProcessor:
+    """
+    包装processor.image_processor，按图像摘要复用预处理后的像素张量
+
+    除__call__外的属性都转发给原始的图像处理器。
+    """
+
+    def __init__(self, image_processor, cache):
+        self._image_processor = image_processor
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._image_processor, name)
+
+    def __call__(self, images, **kwargs):
+        image_list = images if isinstance(images, (list, tuple)) else [images]
+        key = (tuple(image_digest(image) for image in image_list), repr(sorted(kwargs.items())))
+
+        features = self._cache.pixels.get(key)
+        if features is None:
+            features = self._image_processor(images, **kwargs)
+            self._cache.pixels.put(key, features)
+        # 返回浅拷贝，调用方替换其中的张量（如.to(device)）不会影响缓存
+        return features.__class__(dict(features.items()))
+
+
+class ImageEmbeddingCache:
+    """
+    截图的预处理结果与视觉编码结果缓存
+
+    同一张截图在UI分析和意图推断中会被送入模型多次。这里在两处按图像摘要做缓存：
+    - 预处理：包装processor.image_processor，复用缩放、切块、归一化后的像素张量（CPU内存）
+    - 视觉编码：包装模型的图像嵌入模块，复用经过视觉塔和投影层后的图像嵌入（模型所在设备）
+    两部分分别有字节预算，按LRU淘汰。
+
+    视觉编码缓存只在activate()上下文内生效，由调用方声明本次generate对应的图像；
+    没有声明时图像嵌入模块按原样计算。processor按模型路径共享，同一缓存可能装在多个模型
+    （不同后端或量化精度）上，图像嵌入按模型分开缓存。
+    """
+
+    def __init__(self, max_pixel_bytes=256 * 1024 * 1024, max_embedding_bytes=256 * 1024 * 1024,
+                 image_token_id=None):
+        """
+        Args:
+            max_pixel_bytes: 像素张量缓存的字节预算
+            max_embedding_bytes: 图像嵌入缓存的字节预算
+            image_token_id: 图像占位token的ID，None时从模型配置读取
+        """
+        self.pixels = _TensorLRU(max_pixel_bytes)
+        self.embeddings = _TensorLRU(max_embedding_bytes)
+        self.image_token_id = image_token_id
+        self._local = threading.local()
+        self._model_ids = itertools.count()
+
+    def install(self, processor, model=None):
+        """在processor（及model）上安装缓存包装，重复调用不会重复包装"""
+        if not isinstance(processor.image_processor, _CachingImageProcessor):
+            processor.image_processor = _CachingImageProcessor(processor.image_processor, self)
+
+        if model is None:
+            return
+        module = self._find_image_embedding(model)
+        if module is None:
+            logger.warning("未找到模型的图像嵌入模块，只缓存预处理结果")
+            return
+        if getattr(module, "_embedding_cache_installed", False):
+            return
+
+        if self.image_token_id is None:
+            vision_config = getattr(getattr(model, "config", None), "vision_config", None)
+            self.image_token_id = getattr(vision_config, "image_token_id", DEFAULT_IMAGE_TOKEN_ID)
+
+        original_forward = module.forward
+        model_id = next(self._model_ids)
+
+        def cached_forward(*args, **kwargs):
+            return self._embed(module, original_forward, model_id, *args, **kwargs)
+
+        module.forward = cached_forward
+        module._embedding_cache_installed = True
+        logger.info(f"已在{module.__class__.__name__}上启用图像嵌入缓存")
+
+    @contextmanager
+    def activate(self, images):
+        """
+        声明当前线程接下来的generate使用哪些图像
+
+        Args:
+            images: PIL图像、图像列表或None
+        """
+        if images is None:
+            yield
+            return
+        image_list = images if isinstance(images, (list, tuple)) else [images]
+        previous = getattr(self._local, "key", None)
+        self._local.key = tuple(image_digest(image) for image in image_list)
+        try:
+            yield
+        finally:
+            self._local.key = previous
+
+    def clear(self):
+        """清空两部分缓存"""
+        self.pixels.clear()
+        self.embeddings.clear()
+
+    def stats(self):
+        """返回两部分缓存的统计"""
+        return {"pixels": self.pixels.stats(), "embeddings": self.embeddings.stats()}
+
+    @staticmethod
+    def _find_image_embedding(model):
+        for _, module in model.named_modules():
+            if module.__class__.__name__.endswith("ImageEmbedding"):
+                return module
+        return None
+
+    @staticmethod
+    def _text_embeds(args, kwargs, input_ids):
+        """
+        图像嵌入模块输入对应的文本嵌入，无法确定时返回None
+
+        两种实现的forward签名不同：
+        - 模型目录中的远程代码（modeling_phi4mm.Phi4MMImageEmbedding.forward(input_ids, input_embeds,
+          image_sizes, wte=...)）：input_embeds是图像像素，文本嵌入由wte(input_ids)计算
+        - transformers内置实现（Phi4MultimodalImageEmbedding.forward(input_ids, inputs_embeds,
+          image_pixel_values, ...)）：inputs_embeds就是文本嵌入
+        """
+        if "wte" in kwargs:
+            return kwargs["wte"](input_ids)
+        if "inputs_embeds" in kwargs:
+            return kwargs["inputs_embeds"]
+        if len(args) > 1 and "image_pixel_values" in kwargs:
+            return args[1]
+        return None
+
+    def _embed(self, module, original_forward, model_id, *args, **kwargs):
+        """
+        图像嵌入模块的缓存版forward
+
+        模块输出是把文本嵌入中图像占位token位置替换为投影后图像嵌入的hidden states，
+        因此缓存这些位置上的值；命中时在文本嵌入的同样位置写回，跳过视觉塔和投影层。
+        缓存键包含model_id（安装时为每个模型分配），不同模型的图像嵌入互不复用。
+        """
+        images = getattr(self._local, "key", None)
+        input_ids = kwargs["input_ids"] if "input_ids" in kwargs else args[0]
+        if images is None or input_ids is None:
+            return original_forward(*args, **kwargs)
+        key = (model_id, images)
+
+        with torch.no_grad():
+            positions = input_ids == self.image_token_id
+            num_positions = int(positions.sum())
+        if num_positions == 0:
+            return original_forward(*args, **kwargs)
+
+        cached = self.embeddings.get(key)
+        if cached is not None and cached.shape[0] == num_positions:
+            text_embeds = self._text_embeds(args, kwargs, input_ids)
+            if text_embeds is not None:
+                hidden_states = text_embeds.index_put(
+                    torch.nonzero(positions, as_tuple=True),
+                    cached.to(dtype=text_embeds.dtype, device=text_embeds.device)
+                )
+                drop = getattr(module, "drop", None)
+                return drop(hidden_states) if drop is not None else hidden_states
+
+        output = original_forward(*args, **kwargs)
+        self.embeddings.put(key, output[positions].detach())
+        return output
+
+
+def get_embedding_cache(processor, model=None, **kwargs):
+    """
+    获取processor上已安装的图像嵌入缓存，没有则创建并安装
+
+    全局共享的模型实例只安装一次，多个调用方共用同一份缓存。
+    """
+    cache = getattr(processor, "_image_embedding_cache", None)
+    if cache is None:
+        cache = ImageEmbeddingCache(**kwargs)
+        processor._image_embedding_cache = cache
+    cache.install(processor, model)
+    return cache
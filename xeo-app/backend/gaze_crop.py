@@ -0,0 +1,158 @@
+import numpy as np
+from PIL import Image
+
+DEFAULT_RADIUS = 0.1
+
+
+def normalize_gaze_points(gaze_data, default_radius=DEFAULT_RADIUS):
+    """
+    把各种格式的眼动数据整理成坐标数组
+
+    支持单个点或点列表，每个点为{'x', 'y', 'radius'}或{'coordinates': {'x', 'y'}, 'radius'}。
+
+    Returns:
+        (xs, ys, radii)三个float数组，坐标和半径均为0~1的相对值
+    """
+    if isinstance(gaze_data, dict):
+        gaze_data = [gaze_data]
+
+    xs, ys, radii = [], [], []
+    for point in gaze_data or []:
+        coordinates = point.get("coordinates", point)
+        xs.append(coordinates["x"])
+        ys.append(coordinates["y"])
+        radii.append(point.get("radius", default_radius))
+    return np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64), np.asarray(radii, dtype=np.float64)
+
+
+def gaze_boxes(width, height, xs, ys, radii):
+    """
+    一次计算所有眼动点的裁剪框
+
+    与逐点裁剪相同：中心为(x*宽, y*高)，半径为radius*min(宽, 高)，超出图像的部分截掉。
+    每个框至少保留1个像素。
+
+    Returns:
+        (N, 4)的int数组，每行为(left, top, right, bottom)
+    """
+    x_pixel = (xs * width).astype(np.int64)
+    y_pixel = (ys * height).astype(np.int64)
+    r_pixel = (radii * min(width, height)).astype(np.int64)
+
+    left = np.clip(x_pixel - r_pixel, 0, width - 1)
+    top = np.clip(y_pixel - r_pixel, 0, height - 1)
+    right = np.clip(x_pixel + r_pixel, left + 1, width)
+    bottom = np.clip(y_pixel + r_pixel, top + 1, height)
+    return np.stack([left, top, right, bottom], axis=1)
+
+
+def crop_views(pixels, boxes):
+    """按裁剪框返回(高, 宽, 3)的uint8切片视图列表（不复制像素）"""
+    return [pixels[top:bottom, left:right, :3] for left, top, right, bottom in np.asarray(boxes).tolist()]
+
+
+def crop_stack(image, boxes, size):
+    """
+    把所有裁剪区域缩放到相同尺寸并堆叠成一个数组
+
+    采用最近邻采样，采样点为输出像素中心映射回裁剪框内的位置。PIL图像用resize(box=...)
+    直接从原图的裁剪框内采样，只读取用到的像素，不转换整张截图；数组输入先为每个框计算
+    采样的行、列下标，再用一次索引完成所有裁剪和缩放。两种输入的结果相同。
+
+    Args:
+        image: PIL图像或(高, 宽, 通道)的uint8数组
+        boxes: gaze_boxes返回的裁剪框
+        size: 输出边长，int或(宽, 高)
+
+    Returns:
+        (N, 高, 宽, 3)的uint8数组
+    """
+    out_w, out_h = (size, size) if isinstance(size, int) else size
+    boxes = np.asarray(boxes)
+
+    if not isinstance(image, np.ndarray):
+        stack = np.empty((len(boxes), out_h, out_w, 3), dtype=np.uint8)
+        for i, box in enumerate(boxes.tolist()):
+            crop = image.resize((out_w, out_h), Image.NEAREST, box=tuple(box))
+            if crop.mode != "RGB":
+                crop = crop.convert("RGB")
+            stack[i] = np.frombuffer(crop.tobytes(), dtype=np.uint8).reshape(out_h, out_w, 3)
+        return stack
+
+    left, top, right, bottom = boxes[:, 0:1], boxes[:, 1:2], boxes[:, 2:3], boxes[:, 3:4]
+    # (N, out_h)和(N, out_w)的采样下标
+    rows = np.minimum(_nearest_index(top, bottom, out_h), bottom - 1)
+    cols = np.minimum(_nearest_index(left, right, out_w), right - 1)
+    if not image.flags.c_contiguous:
+        return image[rows[:, :, None], cols[:, None, :], :3]
+    # 连续存储的数组按像素的线性下标用np.take取整行通道，比多维高级索引快得多
+    height, width, channels = image.shape
+    index = rows[:, :, None] * width + cols[:, None, :]
+    stack = np.take(image.reshape(height * width, channels), index.ravel(), axis=0)
+    stack = stack.reshape(len(boxes), out_h, out_w, channels)
+    return stack if channels == 3 else np.ascontiguousarray(stack[..., :3])
+
+
+def _nearest_index(start, end, count):
+    """
+    最近邻缩放时每个输出像素对应的源下标
+
+    与PIL的ImagingScaleAffine相同：第一个采样点为start + step/2，之后逐个累加step，
+    浮点运算的顺序一致，因此与resize(box=...)的结果逐像素相同。
+    """
+    step = (end - start) / count
+    increments = np.repeat(step, count, axis=1)
+    increments[:, 0] = start[:, 0] + step[:, 0] * 0.5
+    return np.add.accumulate(increments, axis=1).astype(np.int64)
+
+
+def crop_gaze_regions(image, gaze_data, size=None, default_radius=DEFAULT_RADIUS):
+    """
+    批量裁剪所有眼动关注区域
+
+    返回视图时截图只转换为数组一次（数组输入不转换），各区域是该数组的切片。转换的开销与眼动点数无关，
+    点多时比逐点裁剪后各自转换快，点少时反而更慢；只需要PIL裁剪图时用crop_gaze_images，不必转换整张截图。
+    返回堆叠数组时只采样各框内用到的像素。
+
+    Args:
+        image: PIL图像或(高, 宽, 通道)的uint8数组
+        gaze_data: 单个眼动点或眼动点列表（格式见normalize_gaze_points）
+        size: None时返回各区域(高, 宽, 3)的数组视图；否则返回缩放到该尺寸后堆叠的(N, 高, 宽, 3)数组
+        default_radius: 眼动点未给出半径时使用的默认值
+
+    Returns:
+        (crops, boxes)：crops为视图列表或堆叠数组，boxes为(N, 4)裁剪框
+    """
+    if isinstance(image, np.ndarray):
+        height, width = image.shape[:2]
+    else:
+        width, height = image.size
+    xs, ys, radii = normalize_gaze_points(gaze_data, default_radius)
+    boxes = gaze_boxes(width, height, xs, ys, radii)
+    if size is not None:
+        return crop_stack(image, boxes, size), boxes
+    if not isinstance(image, np.ndarray):
+        image = np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+    return crop_views(image, boxes), boxes
+
+
+def crop_gaze_images(image, gaze_data, default_radius=DEFAULT_RADIUS):
+    """
+    批量裁剪所有眼动关注区域，返回PIL图像（供保存或送入模型）
+
+    裁剪框向量化计算，PIL图像输入用crop直接复制各框内的像素，不经过数组转换。
+
+    Returns:
+        (images, boxes)：images为PIL图像列表，boxes为(N, 4)裁剪框
+    """
+    if isinstance(image, np.ndarray):
+        crops, boxes = crop_gaze_regions(image, gaze_data, default_radius=default_radius)
+        return to_pil_images(crops), boxes
+    xs, ys, radii = normalize_gaze_points(gaze_data, default_radius)
+    boxes = gaze_boxes(image.size[0], image.size[1], xs, ys, radii)
+    return [image.crop(tuple(box)) for box in boxes.tolist()], boxes
+
+
+def to_pil_images(crops):
+    """把裁剪得到的数组（视图列表或堆叠数组）转换为PIL图像列表"""
+    return [Image.fromarray(np.ascontiguousarray(crop)) for crop in crops]
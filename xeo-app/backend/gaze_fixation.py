@@ -0,0 +1,250 @@
+import math
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger("gaze_fixation")
+
+# 注视簇环形缓冲区的列
+_X, _Y, _WEIGHT, _DURATION, _COUNT, _LAST = range(6)
+
+
+def _as_sample_array(samples):
+    """把[[t, x, y], ...]或[{'t', 'x', 'y'}, ...]整理成(n, 3)的float数组"""
+    if len(samples) and isinstance(samples[0], dict):
+        samples = [(s["t"], s["x"], s["y"]) for s in samples]
+    array = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+    return array[np.isfinite(array).all(axis=1)]
+
+
+class FixationDetector:
+    """
+    流式I-VT注视检测
+
+    逐批接收原始眼动采样(t, x, y)（t为秒，x/y为0~1的屏幕相对坐标），
+    速度低于阈值的连续采样归为一次注视。注视结束后并入相近的注视簇，
+    簇保存在固定容量的NumPy环形缓冲区中，另有一张随时间衰减的低分辨率显著性热图。
+    每个会话占用的内存与采样数量无关。
+    """
+
+    def __init__(self, velocity_threshold=1.0, min_duration=0.1, merge_radius=0.05,
+                 max_clusters=32, heatmap_shape=(18, 32), decay_seconds=5.0):
+        """
+        Args:
+            velocity_threshold: 注视/扫视的速度阈值（屏幕宽高单位/秒）
+            min_duration: 最短注视时长（秒），更短的视为噪声
+            merge_radius: 注视中心距离小于该值时并入同一簇
+            max_clusters: 环形缓冲区中最多保留的注视簇数
+            heatmap_shape: 显著性热图的(行, 列)
+            decay_seconds: 簇权重和热图的衰减时间常数（秒）
+        """
+        self.velocity_threshold = velocity_threshold
+        self.min_duration = min_duration
+        self.merge_radius = merge_radius
+        self.decay_seconds = decay_seconds
+
+        self._clusters = np.zeros((max_clusters, 6), dtype=np.float64)
+        self._cluster_count = 0
+        self._next_slot = 0
+        self.heatmap = np.zeros(heatmap_shape, dtype=np.float32)
+        self._heatmap_time = None
+
+        self._last_sample = None  # 上一批最后一个采样 (t, x, y)
+        self._open = None  # 进行中的注视 [sum_x, sum_y, count, start_t, end_t]
+        self.samples_seen = 0
+        self.fixations_seen = 0
+
+    def feed(self, samples):
+        """
+        处理一批眼动采样
+
+        速度按向量化方式一次算出，之后只按注视/扫视的分段循环。
+
+        Returns:
+            本批中结束的注视数
+        """
+        array = _as_sample_array(samples)
+        if len(array) == 0:
+            return 0
+        self.samples_seen += len(array)
+
+        previous = self._last_sample if self._last_sample is not None else array[0]
+        chain = np.vstack([previous[None, :], array])
+        dt = np.diff(chain[:, 0])
+        distance = np.hypot(np.diff(chain[:, 1]), np.diff(chain[:, 2]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            velocity = np.where(dt > 0, distance / np.where(dt > 0, dt, 1.0), np.inf)
+        # 时间戳重复的采样只有在位置不变时才算作注视
+        velocity[(dt <= 0) & (distance == 0)] = 0.0
+        is_fixation = velocity < self.velocity_threshold
+        self._last_sample = array[-1].copy()
+
+        closed = 0
+        boundaries = np.flatnonzero(np.diff(is_fixation.astype(np.int8))) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(array)]):
+            if is_fixation[start]:
+                segment = array[start:end]
+                if self._open is None:
+                    # 注视的第一个采样是速度跳变前的那个点
+                    first = previous if start == 0 else array[start - 1]
+                    self._open = [first[1], first[2], 1, first[0], first[0]]
+                self._open[0] += segment[:, 1].sum()
+                self._open[1] += segment[:, 2].sum()
+                self._open[2] += len(segment)
+                self._open[4] = segment[-1, 0]
+            else:
+                closed += self._close_fixation()
+        return closed
+
+    def top_fixations(self, k=3, radius=0.1, now=None):
+        """
+        按衰减后的权重返回最显著的k个注视簇
+
+        进行中的注视（如用户做手势时正盯着的位置）达到最短时长后也参与排序：按注视结束时的规则
+        临时并入相近的簇或作为单独的候选，权重同样随时间衰减；注视不会因此结束，注视簇也不会被修改。
+
+        Returns:
+            [{'x', 'y', 'radius', 'weight', 'duration', 'count'}, ...]，可直接作为gaze_data使用
+        """
+        clusters = self._clusters[:self._cluster_count]
+        fixation = self._open_fixation()
+        if fixation is not None:
+            x, y, duration, end_t = fixation
+            clusters = clusters.copy()
+            nearest = self._nearest_cluster(clusters, x, y)
+            if nearest is None:
+                clusters = np.vstack([clusters, (x, y, duration, duration, 1, end_t)])
+            else:
+                self._merge_into(clusters[nearest], x, y, duration, end_t)
+        if len(clusters) == 0:
+            return []
+        if now is None:
+            now = self._last_sample[0]
+
+        weights = clusters[:, _WEIGHT] * np.exp(-(now - clusters[:, _LAST]) / self.decay_seconds)
+        order = np.argsort(-weights)[:k]
+        return [{
+            "x": float(clusters[i, _X]),
+            "y": float(clusters[i, _Y]),
+            "radius": radius,
+            "weight": float(weights[i]),
+            "duration": float(clusters[i, _DURATION]),
+            "count": int(clusters[i, _COUNT]),
+        } for i in order]
+
+    def stats(self):
+        """返回检测器状态"""
+        return {
+            "samples": self.samples_seen,
+            "fixations": self.fixations_seen,
+            "clusters": self._cluster_count,
+            "heatmap_peak": float(self.heatmap.max()),
+        }
+
+    def _open_fixation(self):
+        """进行中的注视的(x, y, 时长, 最后采样时间)，没有或短于最短时长时返回None"""
+        if self._open is None:
+            return None
+        sum_x, sum_y, count, start_t, end_t = self._open
+        duration = end_t - start_t
+        if duration < self.min_duration:
+            return None
+        return sum_x / count, sum_y / count, duration, end_t
+
+    def _close_fixation(self):
+        """结束进行中的注视，足够长的并入注视簇和热图"""
+        fixation = self._open_fixation()
+        self._open = None
+        if fixation is None:
+            return 0
+
+        x, y, duration, end_t = fixation
+        self.fixations_seen += 1
+        self._add_to_clusters(x, y, duration, end_t)
+        self._add_to_heatmap(x, y, duration, end_t)
+        return 1
+
+    def _nearest_cluster(self, clusters, x, y):
+        """距离不超过merge_radius的最近簇的下标，没有时返回None"""
+        if len(clusters) == 0:
+            return None
+        distances = np.hypot(clusters[:, _X] - x, clusters[:, _Y] - y)
+        nearest = int(np.argmin(distances))
+        return nearest if distances[nearest] <= self.merge_radius else None
+
+    def _merge_into(self, cluster, x, y, duration, end_t):
+        """把一次注视并入簇：权重先按时间衰减，再按时长加权更新中心"""
+        decayed = cluster[_WEIGHT] * math.exp(-(end_t - cluster[_LAST]) / self.decay_seconds)
+        total = decayed + duration
+        cluster[_X] = (cluster[_X] * decayed + x * duration) / total
+        cluster[_Y] = (cluster[_Y] * decayed + y * duration) / total
+        cluster[_WEIGHT] = total
+        cluster[_DURATION] += duration
+        cluster[_COUNT] += 1
+        cluster[_LAST] = end_t
+
+    def _add_to_clusters(self, x, y, duration, end_t):
+        nearest = self._nearest_cluster(self._clusters[:self._cluster_count], x, y)
+        if nearest is not None:
+            self._merge_into(self._clusters[nearest], x, y, duration, end_t)
+            return
+
+        # 新簇写入环形缓冲区，满了之后覆盖最早写入的簇
+        self._clusters[self._next_slot] = (x, y, duration, duration, 1, end_t)
+        self._next_slot = (self._next_slot + 1) % len(self._clusters)
+        self._cluster_count = min(self._cluster_count + 1, len(self._clusters))
+
+    def _add_to_heatmap(self, x, y, duration, end_t):
+        if self._heatmap_time is not None:
+            self.heatmap *= math.exp(-(end_t - self._heatmap_time) / self.decay_seconds)
+        self._heatmap_time = end_t
+        rows, cols = self.heatmap.shape
+        row = min(max(int(y * rows), 0), rows - 1)
+        col = min(max(int(x * cols), 0), cols - 1)
+        self.heatmap[row, col] += duration
+
+
+class GazeSessionStore:
+    """按客户端保存注视检测器，超过会话数上限时淘汰最久未活动的会话"""
+
+    def __init__(self, max_sessions=256, **detector_kwargs):
+        self.max_sessions = max_sessions
+        self.detector_kwargs = detector_kwargs
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def feed(self, session_id, samples):
+        """把一批采样交给该会话的检测器，返回本批结束的注视数"""
+        # 先解析采样，格式错误时不创建会话
+        samples = _as_sample_array(samples)
+        with self._lock:
+            detector = self._sessions.get(session_id)
+            if detector is None:
+                detector = FixationDetector(**self.detector_kwargs)
+                self._sessions[session_id] = detector
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            return detector.feed(samples)
+
+    def top_fixations(self, session_id, k=3, radius=0.1):
+        """返回该会话最显著的k个注视簇，没有会话时返回空列表"""
+        with self._lock:
+            detector = self._sessions.get(session_id)
+            if detector is None:
+                return []
+            return detector.top_fixations(k, radius)
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def drop(self, session_id):
+        """结束会话（如客户端断开）"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
@@ -0,0 +1,163 @@
+import logging
+
+from lazy_import import lazy_import, module_available
+
+torch = lazy_import("torch", optional=True)
+transformers = lazy_import("transformers", optional=True)
+
+logger = logging.getLogger("inference_backend")
+
+QUANTIZATION_MODES = (None, "int8", "int4")
+
+
+class InferenceBackend:
+    """
+    模型的加载方式与运行设备
+
+    load_weights()按后端的设置调用from_pretrained，prepare()在加载后做设备相关的处理
+    （如量化、设置线程数），推理时输入通过device放到模型所在的设备上。
+    """
+
+    name = None
+    transformers_model = True  # 加载的是否为transformers模型（决定能否使用前缀KV缓存等依赖模型内部结构的优化）
+
+    def __init__(self, device):
+        self.device = device
+
+    def from_pretrained_kwargs(self):
+        """传给AutoModelForCausalLM.from_pretrained的参数"""
+        raise NotImplementedError
+
+    def load_weights(self, model_path):
+        return transformers.AutoModelForCausalLM.from_pretrained(
+            model_path,
+            trust_remote_code=True,
+            **self.from_pretrained_kwargs()
+        )
+
+    def prepare(self, model):
+        """加载后的处理，返回可用于推理的模型"""
+        return model
+
+    def load_model(self, model_path):
+        return self.prepare(self.load_weights(model_path))
+
+    @property
+    def precision(self):
+        """加载后的权重精度（模型注册表按它区分同一路径的不同实例）"""
+        return "auto"
+
+    def describe(self):
+        """后端配置（用于日志和状态接口）"""
+        return {"backend": self.name, "device": self.device}
+
+
+class CudaBackend(InferenceBackend):
+    """GPU推理：权重按原始精度放到GPU上，安装了flash-attn时使用FlashAttention 2，否则使用SDPA"""
+
+    name = "cuda"
+
+    def __init__(self, device="cuda:0"):
+        super().__init__(device)
+        self.attention = "flash_attention_2" if module_available("flash_attn") else "sdpa"
+
+    def from_pretrained_kwargs(self):
+        return {
+            "device_map": self.device,
+            "torch_dtype": "auto",
+            "_attn_implementation": self.attention,
+        }
+
+    def describe(self):
+        return {**super().describe(), "attention": self.attention}
+
+
+class CpuBackend(InferenceBackend):
+    """
+    无GPU设备上的推理
+
+    - 注意力使用PyTorch的SDPA实现
+    - quantization为'int8'时对所有Linear层做动态int8量化（权重int8，激活在运行时量化）
+    - quantization为'int4'时对Linear层做分组的int4权重量化，前向时反量化，主要用于降低内存占用
+    - threads设置PyTorch的计算线程数，None时使用PyTorch的默认值
+    """
+
+    name = "cpu"
+
+    def __init__(self, threads=None, quantization=None, dtype="float32", int4_group_size=32):
+        """
+        Args:
+            threads: 计算线程数
+            quantization: None、'int8'或'int4'
+            dtype: 未量化部分的权重精度，'float32'或'bfloat16'（int8动态量化要求float32）
+            int4_group_size: int4量化时共享一个缩放系数的权重个数
+        """
+        super().__init__("cpu")
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"不支持的量化方式: {quantization}，可选: int8、int4")
+        if quantization == "int8" and dtype != "float32":
+            raise ValueError("int8动态量化要求float32权重")
+        self.threads = threads
+        self.quantization = quantization
+        self.dtype = dtype
+        self.int4_group_size = int4_group_size
+
+    def from_pretrained_kwargs(self):
+        # 不传device_map：权重默认加载到CPU，也不需要安装accelerate
+        return {
+            "torch_dtype": getattr(torch, self.dtype),
+            "_attn_implementation": "sdpa",
+        }
+
+    @property
+    def precision(self):
+        return self.quantization or self.dtype
+
+    def prepare(self, model):
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        model.eval()
+        if self.quantization is not None:
+            # 量化实现只在启用量化时导入
+            from weight_quantization import quantize_int8, quantize_int4
+            if self.quantization == "int8":
+                model = quantize_int8(model)
+            else:
+                count = quantize_int4(model, group_size=self.int4_group_size)
+                logger.info(f"int4量化了{count}个Linear层")
+        return model
+
+    def describe(self):
+        return {
+            **super().describe(),
+            "attention": "sdpa",
+            "threads": self.threads if self.threads is not None else torch.get_num_threads(),
+            "quantization": self.quantization,
+            "dtype": self.dtype,
+        }
+
+
+def create_backend(name="auto", threads=None, quantization=None, dtype="float32"):
+    """
+    按名称创建推理后端
+
+    Args:
+        name: 'cuda'、'cpu'、'onnx'（ONNX Runtime，见onnx_backend.py）或'auto'（有可用的GPU时使用cuda，否则使用cpu）
+        threads, quantization, dtype: CPU后端的设置，使用cuda时忽略；onnx只使用threads
+    """
+    if name == "auto":
+        name = "cuda" if torch.cuda.is_available() else "cpu"
+        logger.info(f"自动选择推理后端: {name}")
+    if name == "cuda":
+        if quantization is not None:
+            logger.warning(f"CUDA后端不支持{quantization}量化，按原始精度加载")
+        return CudaBackend()
+    if name == "cpu":
+        return CpuBackend(threads=threads, quantization=quantization, dtype=dtype)
+    if name == "onnx":
+        # onnxruntime只在选择该后端时导入
+        from onnx_backend import OnnxBackend
+        if quantization is not None:
+            logger.warning(f"ONNX后端的权重精度由导出的模型决定，忽略{quantization}量化")
+        return OnnxBackend(threads=threads)
+    raise ValueError(f"未知的推理后端: {name}，可选: auto、cuda、cpu、onnx")
@@ -0,0 +1,233 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+
+logger = logging.getLogger("inference_pool")
+
+
+class QueueFullError(Exception):
+    """推理队列已满"""
+
+
+class InferenceJob:
+    """推理池中的单个任务"""
+
+    __slots__ = ("job_id", "kind", "fn", "args", "kwargs", "meta", "status", "result", "error",
+                 "created", "started", "finished", "timeout", "done")
+
+    def __init__(self, kind, fn, args, kwargs, timeout, meta=None):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.meta = meta or {}
+        self.status = "queued"  # queued -> running -> done / failed / timeout
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.timeout = timeout
+        self.done = threading.Event()
+
+    @property
+    def deadline(self):
+        return self.created + self.timeout if self.timeout else None
+
+    def wait(self, timeout=None):
+        """等待任务结束（完成、失败或超时），返回是否已结束"""
+        return self.done.wait(timeout)
+
+    def to_dict(self):
+        """任务状态的JSON表示"""
+        data = {
+            "job_id": self.job_id,
+            "type": self.kind,
+            "status": self.status,
+            "queue_wait": (self.started or self.finished or time.time()) - self.created,
+            "run_time": (self.finished or time.time()) - self.started if self.started else None,
+        }
+        if self.status == "done":
+            data["result"] = self.result
+        elif self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class InferencePool:
+    """
+    推理工作线程池
+
+    模型推理从Flask请求线程中移出，由固定数量的工作线程从有界队列中取任务执行。
+    队列满时submit立即抛出QueueFullError；每个任务有超时时间，超时的排队任务不再执行，
+    运行中超时的任务对调用方报告为timeout，其结果被丢弃。
+    任务结束时调用on_complete(job)，已结束的任务保留result_ttl秒供轮询。
+    """
+
+    def __init__(self, workers=1, max_queue=32, default_timeout=120.0, result_ttl=300.0, on_complete=None):
+        """
+        Args:
+            workers: 工作线程数（同一GPU上的模型通常为1）
+            max_queue: 排队任务数上限
+            default_timeout: 默认任务超时（秒），None表示不超时
+            result_ttl: 已结束任务保留多少秒
+            on_complete: 任务结束时的回调，参数为InferenceJob
+        """
+        self.workers = max(1, int(workers))
+        self.max_queue = max_queue
+        self.default_timeout = default_timeout
+        self.result_ttl = result_ttl
+        self.on_complete = on_complete
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "timed_out": 0}
+
+    def start(self):
+        """启动工作线程和超时检查线程"""
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"phi-inference-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        reaper = threading.Thread(target=self._reaper_loop, name="phi-inference-reaper", daemon=True)
+        reaper.start()
+        self._threads.append(reaper)
+        logger.info(f"推理线程池已启动: workers={self.workers}, max_queue={self.max_queue}")
+
+    def stop(self):
+        """停止工作线程（正在运行的任务会先执行完）"""
+        self._stop.set()
+        for _ in range(self.workers):
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        self._threads = []
+
+    def submit(self, kind, fn, *args, timeout=None, meta=None, **kwargs):
+        """
+        提交推理任务，立即返回
+
+        Args:
+            kind: 任务类型（如'intent'、'analyze_ui'、'chat'）
+            fn: 在工作线程中执行的函数，返回值作为任务结果
+            timeout: 任务超时（秒），None时使用默认值
+            meta: 附加信息（如提交任务的Socket.IO会话ID）
+
+        Returns:
+            InferenceJob
+
+        Raises:
+            QueueFullError: 排队任务数已达上限
+        """
+        if not self._threads:
+            self.start()
+
+        job = InferenceJob(kind, fn, args, kwargs, timeout if timeout is not None else self.default_timeout, meta)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.job_id]
+                self._stats["rejected"] += 1
+            raise QueueFullError(f"推理队列已满（{self.max_queue}个任务排队）")
+
+        with self._lock:
+            self._stats["submitted"] += 1
+        return job
+
+    def get(self, job_id):
+        """按ID获取任务，不存在或已过期返回None"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        """返回线程池统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+        stats.update({
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize(),
+            "max_queue": self.max_queue,
+            "running": running,
+        })
+        return stats
+
+    def _finish(self, job, status, result=None, error=None):
+        """标记任务结束并通知；已因超时结束的任务不再更新"""
+        with self._lock:
+            if job.done.is_set():
+                return
+            job.status = status
+            job.result = result
+            job.error = error
+            job.finished = time.time()
+            key = {"done": "completed", "failed": "failed", "timeout": "timed_out"}[status]
+            self._stats[key] += 1
+            job.done.set()
+
+        if self.on_complete is not None:
+            try:
+                self.on_complete(job)
+            except Exception as e:
+                logger.error(f"任务完成回调出错: {str(e)}")
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            job = self._queue.get()
+            if job is None:
+                break
+
+            if job.done.is_set():
+                # 排队期间已超时
+                continue
+            if job.deadline is not None and time.time() > job.deadline:
+                self._finish(job, "timeout", error=f"推理超时（{job.timeout}秒）")
+                continue
+
+            with self._lock:
+                job.status = "running"
+                job.started = time.time()
+
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                logger.error(f"推理任务{job.job_id}失败: {str(e)}")
+                self._finish(job, "failed", error=str(e))
+            else:
+                if job.deadline is not None and time.time() > job.deadline:
+                    self._finish(job, "timeout", error=f"推理超时（{job.timeout}秒）")
+                else:
+                    self._finish(job, "done", result=result)
+
+    def _reaper_loop(self):
+        """定期标记超时任务、清理过期的任务结果"""
+        while not self._stop.wait(0.2):
+            now = time.time()
+            with self._lock:
+                jobs = list(self._jobs.values())
+
+            for job in jobs:
+                if not job.done.is_set() and job.deadline is not None and now > job.deadline:
+                    logger.warning(f"推理任务{job.job_id}超时（{job.timeout}秒，状态{job.status}）")
+                    self._finish(job, "timeout", error=f"推理超时（{job.timeout}秒）")
+
+            with self._lock:
+                expired = [job_id for job_id, job in self._jobs.items()
+                           if job.done.is_set() and now - job.finished > self.result_ttl]
+                for job_id in expired:
+                    del self._jobs[job_id]
@@ -0,0 +1,68 @@
+import sys
+import time
+import logging
+import importlib
+import importlib.util
+import threading
+
+logger = logging.getLogger("lazy_import")
+
+
+class LazyModule:
+    """
+    模块的延迟代理
+
+    创建时只记录模块名，第一次访问属性时才真正导入，之后直接转发到已导入的模块。
+    用于torch、transformers、matplotlib等导入耗时数秒、占用数百MB内存的依赖：
+    模拟模式或只用到状态接口时不会导入它们。
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "已导入" if self._module is not None else "未导入"
+        return f"<LazyModule {self._name} ({state})>"
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    logger.info(f"延迟导入{self._name}用时{time.perf_counter() - start:.2f}秒")
+                module = self._module
+        return module
+
+
+def module_available(name):
+    """模块是否已安装（只查找，不导入）"""
+    if name in sys.modules:
+        return True
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def lazy_import(name, optional=False):
+    """
+    返回模块的延迟代理
+
+    Args:
+        name: 模块名，如'torch'、'matplotlib.pyplot'
+        optional: 为True时模块未安装则返回None（替代try/except ImportError）
+    """
+    if optional and not module_available(name):
+        return None
+    return LazyModule(name)
@@ -1,77 +1,100 @@
 import os
 import sys
 import json
-import requests
 from typing import Dict, Any, List, Optional, Tuple
 import re
 
+from lazy_import import lazy_import
+
+# 只有remote模式才需要HTTP客户端
+requests = lazy_import("requests")
+
 # 导入工具定义
-from mcp_tools import get_tool_by_name, validate_tool_parameters
+from tool_registry import tool_registry, ToolValidationError, SETTINGS
+from tool_call_parser import extract_tool_calls
 
 # API地址
 API_BASE_URL = "http://localhost:5000/api"
 
-# XEO应用工具定义
-xeo_tools = [
-    {
-        "name": "connect_device",
-        "description": "连接或断开XEO应用中的设备",
-        "parameters": {
-            "device_id": {
-                "description": "设备ID，可以是'about-xeo', 'apple-tv', 'playstation', 'nintendo'中的一个",
-                "type": "str",
-                "enum": ["about-xeo", "apple-tv", "playstation", "nintendo"]
-            }
-        }
-    },
-    {
-        "name": "adjust_setting",
-        "description": "调整XEO应用中的设置参数",
-        "parameters": {
-            "setting_id": {
-                "description": "设置ID，可以是'volume', 'ipd', 'magic', 'seat', 'ventilation'中的一个",
-                "type": "str",
-                "enum": ["volume", "ipd", "magic", "seat", "ventilation"]
-            },
-            "value": {
-                "description": "设置的新值",
-                "type": "int"
-            }
-        }
-    }
-]
+# XEO应用工具定义（由tool_registry生成）
+xeo_tools = tool_registry.prompt_tools()
 
 # 全局设备和设置状态，由app.py维护
 devices = {}
 settings = {}
+state_store = None
 
-def set_state_reference(app_devices, app_settings):
-    """从app.py获取设备和设置状态的引用"""
-    global devices, settings
+def set_state_reference(app_devices, app_settings, app_state_store=None):
+    """从app.py获取设备和设置状态的引用；提供StateStore时写入经其记录版本并广播"""
+    global devices, settings, state_store
     devices = app_devices
     settings = app_settings
+    state_store = app_state_store
+
+def write_state(path, value):
+    """写入一项状态，path如('devices', 'apple-tv', 'connected')"""
+    update_state(path, lambda _: value)
+
+def update_state(path, fn):
+    """按当前值计算新值并写入，返回新值；有StateStore时读写在其锁内完成并广播state_delta"""
+    if state_store is not None:
+        return state_store.update(path, fn)
+    section = devices if path[0] == "devices" else settings
+    for key in path[1:-1]:
+        section = section[key]
+    section[path[-1]] = fn(section[path[-1]])
+    return section[path[-1]]
+
+# 设置的单位
+SETTING_UNITS = {setting_id: unit for setting_id, (_, _, unit, _) in SETTINGS.items()}
 
 class ToolExecutor:
-    """Phi4工具执行器类"""
+    """
+    Phi4工具执行器类
     
-    def __init__(self):
-        """初始化工具执行器"""
-        self.api_base_url = "http://localhost:5000/api"
+    - local模式（默认）：与app.py在同一进程，直接修改共享状态，每次调用只生效一次，
+      状态变化由StateStore广播
+    - remote模式：执行器运行在其他进程时，通过连接池复用的HTTP会话调用XEO接口，
+      每个请求有超时，失败时返回错误而不是静默忽略
+    """
+    
+    def __init__(self, mode="local", api_base_url=API_BASE_URL, timeout=5.0, pool_size=4):
+        """
+        初始化工具执行器
+        
+        Args:
+            mode: 'local'或'remote'
+            api_base_url: remote模式下的XEO接口地址
+            timeout: remote模式下单次请求的超时（秒）
+            pool_size: remote模式下连接池大小
+        """
+        if mode not in ("local", "remote"):
+            raise ValueError(f"不支持的工具执行模式: {mode}")
+        self.mode = mode
+        self.api_base_url = api_base_url
+        self.timeout = timeout
+        self.session = None
+        if mode == "remote":
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
     
     def execute_tool(self, tool_name, arguments=None):
         """执行指定的工具"""
         if not arguments:
             arguments = {}
-            
-        result = {"success": False, "message": "未知工具或执行失败"}
         
-        if tool_name == "connect_device":
-            result = self.execute_connect_device(arguments.get("device_id", ""))
-        elif tool_name == "adjust_setting":
-            result = self.execute_adjust_setting(
-                arguments.get("setting_id", ""), 
-                arguments.get("value", 0)
-            )
+        # 按注册表展开别名（如connect_apple_tv）并转换、校验参数
+        try:
+            name, resolved = tool_registry.resolve(tool_name, arguments)
+        except ToolValidationError as e:
+            result = {"success": False, "message": str(e)}
+        else:
+            if name == "connect_device":
+                result = self.execute_connect_device(resolved["device_id"])
+            else:
+                result = self.execute_adjust_setting(resolved["setting_id"], resolved["value"])
         
         return {
             "tool_name": tool_name,
@@ -80,99 +103,79 @@ class ToolExecutor:
             "content": [{"type": "text", "text": result.get("message", "")}]
         }
     
+    def get_current_status(self):
+        """获取当前的设备和设置状态"""
+        if self.mode == "remote":
+            response = self._request("GET", "/state")
+            return response.json()["state"]
+        if state_store is not None:
+            return state_store.snapshot()[1]
+        return {"devices": devices, "settings": settings}
+    
     def execute_connect_device(self, device_id):
         """连接或断开设备"""
-        if device_id not in devices:
-            return {"success": False, "message": f"未知设备ID: {device_id}"}
-        
-        # 切换连接状态
-        current_status = devices[device_id]["connected"]
-        devices[device_id]["connected"] = not current_status
-        
-        new_status = "connected" if devices[device_id]["connected"] else "disconnected"
-        status_text = "已连接" if devices[device_id]["connected"] else "已断开"
-        
-        # 尝试通过API调用
-        try:
-            response = requests.post(
-                f"{self.api_base_url}/devices/{device_id}/connect",
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code != 200:
-                # 如果API调用失败，回滚状态更改
-                devices[device_id]["connected"] = current_status
-                return {"success": False, "message": f"API调用失败: {response.status_code}"}
-            
-        except Exception as e:
-            # 直接使用内存中的状态，不依赖API
-            pass
+        if self.mode == "remote":
+            try:
+                data = self._request("POST", f"/devices/{device_id}/connect").json()
+            except Exception as e:
+                return {"success": False, "message": f"API调用失败: {str(e)}"}
+            device = data["device"]
+        else:
+            if device_id not in devices:
+                return {"success": False, "message": f"未知设备ID: {device_id}"}
+            # 切换连接状态
+            connected = update_state(("devices", device_id, "connected"), lambda connected: not connected)
+            device = dict(devices[device_id], connected=connected)
         
+        new_status = "connected" if device["connected"] else "disconnected"
+        status_text = "已连接" if device["connected"] else "已断开"
         return {
             "success": True,
-            "device": devices[device_id],
+            "device_id": device_id,
+            "old_connected": not device["connected"],
+            "device": device,
             "status": new_status,
-            "message": f"设备 {devices[device_id]['name']} {status_text}"
+            "message": f"设备 {device['name']} {status_text}"
         }
     
     def execute_adjust_setting(self, setting_id, value):
-        """调整设置参数"""
+        """调整设置参数（参数已经过tool_registry校验）"""
+        unit = SETTING_UNITS[setting_id]
+        if self.mode == "remote":
+            try:
+                self._request("PUT", f"/settings/{setting_id}", json={"value": value})
+            except Exception as e:
+                return {"success": False, "message": f"API调用失败: {str(e)}"}
+            return {
+                "success": True,
+                "setting_id": setting_id,
+                "new_value": value,
+                "unit": unit,
+                "message": f"设置 {setting_id} 已更改为 {value}{unit}"
+            }
+        
         if setting_id not in settings:
             return {"success": False, "message": f"未知设置ID: {setting_id}"}
-        
-        # 验证值的范围
-        min_max = {
-            "volume": (0, 100),
-            "ipd": (50, 80),
-            "magic": (0, 100),
-            "seat": (0, 100),
-            "ventilation": (0, 100)
-        }
-        
-        min_val, max_val = min_max[setting_id]
-        if value < min_val or value > max_val:
-            return {"success": False, "message": f"设置值超出范围 ({min_val}-{max_val}): {value}"}
-        
-        # 保存旧值，以便在API调用失败时回滚
         old_value = settings[setting_id]
-        
-        # 更新设置值
-        settings[setting_id] = value
-        
-        # 获取单位
-        units = {
-            "volume": "%",
-            "ipd": "mm",
-            "magic": "%",
-            "seat": "",
-            "ventilation": "%"
-        }
-        
-        # 尝试通过API调用
-        try:
-            response = requests.put(
-                f"{self.api_base_url}/settings/{setting_id}",
-                headers={"Content-Type": "application/json"},
-                json={"value": value}
-            )
-            
-            if response.status_code != 200:
-                # 如果API调用失败，回滚状态更改
-                settings[setting_id] = old_value
-                return {"success": False, "message": f"API调用失败: {response.status_code}"}
-            
-        except Exception as e:
-            # 直接使用内存中的状态，不依赖API
-            pass
-        
+        write_state(("settings", setting_id), value)
         return {
             "success": True,
             "setting_id": setting_id,
             "old_value": old_value, 
             "new_value": value,
-            "unit": units[setting_id],
-            "message": f"设置 {setting_id} 已从 {old_value}{units[setting_id]} 更改为 {value}{units[setting_id]}"
+            "unit": unit,
+            "message": f"设置 {setting_id} 已从 {old_value}{unit} 更改为 {value}{unit}"
         }
+    
+    def _request(self, method, path, **kwargs):
+        """remote模式下调用XEO接口，非2xx状态码抛出异常"""
+        response = self.session.request(method, f"{self.api_base_url}{path}", timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+def create_tool_executor(mode="local", **kwargs):
+    """按模式创建工具执行器（参数见ToolExecutor）"""
+    return ToolExecutor(mode, **kwargs)
 
 # 创建工具执行器实例
 tool_executor = ToolExecutor()
@@ -187,12 +190,12 @@ def test_tools():
     
     # 测试设备连接
     print("\n测试设备连接...")
-    result = tool_executor.execute_tool("connect_about_xeo", {})
+    result = tool_executor.execute_tool("connect_device", {"device_id": "about-xeo"})
     print(json.dumps(result, indent=2))
     
     # 测试设置调节
     print("\n测试设置调节...")
-    result = tool_executor.execute_tool("adjust_volume", {"value": 75})
+    result = tool_executor.execute_tool("adjust_setting", {"setting_id": "volume", "value": 75})
     print(json.dumps(result, indent=2))
 
 if __name__ == "__main__":
@@ -201,55 +204,14 @@ if __name__ == "__main__":
 def parse_tool_calls(response_text):
     """
     解析模型返回的工具调用，支持Phi4的格式
-    """
-    tool_calls = []
-    
-    # 尝试提取 <|tool_call|>[...]<|/tool_call|> 格式
-    tool_call_pattern = r'<\|tool_call\|>(.+?)<\|/tool_call\|>'
-    tool_call_matches = re.findall(tool_call_pattern, response_text, re.DOTALL)
-    
-    if tool_call_matches:
-        for match in tool_call_matches:
-            try:
-                # 尝试解析JSON
-                calls = json.loads(match)
-                if isinstance(calls, list):
-                    for call in calls:
-                        if isinstance(call, dict) and "name" in call:
-                            # 将arguments字段映射到parameters字段
-                            if "arguments" in call:
-                                call["parameters"] = call.pop("arguments")
-                            tool_calls.append(call)
-                elif isinstance(calls, dict) and "name" in calls:
-                    if "arguments" in calls:
-                        calls["parameters"] = calls.pop("arguments")
-                    tool_calls.append(calls)
-            except json.JSONDecodeError:
-                print(f"无法解析JSON: {match}")
-    
-    # 如果没有找到tool_call标记，尝试直接在文本中查找JSON数组或对象
-    if not tool_calls:
-        # 尝试查找JSON格式的数组或对象
-        json_pattern = r'\[\s*\{.*?\}\s*\]|\{\s*"name"\s*:.*?\}'
-        json_matches = re.findall(json_pattern, response_text, re.DOTALL)
-        
-        for match in json_matches:
-            try:
-                data = json.loads(match)
-                if isinstance(data, list):
-                    for item in data:
-                        if isinstance(item, dict) and "name" in item:
-                            # 将arguments字段映射到parameters字段
-                            if "arguments" in item:
-                                item["parameters"] = item.pop("arguments")
-                            tool_calls.append(item)
-                elif isinstance(data, dict) and "name" in data:
-                    if "arguments" in data:
-                        data["parameters"] = data.pop("arguments")
-                    tool_calls.append(data)
-            except json.JSONDecodeError:
-                continue
     
+    优先提取<|tool_call|>或```tool_call框定的调用，没有时在正文中查找带name的JSON对象或数组。
+    """
+    _, tool_calls = extract_tool_calls(response_text, bare_json=True)
+    for call in tool_calls:
+        # 将arguments字段映射到parameters字段
+        if "arguments" in call:
+            call["parameters"] = call.pop("arguments")
     return tool_calls
 
 def analyze_message_keywords(message):
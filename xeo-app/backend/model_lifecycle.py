@@ -0,0 +1,175 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("model_lifecycle")
+
+# 生命周期状态
+UNLOADED = "unloaded"    # 按需加载模式下尚未开始加载
+LOADING = "loading"      # 后台加载中
+READY = "ready"          # 模型可用
+DEGRADED = "degraded"    # 加载失败，已降级为模拟模式
+FAILED = "failed"        # 加载失败且不允许降级，推理不可用
+CLOSED = "closed"        # 已释放模型，推理不可用，也不会重新加载
+
+
+class ModelUnavailable(Exception):
+    """模型尚未就绪或加载失败，推理请求无法执行"""
+
+    def __init__(self, message, state, retry_after=None):
+        super().__init__(message)
+        self.state = state
+        self.retry_after = retry_after
+
+
+class ModelLifecycle:
+    """
+    模型的后台加载与生命周期状态
+
+    - start()在后台线程中执行加载，进程启动和轻量接口不必等待多GB的权重加载
+    - 加载函数通过step()分步计时（如processor、weights、generation_config）
+    - 加载失败时，提供了fallback则调用它并进入degraded，否则进入failed
+    - check()供请求入口使用：未加载时触发加载，未就绪时抛出ModelUnavailable
+    - close()在释放模型前调用，之后的请求直接得到ModelUnavailable
+    """
+
+    def __init__(self, name, load_fn, fallback_fn=None, retry_after=5):
+        """
+        Args:
+            name: 模型名称（用于日志）
+            load_fn: 加载函数，参数为本对象（用于step计时），失败时抛出异常
+            fallback_fn: 加载失败时的降级函数，None表示不降级
+            retry_after: 加载中时建议客户端重试的秒数
+        """
+        self.name = name
+        self.load_fn = load_fn
+        self.fallback_fn = fallback_fn
+        self.retry_after = retry_after
+
+        self._state = UNLOADED
+        self._error = None
+        self._timings = {}
+        self._started_at = None
+        self._finished_at = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def usable(self):
+        """是否可以处理推理请求（ready或已降级）"""
+        return self._state in (READY, DEGRADED)
+
+    def mark(self, state, error=None):
+        """不经加载直接设置最终状态（如配置为模拟模式、依赖未安装）"""
+        with self._lock:
+            self._state = state
+            self._error = error
+            self._done.set()
+
+    def close(self):
+        """进入closed状态（正在加载时先等待加载结束，以便调用方释放加载出的模型）"""
+        while True:
+            with self._lock:
+                if self._state != LOADING:
+                    self._state = CLOSED
+                    self._error = None
+                    self._done.set()
+                    return
+            self._done.wait()
+
+    def start(self):
+        """在后台线程中开始加载（已开始或已结束时不做任何事）"""
+        with self._lock:
+            if self._state != UNLOADED:
+                return self
+            self._state = LOADING
+            self._started_at = time.time()
+        thread = threading.Thread(target=self._run, name=f"load-{self.name}", daemon=True)
+        thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """等待加载结束，返回当前状态"""
+        self._done.wait(timeout)
+        return self._state
+
+    def ensure(self, timeout=None):
+        """触发加载并等待结束（直接调用推理方法时使用），不可用时抛出ModelUnavailable"""
+        self.start()
+        self.wait(timeout)
+        self._raise_unless_usable()
+
+    def check(self, wait=0):
+        """
+        请求入口的就绪检查：未加载时触发后台加载，最多等待wait秒
+
+        Raises:
+            ModelUnavailable: 仍在加载或加载失败
+        """
+        if self.usable:
+            return
+        self.start()
+        if wait > 0:
+            self.wait(wait)
+        self._raise_unless_usable()
+
+    @contextmanager
+    def step(self, name):
+        """记录加载中某一步的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._timings[name] = round(elapsed, 3)
+            logger.info(f"{self.name}加载步骤{name}用时{elapsed:.2f}秒")
+
+    def status(self):
+        """生命周期状态、错误信息和分步耗时"""
+        status = {
+            "state": self._state,
+            "timings": dict(self._timings),
+        }
+        if self._error is not None:
+            status["error"] = self._error
+        if self._started_at is not None:
+            end = self._finished_at if self._finished_at is not None else time.time()
+            status["load_seconds"] = round(end - self._started_at, 3)
+        return status
+
+    def _run(self):
+        try:
+            self.load_fn(self)
+            state, error = READY, None
+            logger.info(f"{self.name}加载完成")
+        except Exception as e:
+            error = str(e)
+            logger.error(f"{self.name}加载失败: {error}")
+            state = FAILED
+            if self.fallback_fn is not None:
+                try:
+                    self.fallback_fn()
+                    state = DEGRADED
+                    logger.warning(f"{self.name}已降级运行")
+                except Exception as fallback_error:
+                    logger.error(f"{self.name}降级失败: {str(fallback_error)}")
+        with self._lock:
+            self._state = state
+            self._error = error
+            self._finished_at = time.time()
+            self._done.set()
+
+    def _raise_unless_usable(self):
+        state = self._state
+        if state in (READY, DEGRADED):
+            return
+        if state == FAILED:
+            raise ModelUnavailable(f"{self.name}加载失败: {self._error}", state)
+        if state == CLOSED:
+            raise ModelUnavailable(f"{self.name}已关闭", state)
+        raise ModelUnavailable(f"{self.name}正在加载，请稍后重试", state, self.retry_after)
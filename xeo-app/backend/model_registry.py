@@ -0,0 +1,200 @@
+import os
+import gc
+import time
+import logging
+import threading
+from contextlib import nullcontext
+
+from lazy_import import lazy_import
+from inference_backend import create_backend
+
+torch = lazy_import("torch", optional=True)
+transformers = lazy_import("transformers", optional=True)
+
+logger = logging.getLogger("model_registry")
+
+
+class LoadedModel:
+    """
+    注册表中的一个模型实例
+
+    同一(权重路径, 后端, 精度)只加载一次，各工作流通过acquire()取得同一个对象，
+    用完后release()；引用计数归零时卸载。
+    """
+
+    def __init__(self, key, name, model_path):
+        self.key = key
+        self.name = name
+        self.model_path = model_path  # processor和生成配置的路径
+        self.processor = None
+        self.model = None
+        self.generation_config = None
+        self.backend = None
+        self.refcount = 0
+        self.load_seconds = None
+        self.lock = threading.Lock()  # 同一模型只由一个调用方加载，其余等待
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def status(self):
+        path, backend, precision = self.key
+        return {
+            "name": self.name,
+            "path": path,
+            "backend": self.backend.describe() if self.backend is not None else backend,
+            "precision": precision,
+            "refcount": self.refcount,
+            "loaded": self.loaded,
+            "load_seconds": self.load_seconds,
+        }
+
+
+class _CachedValue:
+    """按路径缓存的processor或生成配置；每个路径一把锁，不同路径可以同时加载"""
+
+    def __init__(self):
+        self.value = None
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    进程内共享的模型、processor和生成配置
+
+    - 模型以(权重路径, 后端, 精度)为键并按引用计数管理，PhiIntentProcessor、PhiUserIntentWorkflow
+      和Phi4WorkflowWithTools加载同一模型时共用一份权重
+    - processor和生成配置按路径缓存（与后端无关），生成配置不会在每次推理时重新读取；
+      该路径的模型全部卸载后一并释放
+    - 不同的模型可以同时在不同线程中加载
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._processors = {}
+        self._generation_configs = {}
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+
+    def acquire(self, model_path, backend="auto", threads=None, quantization=None, dtype="float32",
+                onnx_model_path=None, name=None, step=None):
+        """
+        取得模型（未加载时加载），引用计数加一
+
+        Args:
+            model_path: transformers模型目录（processor和生成配置也从这里加载）
+            backend, threads, quantization, dtype: 推理后端的设置，见inference_backend.create_backend
+            onnx_model_path: backend为'onnx'时的ONNX模型目录
+            name: 模型名称（用于日志和状态接口），默认为目录名
+            step: 加载步骤的计时上下文管理器工厂，如ModelLifecycle.step
+
+        Returns:
+            LoadedModel，含processor、model、generation_config和backend
+        """
+        step = step or (lambda _: nullcontext())
+        backend = create_backend(backend, threads=threads, quantization=quantization, dtype=dtype)
+        weights_path = model_path if backend.transformers_model else onnx_model_path
+        key = (weights_path, backend.name, backend.precision)
+
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                entry = LoadedModel(key, name or os.path.basename(os.path.normpath(str(weights_path))), model_path)
+                self._models[key] = entry
+            entry.refcount += 1
+
+        try:
+            with entry.lock:
+                if entry.loaded:
+                    logger.info(f"复用已加载的模型{entry.name}（{backend.name}，引用数{entry.refcount}）")
+                else:
+                    self._load(entry, model_path, weights_path, backend, step)
+        except Exception:
+            self._release(entry)
+            raise
+        return entry
+
+    def release(self, entry):
+        """引用计数减一，归零时卸载模型"""
+        if entry is not None:
+            self._release(entry)
+
+    def processor(self, model_path):
+        """按路径缓存的processor"""
+        return self._cached(self._processors, model_path,
+                            lambda: transformers.AutoProcessor.from_pretrained(model_path, trust_remote_code=True))
+
+    def generation_config(self, model_path):
+        """按路径缓存的生成配置"""
+        return self._cached(self._generation_configs, model_path,
+                            lambda: transformers.GenerationConfig.from_pretrained(model_path))
+
+    def stats(self):
+        with self._lock:
+            models = [entry.status() for entry in self._models.values()]
+        with self._cache_lock:
+            processors = sum(cached.value is not None for cached in self._processors.values())
+            generation_configs = sum(cached.value is not None for cached in self._generation_configs.values())
+        return {
+            "models": models,
+            "processors": processors,
+            "generation_configs": generation_configs,
+        }
+
+    def _cached(self, cache, model_path, load):
+        """
+        取缓存的值，没有时调用load()加载
+
+        _cache_lock只保护字典的读写；加载在该路径自己的锁内进行，
+        同一路径只加载一次，不同路径的加载互不等待。加载失败时下次调用重试。
+        """
+        with self._cache_lock:
+            cached = cache.get(model_path)
+            if cached is None:
+                cached = cache[model_path] = _CachedValue()
+        with cached.lock:
+            if cached.value is None:
+                cached.value = load()
+            return cached.value
+
+    def _load(self, entry, model_path, weights_path, backend, step):
+        logger.info(f"正在加载模型{entry.name}: {weights_path}，推理后端: {backend.describe()}")
+        start = time.perf_counter()
+        with step("processor"):
+            processor = self.processor(model_path)
+        with step("weights"):
+            model = backend.load_weights(weights_path)
+        with step("prepare"):
+            model = backend.prepare(model)
+        with step("generation_config"):
+            generation_config = self.generation_config(model_path)
+        entry.processor, entry.generation_config, entry.backend = processor, generation_config, backend
+        entry.model = model
+        entry.load_seconds = round(time.perf_counter() - start, 3)
+        logger.info(f"模型{entry.name}加载成功，用时{entry.load_seconds}秒")
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refcount -= 1
+            if entry.refcount > 0 or self._models.get(entry.key) is not entry:
+                return
+            del self._models[entry.key]
+            shared = any(other.model_path == entry.model_path for other in self._models.values())
+        if not shared:
+            # processor上还挂着截图嵌入缓存，没有其他模型使用时一并释放
+            with self._cache_lock:
+                self._processors.pop(entry.model_path, None)
+                self._generation_configs.pop(entry.model_path, None)
+        if entry.loaded:
+            logger.info(f"模型{entry.name}已无引用，卸载")
+        device = entry.backend.device if entry.backend is not None else None
+        entry.model = None
+        entry.processor = None
+        gc.collect()
+        if device is not None and str(device).startswith("cuda"):
+            torch.cuda.empty_cache()
+
+
+# 全局模型注册表
+model_registry = ModelRegistry()
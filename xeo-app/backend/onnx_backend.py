@@ -0,0 +1,246 @@
+import os
+import json
+import glob
+import logging
+
+import numpy as np
+
+from lazy_import import lazy_import
+from inference_backend import InferenceBackend
+
+onnxruntime = lazy_import("onnxruntime", optional=True)
+torch = lazy_import("torch", optional=True)
+
+logger = logging.getLogger("onnx_backend")
+
+# ONNX张量类型 -> numpy类型
+_ONNX_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(int64)": np.int64,
+    "tensor(int32)": np.int32,
+}
+
+# 视觉模型的输入名 -> processor输出中可能对应的键
+_VISION_INPUT_ALIASES = {
+    "pixel_values": ("pixel_values", "input_image_embeds"),
+    "image_sizes": ("image_sizes",),
+    "image_attention_mask": ("image_attention_mask",),
+    "attention_mask": ("image_attention_mask",),
+}
+
+
+def _create_session(path, threads=None):
+    """创建CPU执行提供程序上的推理会话（开启全部图优化）"""
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads is not None:
+        options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def _empty_input(meta, batch_size):
+    """按输入的声明形状创建空张量：第一维为批大小，其余符号维度（如序列长度）为0"""
+    shape = [dim if isinstance(dim, int) else 0 for dim in meta.shape]
+    if shape and not isinstance(meta.shape[0], int):
+        shape[0] = batch_size
+    return np.zeros(shape, dtype=_ONNX_DTYPES[meta.type])
+
+
+def _to_numpy(value):
+    return value.cpu().numpy() if hasattr(value, "cpu") else np.asarray(value)
+
+
+class OnnxCausalLM:
+    """
+    ONNX Runtime上的自回归生成
+
+    模型目录中有genai_config.json时按其中的文件名加载解码器、嵌入和视觉模型
+    （Phi-4-multimodal-instruct-onnx、Phi-4-mini-instruct-onnx的目录格式），否则目录中只能有一个.onnx文件。
+    解码器的输入为input_ids或inputs_embeds、attention_mask、可选的position_ids和past_key_values.N.key/value，
+    输出logits和present.N.key/value。
+
+    generate()接受与transformers模型generate相同的processor输出和停止条件、logits处理器、streamer，
+    因此PhiIntentProcessor的单条、流式和批量调用不需要区分后端。只支持贪心解码。
+    会话在加载时创建，供所有请求复用；每步通过IO绑定把上一步的present直接作为past输入，
+    KV缓存不在numpy和ORT之间来回复制。
+    """
+
+    def __init__(self, model_dir, threads=None):
+        self.model_dir = model_dir
+        self.device = "cpu"
+        files = self._model_files(model_dir)
+        self.files = files
+        self.decoder = _create_session(files["decoder"], threads)
+        self.embedding = _create_session(files["embedding"], threads) if "embedding" in files else None
+        self.vision = _create_session(files["vision"], threads) if "vision" in files else None
+
+        inputs = {meta.name: meta for meta in self.decoder.get_inputs()}
+        self._decoder_inputs = inputs
+        self._past_names = [name for name in inputs if name.startswith("past_key_values.")]
+        self._present_names = [name.replace("past_key_values.", "present.", 1) for name in self._past_names]
+        self._uses_embeds = "inputs_embeds" in inputs
+        if self._uses_embeds and self.embedding is None:
+            raise ValueError(f"{model_dir}的解码器输入为inputs_embeds，但没有嵌入模型")
+        logger.info(f"ONNX模型已加载: {', '.join(os.path.basename(f) for f in files.values())}，"
+                    f"{len(self._past_names) // 2}层KV缓存")
+
+    @staticmethod
+    def _model_files(model_dir):
+        config_path = os.path.join(model_dir, "genai_config.json")
+        if os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)["model"]
+            return {
+                part: os.path.join(model_dir, config[part]["filename"])
+                for part in ("decoder", "embedding", "vision")
+                if part in config and "filename" in config[part]
+            }
+        candidates = glob.glob(os.path.join(model_dir, "*.onnx"))
+        if len(candidates) != 1:
+            raise ValueError(f"{model_dir}中没有genai_config.json，且.onnx文件不止一个（或没有）")
+        return {"decoder": candidates[0]}
+
+    def _image_features(self, inputs):
+        """用视觉模型编码processor输出的图像，没有图像时返回None"""
+        if self.vision is None:
+            return None
+        feeds = {}
+        for meta in self.vision.get_inputs():
+            key = next((k for k in _VISION_INPUT_ALIASES.get(meta.name, (meta.name,)) if k in inputs), None)
+            if key is None:
+                return None
+            feeds[meta.name] = _to_numpy(inputs[key]).astype(_ONNX_DTYPES[meta.type])
+        return self.vision.run(None, feeds)[0]
+
+    def _embed(self, input_ids, image_features=None):
+        feeds = {}
+        for meta in self.embedding.get_inputs():
+            if meta.name == "input_ids":
+                feeds[meta.name] = input_ids
+            elif meta.name == "image_features" and image_features is not None:
+                feeds[meta.name] = image_features.astype(_ONNX_DTYPES[meta.type])
+            else:
+                # 没有的模态（如音频）传空张量
+                feeds[meta.name] = _empty_input(meta, 0)
+        return self.embedding.run(None, feeds)[0]
+
+    def _cast(self, name, array):
+        """转换为解码器声明的输入类型（导出的模型可能使用int32）"""
+        return np.ascontiguousarray(array, dtype=_ONNX_DTYPES[self._decoder_inputs[name].type])
+
+    def _bind_step(self, binding, input_ids, attention_mask, position_ids, past, image_features=None):
+        """绑定一步解码的输入输出，past为上一步的present（OrtValue），第一步为None"""
+        binding.clear_binding_inputs()
+        binding.clear_binding_outputs()
+        if self._uses_embeds:
+            binding.bind_cpu_input("inputs_embeds", self._embed(input_ids, image_features))
+        else:
+            binding.bind_cpu_input("input_ids", self._cast("input_ids", input_ids))
+        binding.bind_cpu_input("attention_mask", self._cast("attention_mask", attention_mask))
+        if "position_ids" in self._decoder_inputs:
+            binding.bind_cpu_input("position_ids", self._cast("position_ids", position_ids))
+        for i, name in enumerate(self._past_names):
+            if past is None:
+                binding.bind_cpu_input(name, _empty_input(self._decoder_inputs[name], input_ids.shape[0]))
+            else:
+                binding.bind_ortvalue_input(name, past[i])
+        binding.bind_output("logits", "cpu")
+        for name in self._present_names:
+            binding.bind_output(name, "cpu")
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens=500, generation_config=None,
+                 stopping_criteria=None, logits_processor=None, streamer=None, past_key_values=None,
+                 **model_inputs):
+        """
+        贪心解码
+
+        Args:
+            input_ids, attention_mask: processor的输出（支持左填充的批量输入）
+            generation_config: 取其中的eos_token_id和pad_token_id
+            stopping_criteria, logits_processor, streamer: 同transformers的generate
+            model_inputs: processor的其他输出（如图像），num_logits_to_keep等generate参数会被忽略
+
+        Returns:
+            提示词加生成内容的token id（torch张量，已结束的行用pad_token_id填充）
+        """
+        if past_key_values is not None:
+            raise ValueError("ONNX后端不支持传入past_key_values（前缀KV缓存）")
+        eos_ids = getattr(generation_config, "eos_token_id", None)
+        eos_ids = set(eos_ids if isinstance(eos_ids, (list, tuple)) else [eos_ids] if eos_ids is not None else [])
+        pad_id = getattr(generation_config, "pad_token_id", None)
+        pad_id = pad_id if pad_id is not None else (min(eos_ids) if eos_ids else 0)
+
+        ids = _to_numpy(input_ids).astype(np.int64)
+        batch_size = ids.shape[0]
+        mask = (_to_numpy(attention_mask) if attention_mask is not None else np.ones_like(ids)).astype(np.int64)
+        # 左填充时位置从每行第一个有效token开始计数
+        positions = np.clip(np.cumsum(mask, axis=1) - 1, 0, None)
+        image_features = self._image_features(model_inputs)
+
+        sequences = torch.from_numpy(ids)
+        if streamer is not None:
+            streamer.put(sequences)
+        finished = np.zeros(batch_size, dtype=bool)
+        binding = self.decoder.io_binding()
+        step_ids, past = ids, None
+        for _ in range(max_new_tokens):
+            self._bind_step(binding, step_ids, mask, positions, past, image_features)
+            self.decoder.run_with_iobinding(binding)
+            outputs = binding.get_outputs()
+            past = outputs[1:]
+            image_features = None
+
+            scores = torch.from_numpy(outputs[0].numpy()[:, -1, :].astype(np.float32))
+            for processor in logits_processor or ():
+                scores = processor(sequences, scores)
+            next_ids = scores.argmax(dim=-1).numpy()
+            next_ids = np.where(finished, pad_id, next_ids)
+
+            sequences = torch.cat((sequences, torch.from_numpy(next_ids).unsqueeze(1)), dim=1)
+            if streamer is not None:
+                streamer.put(torch.from_numpy(next_ids))
+            finished |= np.isin(next_ids, list(eos_ids))
+            for criteria in stopping_criteria or ():
+                finished |= np.asarray(criteria(sequences, scores), dtype=bool)
+            if finished.all():
+                break
+
+            step_ids = next_ids[:, None]
+            mask = np.concatenate((mask, np.ones((batch_size, 1), dtype=np.int64)), axis=1)
+            positions = positions[:, -1:] + 1
+
+        if streamer is not None:
+            streamer.end()
+        return sequences
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    ONNX Runtime推理（CPU执行提供程序）
+
+    加载的不是transformers模型，前缀KV缓存、图像嵌入缓存等依赖模型内部结构的优化不可用。
+    权重精度和量化由导出的ONNX模型决定（如Phi-4的cpu-int4-rtn-block-32版本）。
+    """
+
+    name = "onnx"
+    transformers_model = False
+
+    def __init__(self, threads=None):
+        super().__init__("cpu")
+        if onnxruntime is None:
+            raise ImportError("未安装onnxruntime")
+        self.threads = threads
+
+    def load_weights(self, model_path):
+        if not model_path:
+            raise ValueError("未设置ONNX模型目录（PHI_ONNX_MODEL_PATH）")
+        return OnnxCausalLM(model_path, threads=self.threads)
+
+    def describe(self):
+        return {
+            **super().describe(),
+            "provider": "CPUExecutionProvider",
+            "threads": self.threads,
+            "onnxruntime": onnxruntime.__version__,
+        }
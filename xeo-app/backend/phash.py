@@ -0,0 +1,154 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("phash")
+
+
+def dhash(image, hash_size=8):
+    """
+    差值哈希(dHash)：比较缩略灰度图中水平相邻像素的亮度
+
+    Returns:
+        hash_size*hash_size位的整数
+    """
+    small = image.resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0).convert("L")
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _dct_matrix(n):
+    """n点DCT-II正交变换矩阵"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT_CACHE = {}
+
+
+def phash(image, hash_size=8, highfreq_factor=4):
+    """
+    感知哈希(pHash)：对缩略灰度图做二维DCT，取低频系数与中位数比较
+
+    Returns:
+        hash_size*hash_size位的整数
+    """
+    size = hash_size * highfreq_factor
+    small = image.resize((size, size), Image.BILINEAR, reducing_gap=2.0).convert("L")
+    pixels = np.asarray(small, dtype=np.float64)
+
+    dct = _DCT_CACHE.get(size)
+    if dct is None:
+        dct = _DCT_CACHE[size] = _dct_matrix(size)
+
+    low_freq = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    bits = low_freq > np.median(low_freq)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+HASH_FUNCTIONS = {"dhash": dhash, "phash": phash}
+
+
+def hamming_distance(a, b):
+    """两个哈希值之间的汉明距离"""
+    return bin(a ^ b).count("1")
+
+
+class PerceptualHashIndex:
+    """
+    感知哈希近邻索引（多索引哈希）
+
+    把hash_bits位哈希切成max_distance+1段，每段建一个精确匹配的字典。
+    由鸽巢原理，汉明距离不超过max_distance的两个哈希至少有一段完全相同，
+    因此查询只需检查各段桶里的候选，再逐个计算完整汉明距离。
+    """
+
+    def __init__(self, max_distance=4, hash_bits=64, max_entries=50000):
+        """
+        初始化索引
+
+        Args:
+            max_distance: 视为近似重复的最大汉明距离
+            hash_bits: 哈希位数
+            max_entries: 最多索引的条目数，超出后淘汰最早加入的条目
+        """
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.max_entries = max_entries
+
+        num_chunks = min(max_distance + 1, hash_bits)
+        base, extra = divmod(hash_bits, num_chunks)
+        self._chunks = []  # [(shift, mask), ...]
+        shift = 0
+        for i in range(num_chunks):
+            width = base + (1 if i < extra else 0)
+            self._chunks.append((shift, (1 << width) - 1))
+            shift += width
+
+        self._tables = [{} for _ in self._chunks]  # 段值 -> {key, ...}
+        self._entries = OrderedDict()  # key -> hash值
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, hash_value, key):
+        """加入（或更新）一个条目"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = hash_value
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                table.setdefault((hash_value >> shift) & mask, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def remove(self, key):
+        """删除条目（不存在时忽略）"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def nearest(self, hash_value, max_distance=None):
+        """
+        查找汉明距离最近的条目
+
+        Returns:
+            (key, distance)，没有距离不超过阈值的条目时返回None
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        max_distance = min(max_distance, self.max_distance)
+
+        best = None
+        with self._lock:
+            seen = set()
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                for key in table.get((hash_value >> shift) & mask, ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    distance = hamming_distance(hash_value, self._entries[key])
+                    if distance <= max_distance and (best is None or distance < best[1]):
+                        best = (key, distance)
+                        if distance == 0:
+                            return best
+        return best
+
+    def _remove(self, key):
+        hash_value = self._entries.pop(key)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            chunk = (hash_value >> shift) & mask
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del table[chunk]
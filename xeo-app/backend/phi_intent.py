@@ -1,75 +1,100 @@
 import os
 import io
-import base64
+import binascii
 import json
 import numpy as np
 from PIL import Image
 import time
 import tempfile
 import logging
-import re
+import threading
+from contextlib import nullcontext
+
+from batching import MicroBatchScheduler
+from ui_cache import UIAnalysisCache, image_digest, set_image_digest
+from phash import HASH_FUNCTIONS, PerceptualHashIndex
+from stopping import ToolCallStoppingCriteria, generation_info, trailing_sentence_end
+from constrained_decoding import ToolCallGrammar, GrammarTokenIndex, ToolCallLogitsProcessor
+from model_lifecycle import ModelLifecycle, READY, DEGRADED
+from lazy_import import lazy_import, module_available
+from prefix_cache import PrefixKVCache
+from model_registry import model_registry
+from embedding_cache import get_embedding_cache
+from gaze_crop import crop_gaze_regions, crop_gaze_images, to_pil_images
+from tool_registry import tool_registry
+from tool_call_parser import extract_tool_calls
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("phi_intent")
 
-# 检查依赖项是否安装
-try:
-    import torch
-    from transformers import AutoModelForCausalLM, AutoProcessor, GenerationConfig
-    PHI_MODEL_AVAILABLE = True
-except ImportError:
+# 检查依赖项是否安装（只查找不导入，transformers在加载模型时才真正导入）
+transformers = lazy_import("transformers", optional=True)
+PHI_MODEL_AVAILABLE = transformers is not None and module_available("torch")
+if not PHI_MODEL_AVAILABLE:
     logger.warning("未安装PyTorch或Transformers，将使用模拟模式")
-    PHI_MODEL_AVAILABLE = False
 
-# 定义XEO应用工具
-xeo_tools = [
-    {
-        "name": "connect_device",
-        "description": "连接或断开XEO应用中的设备",
-        "parameters": {
-            "device_id": {
-                "description": "当前页面能被控制的设备，可以是'xeo-about', 'apple-tv', 'playstation', 'nintendo'中的一个",
-                "type": "str",
-                "enum": ["xeo-about", "apple-tv", "playstation", "nintendo"]
-            }
-        }
-    },
-    {
-        "name": "adjust_setting",
-        "description": "调整XEO应用中的设置参数",
-        "parameters": {
-            "setting_id": {
-                "description": "当前页面能被控制的设置，可以是'volume', 'ipd', 'magic', 'seat', 'ventilation'中的一个",
-                "type": "str",
-                "enum": ["volume", "ipd", "magic", "seat", "ventilation"]
-            },
-            "value": {
-                "description": "设置的新值",
-                "type": "int"
-            }
-        }
-    }
-]
+# XEO应用工具定义（由tool_registry生成）
+xeo_tools = tool_registry.prompt_tools()
 
-# 全局变量，用于存储已加载的模型和处理器
-_MODEL = None
-_PROCESSOR = None
-_GENERATION_CONFIG = None
+def validate_tool_call(call):
+    """按工具注册表严格校验单个工具调用"""
+    return tool_registry.is_valid_call(call)
 
 class PhiIntentProcessor:
     """Phi4用户意图处理器"""
     
-    def __init__(self, model_path="/home/lab/phi4/phi4", use_local_model=True):
+    def __init__(self, model_path="/home/lab/phi4/phi4", use_local_model=True,
+                 max_batch_size=1, max_batch_wait_ms=10, ui_cache=None,
+                 phash_threshold=None, phash_method="dhash", stop_on_tool_call=False,
+                 use_prefix_cache=True, intent_mode="two_pass", use_embedding_cache=True,
+                 embedding_cache_max_bytes=256 * 1024 * 1024, crop_sink=None, constrained_tool_calls=False,
+                 load_mode="warm", fallback_to_mock=True, backend="auto", cpu_threads=None,
+                 quantization=None, onnx_model_path=None):
         """
         初始化用户意图处理器
         
         Args:
             model_path: Phi4模型路径
             use_local_model: 是否使用本地模型（如果为False，使用模拟模式）
+            max_batch_size: 微批处理的最大批大小，为1时不启用批处理
+            max_batch_wait_ms: 微批处理凑批的最大等待时间（毫秒）
+            ui_cache: UI分析结果缓存（见ui_cache.py），默认使用进程内LRU缓存
+            phash_threshold: 近似重复截图的最大汉明距离，为None时不启用感知哈希查找
+            phash_method: 感知哈希算法，'dhash'或'phash'
+            stop_on_tool_call: 工具模式下，完整的工具调用闭合后是否提前停止生成（调用处可单独覆盖）；
+                停止后不会再生成其后的工具调用（如"工具调用、一句话、第二个工具调用"会丢掉第二个），默认不启用
+            use_prefix_cache: 工具模式下是否复用系统提示前缀的KV缓存
+            intent_mode: 默认的意图推理模式，'two_pass'（先分析界面再推断意图）或'fused'（一次生成）
+            use_embedding_cache: 是否按截图摘要缓存预处理像素和图像嵌入（同一截图只编码一次）
+            embedding_cache_max_bytes: 像素缓存和图像嵌入缓存各自的字节预算
+            crop_sink: 眼动裁剪图像的异步保存（见crop_sink.py），None时裁剪图像只保留在内存中
+            constrained_tool_calls: 工具模式下是否按工具定义约束工具调用块内的解码，使生成的调用都能解析且通过校验
+            load_mode: 'warm'（创建后立即在后台加载模型）或'lazy'（第一次推理请求时才加载）
+            fallback_to_mock: 模型加载失败时是否降级为模拟模式（状态为degraded），否则状态为failed
+            backend: 推理后端，'cuda'、'cpu'、'onnx'或'auto'（有可用的GPU时使用cuda），见inference_backend.py
+            cpu_threads: CPU/ONNX后端的计算线程数，None时使用默认值
+            quantization: CPU后端的权重量化方式，None、'int8'或'int4'
+            onnx_model_path: ONNX模型目录（backend为'onnx'时使用，processor仍从model_path加载）
         """
         self.model_path = model_path
         self.use_local_model = use_local_model and PHI_MODEL_AVAILABLE
+        self.model = None
+        self.processor = None
+        self.generation_config = None
+        self.backend = None  # 模型加载时按backend_name创建（见inference_backend.py）
+        self.loaded_model = None  # 模型注册表中的共享实例（见model_registry.py）
+        self.backend_name = backend
+        self.backend_options = {"threads": cpu_threads, "quantization": quantization}
+        self.onnx_model_path = onnx_model_path
+        self.intent_mode = intent_mode
+        self.mock_latency = 1.5  # 模拟模式下每次generate的延迟（秒）
+        self._mock_device_lock = threading.Lock()  # 模拟单个加速器上generate的串行执行
+        
+        # 提前停止生成的配置与统计
+        self.stop_on_tool_call = stop_on_tool_call
+        self.early_stop_stats = {"tool_calls": 0, "early_stops": 0, "tokens_saved": 0}
+        self._stats_lock = threading.Lock()
         
         # 定义提示词结构
         self.system_prompt_start = '<|system|>'
@@ -80,77 +105,143 @@ class PhiIntentProcessor:
         self.assistant_prompt_end = '<|end|>'
         self.tool_call_start = '<|tool_call|>'
         self.tool_call_end = '<|/tool_call|>'
+        # 融合模式下界面分析部分的分隔标记
+        self.ui_analysis_start = '<ui_analysis>'
+        self.ui_analysis_end = '</ui_analysis>'
+        
+        # 存储UI分析缓存（以上传图像压缩字节的摘要为键）
+        self.ui_analysis_cache = ui_cache if ui_cache is not None else UIAnalysisCache()
+        
+        # 感知哈希索引：像素略有差异（滑块、时钟等）的同一页面复用已有分析结果
+        self.phash_index = None
+        self.phash_function = HASH_FUNCTIONS[phash_method]
+        self.phash_near_hits = 0
+        if phash_threshold is not None:
+            self.phash_index = PerceptualHashIndex(max_distance=phash_threshold)
         
-        # 存储UI分析缓存
-        self.ui_analysis_cache = {}
+        # 工具系统提示的前缀KV缓存（模型加载成功后创建）
+        self.use_prefix_cache = use_prefix_cache
+        self.prefix_cache = None
         
-        # 如果使用本地模型，加载模型
+        # 裁剪图像的异步保存
+        self.crop_sink = crop_sink
+        
+        # 截图预处理与视觉编码缓存（模型加载成功后创建）
+        self.use_embedding_cache = use_embedding_cache
+        self.embedding_cache_max_bytes = embedding_cache_max_bytes
+        self.embedding_cache = None
+        
+        # 工具调用约束解码的语法与词表索引（模型加载成功后创建）
+        self.constrained_tool_calls = constrained_tool_calls
+        self.tool_grammar_index = None
+        
+        # 模型在后台加载，加载状态和分步耗时见self.lifecycle
+        self.lifecycle = ModelLifecycle(
+            "Phi4模型",
+            self._load_model,
+            fallback_fn=self._fall_back_to_mock if fallback_to_mock else None
+        )
         if self.use_local_model:
-            self._load_model()
+            if load_mode == "warm":
+                self.lifecycle.start()
+        elif use_local_model:
+            # 要求使用本地模型但依赖未安装
+            self.lifecycle.mark(DEGRADED, "未安装PyTorch或Transformers")
+            logger.warning("未安装PyTorch或Transformers，使用模拟模式")
         else:
+            self.lifecycle.mark(READY)
             logger.info("使用模拟模式，不加载实际模型")
+        
+        # 动态微批处理调度器（并发请求合并为一次generate）
+        self.batch_scheduler = None
+        if max_batch_size > 1:
+            self.batch_scheduler = MicroBatchScheduler(
+                self.generate_batch,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_batch_wait_ms
+            )
+            self.batch_scheduler.start()
+    
+    def _load_model(self, lifecycle):
+        """从全局模型注册表取得模型（其他实例或工作流已加载时直接复用），在后台线程中执行，失败时抛出异常"""
+        loaded = model_registry.acquire(
+            self.model_path,
+            backend=self.backend_name,
+            onnx_model_path=self.onnx_model_path,
+            step=lifecycle.step,
+            **self.backend_options
+        )
+        self.loaded_model = loaded
+        self.processor = loaded.processor
+        self.model = loaded.model
+        self.generation_config = loaded.generation_config
+        self.backend = loaded.backend
+        with lifecycle.step("caches"):
+            self._init_prefix_cache()
+            self._init_embedding_cache()
+            self._init_tool_grammar()
     
-    def _load_model(self):
-        """加载Phi4模型（如果全局已加载则复用）"""
-        global _MODEL, _PROCESSOR, _GENERATION_CONFIG
+    def close(self):
+        """
+        释放对共享模型的引用（没有其他使用者时模型被卸载）
         
-        if _MODEL is not None and _PROCESSOR is not None and _GENERATION_CONFIG is not None:
-            logger.info("使用已加载的模型实例")
-            self.model = _MODEL
-            self.processor = _PROCESSOR
-            self.generation_config = _GENERATION_CONFIG
+        生命周期进入closed状态，就绪探针返回503，之后的推理请求得到ModelUnavailable。
+        """
+        self.lifecycle.close()
+        if self.batch_scheduler is not None:
+            self.batch_scheduler.stop()
+        model_registry.release(self.loaded_model)
+        self.loaded_model = None
+        self.model = None
+    
+    def _fall_back_to_mock(self):
+        """模型加载失败时降级为模拟模式"""
+        self.use_local_model = False
+    
+    def _init_prefix_cache(self):
+        """为当前加载的模型创建前缀KV缓存"""
+        if self.use_prefix_cache and not self.backend.transformers_model:
+            logger.info(f"{self.backend.name}后端不支持前缀KV缓存")
+        elif self.use_prefix_cache:
+            self.prefix_cache = PrefixKVCache(self.model, self.processor.tokenizer, device=self.backend.device)
+    
+    def _init_embedding_cache(self):
+        """在共享的processor和模型上安装截图嵌入缓存"""
+        if self.use_embedding_cache and not self.backend.transformers_model:
+            logger.info(f"{self.backend.name}后端不支持截图嵌入缓存")
+        elif self.use_embedding_cache:
+            self.embedding_cache = get_embedding_cache(
+                self.processor,
+                self.model,
+                max_pixel_bytes=self.embedding_cache_max_bytes,
+                max_embedding_bytes=self.embedding_cache_max_bytes
+            )
+    
+    def _init_tool_grammar(self):
+        """按工具注册表生成工具调用语法，并建立与当前tokenizer词表的索引"""
+        if not self.constrained_tool_calls:
             return
-            
-        try:
-            logger.info(f"正在加载模型: {self.model_path}")
-            _PROCESSOR = AutoProcessor.from_pretrained(self.model_path, trust_remote_code=True)
-            _MODEL = AutoModelForCausalLM.from_pretrained(
-                self.model_path, 
-                device_map="cuda", 
-                torch_dtype="auto", 
-                trust_remote_code=True,
-                _attn_implementation='flash_attention_2',
-            ).cuda()
-            _GENERATION_CONFIG = GenerationConfig.from_pretrained(self.model_path)
-            
-            # 保存引用
-            self.processor = _PROCESSOR
-            self.model = _MODEL
-            self.generation_config = _GENERATION_CONFIG
-            logger.info("模型加载成功")
-        except Exception as e:
-            logger.error(f"加载模型失败: {str(e)}")
-            self.use_local_model = False
+        grammar = ToolCallGrammar.from_registry(tool_registry, end_marker=self.tool_call_end)
+        self.tool_grammar_index = GrammarTokenIndex.from_tokenizer(grammar, self.processor.tokenizer)
+        logger.info(f"工具调用约束解码已启用: 语法状态{len(grammar)}个")
     
-    def call_model(self, prompt, image=None, max_new_tokens=500, use_tools=False):
-        """调用phi4模型进行推理"""
-        if not self.use_local_model:
-            # 模拟模式
-            logger.info(f"模拟模型调用: {prompt[:50]}...")
-            time.sleep(1.5)  # 模拟推理延迟
-            
-            # 生成模拟响应
-            if image:
-                if use_tools:
-                    return f'''{self.tool_call_start}[{{"name":"connect_device","arguments":{{"device_id":"apple-tv"}}}}]{self.tool_call_end}
-我可以帮您连接Apple TV设备。''', 1.5
-                return "这是一个XEO虚拟现实界面，显示了设备连接状态和各种设置选项。", 1.5
-            elif "手势" in prompt:
-                if use_tools:
-                    return f'''{self.tool_call_start}[{{"name":"adjust_setting","arguments":{{"setting_id":"volume","value":80}}}}]{self.tool_call_end}
-我已帮您将音量调整到80%。''', 1.5
-                return "根据用户的手势，可能想要调整设置或连接设备", 1.5
-            else:
-                return "我理解您的指令，请告诉我您想要执行的操作。", 1.5
-        
-        # 实际模型调用
-        logger.info(f"调用模型: {prompt[:50]}...")
-        
-        # 是否在系统提示中添加工具
-        if use_tools:
-            # 添加工具信息到提示词
-            tools_json = json.dumps(xeo_tools)
-            system_prompt = f'''{self.system_prompt_start}
+    def _image_context(self, images):
+        """声明本次generate使用的图像，使视觉编码结果可以按截图复用"""
+        if self.embedding_cache is None:
+            return nullcontext()
+        return self.embedding_cache.activate(images)
+    
+    def _build_prompt(self, prompt, use_tools=False):
+        """在工具模式下为提示词添加工具系统提示"""
+        if not use_tools:
+            return prompt
+        return f"{self._tool_system_prompt()}\n{prompt}"
+    
+    def _tool_system_prompt(self):
+        """工具模式的系统提示，所有工具模式请求共享这一前缀"""
+        # 添加工具信息到提示词
+        tools_json = tool_registry.prompt_json()
+        system_prompt = f'''{self.system_prompt_start}
 你是一个具备工具调用能力的XEO虚拟现实系统助手，可以控制设备连接和调整设置,你只需要返回工具调用的具体格式。
 
 可用函数：<|tool|>
@@ -162,23 +253,171 @@ class PhiIntentProcessor:
 2. 遵循提供的JSON架构，不要编造参数或值
 3. 确保选择正确匹配用户意图的函数
 {self.system_prompt_end}'''
-            prompt = f"{system_prompt}\n{prompt}"
+        return system_prompt
+    
+    def _mock_response(self, prompt, image=None, use_tools=False):
+        """生成模拟模式下的响应文本"""
+        if image:
+            if use_tools and self.ui_analysis_start in prompt:
+                return f'''{self.ui_analysis_start}这是一个XEO虚拟现实界面，显示了设备连接状态和各种设置选项。{self.ui_analysis_end}
+{self.tool_call_start}[{{"name":"connect_device","arguments":{{"device_id":"apple-tv"}}}}]{self.tool_call_end}
+我可以帮您连接Apple TV设备。'''
+            if use_tools:
+                return f'''{self.tool_call_start}[{{"name":"connect_device","arguments":{{"device_id":"apple-tv"}}}}]{self.tool_call_end}
+我可以帮您连接Apple TV设备。'''
+            return "这是一个XEO虚拟现实界面，显示了设备连接状态和各种设置选项。"
+        elif "手势" in prompt:
+            if use_tools:
+                return f'''{self.tool_call_start}[{{"name":"adjust_setting","arguments":{{"setting_id":"volume","value":80}}}}]{self.tool_call_end}
+我已帮您将音量调整到80%。'''
+            return "根据用户的手势，可能想要调整设置或连接设备"
+        else:
+            return "我理解您的指令，请告诉我您想要执行的操作。"
+    
+    def call_model(self, prompt, image=None, max_new_tokens=500, use_tools=False,
+                   stop_on_tool_call=None, generation_stats=None):
+        """
+        调用phi4模型进行推理
+        
+        Args:
+            stop_on_tool_call: 工具模式下是否在工具调用完成后提前停止，None时使用实例默认配置
+            generation_stats: 可选的字典，调用后填入本次生成的token使用情况（含节省的token数）
+        """
+        if stop_on_tool_call is None:
+            stop_on_tool_call = self.stop_on_tool_call
+        stop_on_tool_call = stop_on_tool_call and use_tools
+        # 模型仍在后台加载时等待加载结束，加载失败时抛出ModelUnavailable
+        self.lifecycle.ensure()
+        
+        if self.batch_scheduler is not None:
+            # 通过微批处理调度器排队，与其他并发请求合并推理
+            request = self.batch_scheduler.submit_request(
+                prompt, image, max_new_tokens, use_tools, stop_on_tool_call=stop_on_tool_call
+            )
+            timing = request.timing
+            logger.info(f"批处理响应: 批大小={timing['batch_size']}, "
+                        f"排队{timing['queue_wait']:.2f}秒, 推理{timing['inference']:.2f}秒")
+            if generation_stats is not None:
+                generation_stats.update(request.generation_info)
+            return request.response, timing["total"]
+        
+        info = {}
+        response, response_time = self._generate(prompt, image, max_new_tokens, use_tools, stop_on_tool_call, info)
+        if generation_stats is not None:
+            generation_stats.update(info)
+        return response, response_time
+    
+    def is_complete_tool_call(self, block_text):
+        """判断工具调用块是否为语法完整且符合工具定义的JSON"""
+        try:
+            data = json.loads(block_text.strip())
+        except json.JSONDecodeError:
+            return False
+        calls = data if isinstance(data, list) else [data]
+        return len(calls) > 0 and all(validate_tool_call(call) for call in calls)
+    
+    def _truncate_after_tool_call(self, response):
+        """
+        模拟模式下的提前停止：截掉第一个有效工具调用块之后第一句话以后的文本（同ToolCallStoppingCriteria）
+        
+        Returns:
+            (截断后的文本, 是否截断)
+        """
+        end = response.find(self.tool_call_end)
+        while end >= 0:
+            start = response.rfind(self.tool_call_start, 0, end)
+            if start >= 0 and self.is_complete_tool_call(response[start + len(self.tool_call_start):end]):
+                cut = end + len(self.tool_call_end)
+                sentence_end = trailing_sentence_end(response[cut:], self.tool_call_start)
+                if sentence_end is not None:
+                    cut += sentence_end
+                    return response[:cut], cut < len(response)
+                if self.tool_call_start not in response[cut:]:
+                    return response, False
+            end = response.find(self.tool_call_end, end + 1)
+        return response, False
+    
+    def _record_generation(self, info, use_tools):
+        """累计工具模式下提前停止的统计"""
+        if not use_tools:
+            return
+        with self._stats_lock:
+            self.early_stop_stats["tool_calls"] += 1
+            if info["stopped_early"]:
+                self.early_stop_stats["early_stops"] += 1
+                self.early_stop_stats["tokens_saved"] += info["tokens_saved"]
+        if info["stopped_early"]:
+            logger.info(f"工具调用已完成，提前停止生成，节省{info['tokens_saved']}个token")
+    
+    def _mock_generation(self, prompt, image, max_new_tokens, use_tools, stop_on_tool_call):
+        """
+        生成模拟响应及其token统计
+        
+        模拟模式没有tokenizer，按字符数近似token数。
+        """
+        response = self._mock_response(prompt, image, use_tools)
+        full_length = len(response)
+        stopped = False
+        if stop_on_tool_call:
+            response, stopped = self._truncate_after_tool_call(response)
+        
+        generated = min(len(response), max_new_tokens)
+        info = generation_info(generated, max_new_tokens, stopped)
+        if stopped:
+            info["tokens_saved"] = min(full_length, max_new_tokens) - generated
+        self._record_generation(info, use_tools)
+        return response, info
+    
+    def _generate(self, prompt, image=None, max_new_tokens=500, use_tools=False,
+                  stop_on_tool_call=False, info=None):
+        """对单个提示词执行一次generate，info字典会填入token使用情况"""
+        if info is None:
+            info = {}
+        
+        if not self.use_local_model:
+            # 模拟模式
+            logger.info(f"模拟模型调用: {prompt[:50]}...")
+            with self._mock_device_lock:
+                time.sleep(self.mock_latency)  # 模拟推理延迟
+            response, mock_info = self._mock_generation(prompt, image, max_new_tokens, use_tools, stop_on_tool_call)
+            info.update(mock_info)
+            return response, self.mock_latency
+        
+        # 实际模型调用
+        logger.info(f"调用模型: {prompt[:50]}...")
+        
+        # 是否在系统提示中添加工具
+        prompt = self._build_prompt(prompt, use_tools)
         
         # 处理输入
         inputs = self.processor(
             text=prompt,
             images=image,
             return_tensors='pt'
-        ).to('cuda:0')
+        ).to(self.backend.device)
+        
+        # 工具调用完成后提前停止
+        criteria = None
+        if stop_on_tool_call:
+            criteria = self._tool_call_stopping_criteria(inputs['input_ids'].shape[1])
+        
+        # 工具调用块内的约束解码
+        logits_processor = None
+        if use_tools:
+            logits_processor = self._tool_call_logits_processor(inputs['input_ids'].shape[1])
         
         # 计时并生成响应
         start_time = time.time()
-        generate_ids = self.model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            generation_config=self.generation_config,
-            num_logits_to_keep=1,
-        )
+        with self._image_context(image):
+            generate_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                generation_config=self.generation_config,
+                num_logits_to_keep=1,
+                stopping_criteria=transformers.StoppingCriteriaList([criteria]) if criteria else None,
+                logits_processor=logits_processor,
+                **self._prefix_cache_kwargs(inputs, use_tools, image, info),
+            )
         generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
         response = self.processor.batch_decode(
             generate_ids,
@@ -190,24 +429,275 @@ class PhiIntentProcessor:
         response_time = end_time - start_time
         logger.info(f"响应用时: {response_time:.2f}秒")
         
+        stopped = criteria is not None and 0 in criteria.stop_lengths
+        info.update(generation_info(generate_ids.shape[1], max_new_tokens, stopped))
+        self._record_generation(info, use_tools)
+        
         return response, response_time
     
+    def _prefix_cache_kwargs(self, inputs, use_tools, image=None, info=None):
+        """
+        工具模式下复用系统提示前缀的KV缓存，返回需要传给generate的额外参数
+        
+        前缀KV是纯文本模式下计算的，带图像的请求使用视觉LoRA，不复用。
+        """
+        if not use_tools or image is not None or self.prefix_cache is None:
+            return {}
+        
+        past_key_values, time_saved = self.prefix_cache.lookup(self._tool_system_prompt(), inputs['input_ids'])
+        if info is not None:
+            info["prefill_time_saved"] = time_saved
+        if past_key_values is None:
+            return {}
+        return {"past_key_values": past_key_values}
+    
+    def _tool_call_stopping_criteria(self, prompt_length, enabled_rows=None):
+        """创建工具调用完成即停止的停止条件"""
+        return ToolCallStoppingCriteria(
+            self.processor.tokenizer,
+            prompt_length,
+            self.is_complete_tool_call,
+            start_marker=self.tool_call_start,
+            end_marker=self.tool_call_end,
+            enabled_rows=enabled_rows
+        )
+    
+    def _tool_call_logits_processor(self, prompt_length, enabled_rows=None):
+        """创建工具调用块内的约束解码处理器，未启用约束解码时返回None"""
+        if self.tool_grammar_index is None:
+            return None
+        return transformers.LogitsProcessorList([ToolCallLogitsProcessor(
+            self.tool_grammar_index,
+            prompt_length,
+            start_marker=self.tool_call_start,
+            enabled_rows=enabled_rows
+        )])
+    
+    def call_model_stream(self, prompt, image=None, max_new_tokens=500, use_tools=False,
+                          stop_on_tool_call=None, chunk_size=4):
+        """
+        流式调用phi4模型，逐段产出生成的文本
+        
+        流式请求需要独占一次generate，不经过微批处理调度器。
+        
+        Args:
+            stop_on_tool_call: 同call_model
+            chunk_size: 模拟模式下每段输出的字符数
+        
+        Yields:
+            新生成的文本片段
+        """
+        if stop_on_tool_call is None:
+            stop_on_tool_call = self.stop_on_tool_call
+        stop_on_tool_call = stop_on_tool_call and use_tools
+        self.lifecycle.ensure()
+        
+        if not self.use_local_model:
+            # 模拟模式：把模拟响应切成小段，推理延迟均摊到各段
+            logger.info(f"模拟流式调用: {prompt[:50]}...")
+            response, _ = self._mock_generation(prompt, image, max_new_tokens, use_tools, stop_on_tool_call)
+            chunks = [response[i:i + chunk_size] for i in range(0, len(response), chunk_size)]
+            for chunk in chunks:
+                time.sleep(self.mock_latency / len(chunks))
+                yield chunk
+            return
+        
+        logger.info(f"流式调用模型: {prompt[:50]}...")
+        prompt = self._build_prompt(prompt, use_tools)
+        inputs = self.processor(
+            text=prompt,
+            images=image,
+            return_tensors='pt'
+        ).to(self.backend.device)
+        
+        streamer = transformers.TextIteratorStreamer(
+            self.processor.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False
+        )
+        criteria = None
+        if stop_on_tool_call:
+            criteria = self._tool_call_stopping_criteria(inputs['input_ids'].shape[1])
+        logits_processor = None
+        if use_tools:
+            logits_processor = self._tool_call_logits_processor(inputs['input_ids'].shape[1])
+        generate_kwargs = dict(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            generation_config=self.generation_config,
+            num_logits_to_keep=1,
+            streamer=streamer,
+            stopping_criteria=transformers.StoppingCriteriaList([criteria]) if criteria else None,
+            logits_processor=logits_processor,
+            **self._prefix_cache_kwargs(inputs, use_tools, image),
+        )
+        
+        # generate在后台线程运行，streamer在当前线程逐段取出解码文本
+        start_time = time.time()
+        
+        def run_generate():
+            with self._image_context(image):
+                self.model.generate(**generate_kwargs)
+        
+        thread = threading.Thread(target=run_generate, daemon=True)
+        thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        thread.join()
+        logger.info(f"流式响应用时: {time.time() - start_time:.2f}秒")
+        
+        if criteria is not None:
+            stopped = 0 in criteria.stop_lengths
+            generated = criteria.stop_lengths.get(0, max_new_tokens)
+            self._record_generation(generation_info(generated, max_new_tokens, stopped), use_tools)
+    
+    def generate_batch(self, requests):
+        """
+        批量推理，供微批处理调度器调用
+        
+        带图像和纯文本的请求分成两组，每组执行一次填充后的generate。
+        
+        Args:
+            requests: BatchRequest列表（需有prompt、image、max_new_tokens、use_tools、
+                stop_on_tool_call属性），token使用情况写入各自的generation_info
+        
+        Returns:
+            与requests顺序一致的[(response, response_time), ...]
+        """
+        if len(requests) == 1:
+            r = requests[0]
+            return [self._generate(r.prompt, r.image, r.max_new_tokens, r.use_tools,
+                                   r.stop_on_tool_call, r.generation_info)]
+        
+        if not self.use_local_model:
+            # 模拟模式：整批只产生一次推理延迟
+            logger.info(f"模拟批量调用: {len(requests)}个请求")
+            with self._mock_device_lock:
+                time.sleep(self.mock_latency)
+            results = []
+            for r in requests:
+                response, info = self._mock_generation(
+                    r.prompt, r.image, r.max_new_tokens, r.use_tools, r.stop_on_tool_call
+                )
+                r.generation_info.update(info)
+                results.append((response, self.mock_latency))
+            return results
+        
+        results = [None] * len(requests)
+        image_group = [i for i, r in enumerate(requests) if r.image is not None]
+        text_group = [i for i, r in enumerate(requests) if r.image is None]
+        
+        for group in (image_group, text_group):
+            if not group:
+                continue
+            group_requests = [requests[i] for i in group]
+            for i, result in zip(group, self._generate_padded(group_requests)):
+                results[i] = result
+        
+        return results
+    
+    def _generate_padded(self, requests):
+        """对同类请求执行一次左填充的批量generate"""
+        logger.info(f"批量调用模型: {len(requests)}个请求")
+        
+        prompts = [self._build_prompt(r.prompt, r.use_tools) for r in requests]
+        images = [r.image for r in requests if r.image is not None]
+        
+        # 生成式模型批量推理需要左填充，保证新token紧接在各自提示词之后
+        self.processor.tokenizer.padding_side = "left"
+        inputs = self.processor(
+            text=prompts,
+            images=images or None,
+            return_tensors='pt',
+            padding=True
+        ).to(self.backend.device)
+        
+        # 按行启用提前停止，整批在所有行都停止（或达到上限）后结束
+        criteria = None
+        enabled_rows = [r.stop_on_tool_call for r in requests]
+        if any(enabled_rows):
+            criteria = self._tool_call_stopping_criteria(inputs['input_ids'].shape[1], enabled_rows)
+        
+        # 只约束工具模式的行
+        logits_processor = None
+        tool_rows = [r.use_tools for r in requests]
+        if any(tool_rows):
+            logits_processor = self._tool_call_logits_processor(inputs['input_ids'].shape[1], tool_rows)
+        
+        start_time = time.time()
+        with self._image_context(images or None):
+            generate_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max(r.max_new_tokens for r in requests),
+                generation_config=self.generation_config,
+                num_logits_to_keep=1,
+                stopping_criteria=transformers.StoppingCriteriaList([criteria]) if criteria else None,
+                logits_processor=logits_processor,
+            )
+        generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
+        
+        # 按各请求自身的max_new_tokens截断后再解码
+        responses = [
+            self.processor.decode(
+                row[:r.max_new_tokens],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
+            )
+            for row, r in zip(generate_ids, requests)
+        ]
+        response_time = time.time() - start_time
+        logger.info(f"批量响应用时: {response_time:.2f}秒")
+        
+        for row, r in enumerate(requests):
+            stop_lengths = criteria.stop_lengths if criteria is not None else {}
+            generated = min(stop_lengths.get(row, generate_ids.shape[1]), r.max_new_tokens)
+            r.generation_info.update(generation_info(generated, r.max_new_tokens, row in stop_lengths))
+            self._record_generation(r.generation_info, r.use_tools)
+        
+        return [(response, response_time) for response in responses]
+    
     def process_base64_image(self, base64_image):
         """处理Base64编码的图像"""
         try:
-            # 去除可能的data URL前缀
-            if ',' in base64_image:
-                base64_image = base64_image.split(',')[1]
+            # 去除可能的data URL前缀（用内存视图跳过前缀，不复制整段数据）
+            encoded = memoryview(base64_image.encode('ascii'))
+            prefix_end = base64_image.find(',', 0, 128)
+            if prefix_end >= 0:
+                encoded = encoded[prefix_end + 1:]
             
             # 解码Base64数据
-            image_data = base64.b64decode(base64_image)
+            image_data = binascii.a2b_base64(encoded)
+        except Exception as e:
+            logger.error(f"处理Base64图像时出错: {str(e)}")
+            return None
+        
+        return self.process_image_bytes(image_data)
+    
+    def process_image_bytes(self, image_data):
+        """
+        处理原始图像字节（multipart或二进制上传）
+        
+        bytes对象交给BytesIO和摘要计算时都不会被复制，PIL直接从这份数据解码。
+        """
+        try:
+            if not isinstance(image_data, bytes):
+                image_data = bytes(image_data)
             image = Image.open(io.BytesIO(image_data))
             
+            # 在解码像素前记录压缩字节的摘要，作为缓存键
+            set_image_digest(image, image_data)
+            
             return image
         except Exception as e:
-            logger.error(f"处理Base64图像时出错: {str(e)}")
+            logger.error(f"处理图像数据时出错: {str(e)}")
             return None
     
+    def image_digest(self, image):
+        """获取图像的稳定内容摘要（见ui_cache.image_digest）"""
+        return image_digest(image)
+    
     def crop_image_at_gaze(self, image, coordinates, radius):
         """根据眼动坐标和半径裁剪图像"""
         width, height = image.size
@@ -225,19 +715,38 @@ class PhiIntentProcessor:
         # 裁剪图像
         cropped = image.crop((left, top, right, bottom))
         
-        # 创建保存目录
-        save_dir = os.path.join(os.path.dirname(__file__), "cropped_images")
-        os.makedirs(save_dir, exist_ok=True)
+        # 交给后台线程保存，编码和写盘不计入请求延迟
+        if self.crop_sink is not None:
+            self.crop_sink.submit(cropped, x_pixel, y_pixel)
         
-        # 生成文件名并保存
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        filename = f"gaze_crop_{timestamp}_{x_pixel}_{y_pixel}.png"
-        save_path = os.path.join(save_dir, filename)
-        cropped.save(save_path)
+        return cropped
+    
+    def crop_gaze_regions(self, image, gaze_data, size=None):
+        """
+        批量裁剪多个眼动关注区域（见gaze_crop.py）
         
-        logger.info(f"保存裁剪图像到: {save_path}")
+        裁剪框向量化计算，不转换整张截图。
         
-        return cropped
+        Args:
+            gaze_data: 单个眼动点或眼动点列表
+            size: None时返回各区域的PIL图像；否则返回缩放到该尺寸后堆叠的数组
+        
+        Returns:
+            PIL图像列表或(N, size, size, 3)数组
+        """
+        if size is None:
+            crops, boxes = crop_gaze_images(image, gaze_data)
+            images = crops
+        else:
+            crops, boxes = crop_gaze_regions(image, gaze_data, size)
+            images = to_pil_images(crops) if self.crop_sink is not None else ()
+        logger.info(f"裁剪{len(boxes)}个眼动点: {boxes.tolist()}")
+        
+        # 交给后台线程保存，编码和写盘不计入请求延迟
+        if self.crop_sink is not None:
+            for crop, (left, top, right, bottom) in zip(images, boxes):
+                self.crop_sink.submit(crop, int(left + right) // 2, int(top + bottom) // 2)
+        return crops
     
     def analyze_ui(self, image_data):
         """
@@ -266,11 +775,9 @@ class PhiIntentProcessor:
         if not image:
             return {"error": "无法处理图像"}
         
-        # 使用图像指纹作为缓存键
-        image_key = hash(image.tobytes())
-        if image_key in self.ui_analysis_cache:
-            logger.info("使用缓存的UI分析结果")
-            return self.ui_analysis_cache[image_key]
+        cached, hash_value = self.lookup_ui_analysis(image)
+        if cached is not None:
+            return cached
         
         # 构建提示词
         prompt = f'''{self.user_prompt}<|image_1|>
@@ -289,65 +796,106 @@ class PhiIntentProcessor:
         }
         
         # 缓存结果
-        self.ui_analysis_cache[image_key] = result
+        self._store_ui_analysis(image, result, hash_value)
         
         return result
     
+    def lookup_ui_analysis(self, image):
+        """
+        查找图像已缓存的UI分析结果
+        
+        Returns:
+            (cached, hash_value): 缓存结果（未命中为None），以及计算过的感知哈希（未启用为None），
+            后者用于写入缓存时避免重复计算
+        """
+        # 使用图像内容摘要作为缓存键
+        image_key = self.image_digest(image)
+        cached = self.ui_analysis_cache.get(image_key)
+        if cached is not None:
+            logger.info("使用缓存的UI分析结果")
+            return cached, None
+        
+        # 精确匹配未命中时，查找视觉上等价的已分析页面
+        hash_value = None
+        if self.phash_index is not None:
+            hash_value = self.phash_function(image)
+            cached = self._lookup_near_duplicate(hash_value, image_key)
+        return cached, hash_value
+    
+    def _store_ui_analysis(self, image, result, hash_value=None):
+        """写入UI分析缓存及感知哈希索引"""
+        image_key = self.image_digest(image)
+        self.ui_analysis_cache.put(image_key, result)
+        if self.phash_index is not None:
+            if hash_value is None:
+                hash_value = self.phash_function(image)
+            self.phash_index.add(hash_value, image_key)
+    
+    def _lookup_near_duplicate(self, hash_value, image_key):
+        """在感知哈希索引中查找近似重复的截图，并返回其缓存的分析结果"""
+        match = self.phash_index.nearest(hash_value)
+        if match is None:
+            return None
+        
+        near_key, distance = match
+        cached = self.ui_analysis_cache.get(near_key, count=False)
+        if cached is None:
+            # 对应结果已被缓存淘汰，索引条目失效
+            self.phash_index.remove(near_key)
+            return None
+        
+        logger.info(f"使用近似重复页面的缓存UI分析结果（汉明距离: {distance}）")
+        self.phash_near_hits += 1
+        self.ui_analysis_cache.put(image_key, cached)
+        self.phash_index.add(hash_value, image_key)
+        return cached
+    
     def parse_tool_calls(self, response_text):
         """从响应文本中解析工具调用"""
-        tool_calls = []
-        
-        # 匹配工具调用
-        pattern = re.compile(f'{re.escape(self.tool_call_start)}(.*?){re.escape(self.tool_call_end)}', re.DOTALL)
-        matches = pattern.findall(response_text)
+        return self.split_tool_calls(response_text)[1]
+    
+    def split_tool_calls(self, response_text):
+        """
+        把响应拆分为工具调用之外的文本和通过校验的工具调用
         
-        if not matches:
+        Returns:
+            (text, tool_calls)
+        """
+        text, tool_calls = extract_tool_calls(response_text)
+        if not tool_calls:
             logger.warning("未找到工具调用格式")
-            return []
-        
-        for match in matches:
-            try:
-                # 尝试解析JSON
-                json_str = match.strip()
-                # 处理非标准JSON格式，如[{"name": "tool_name"}]
-                if json_str.startswith('[') and json_str.endswith(']'):
-                    json_data = json.loads(json_str)
-                    if isinstance(json_data, list) and len(json_data) > 0:
-                        for item in json_data:
-                            tool_calls.append(item)
-                else:
-                    # 尝试作为单个对象解析
-                    json_data = json.loads(json_str)
-                    if isinstance(json_data, dict):
-                        tool_calls.append(json_data)
-            except json.JSONDecodeError as e:
-                logger.warning(f"无法解析工具调用JSON: {e}\n原始文本: {match}")
-                continue
-        
-        # 验证工具调用格式
+        return text.strip(), self.filter_tool_calls(tool_calls)
+    
+    def filter_tool_calls(self, tool_calls):
+        """只保留注册表中存在的工具调用"""
         valid_calls = []
         for call in tool_calls:
-            if "name" in call and call["name"] in [tool["name"] for tool in xeo_tools]:
+            if isinstance(call, dict) and call.get("name") in tool_registry:
                 valid_calls.append(call)
             else:
                 logger.warning(f"无效的工具调用: {call}")
-        
         return valid_calls
     
-    def infer_intent(self, image_data, gesture, gaze_data=None):
+    def infer_intent(self, image_data, gesture, gaze_data=None, stop_on_tool_call=None, mode=None):
         """
         完整的意图推理流程
         
         Args:
             image_data: 图像数据（文件对象或Base64字符串）
             gesture: 用户手势 (如 'pinch', 'thumb up')
-            gaze_data: 可选的眼动数据 {'x': 0.5, 'y': 0.5, 'radius': 0.1}
+            gaze_data: 可选的眼动数据 {'x': 0.5, 'y': 0.5, 'radius': 0.1}，或多个这样的注视点组成的列表
+            stop_on_tool_call: 意图调用是否在工具调用完成后提前停止，None时使用实例默认配置
+            mode: 'two_pass'先调用analyze_ui再推断意图（两次视觉推理）；
+                'fused'在一次生成中同时输出界面分析和工具调用。None时使用实例默认配置
         
         Returns:
             包含分析结果的字典
         """
         start_time = time.time()
-        logger.info(f"开始处理手势: {gesture}")
+        mode = mode or self.intent_mode
+        if mode not in ("two_pass", "fused"):
+            return {"error": f"不支持的意图推理模式: {mode}"}
+        logger.info(f"开始处理手势: {gesture}（{mode}模式）")
         
         # 处理输入图像
         if isinstance(image_data, str) and image_data.startswith(('data:image', 'http')):
@@ -366,55 +914,44 @@ class PhiIntentProcessor:
         if not image:
             return {"error": "无法处理图像"}
         
-        # 步骤1: 获取UI整体分析
-        ui_analysis = self.analyze_ui(image)
-        if "error" in ui_analysis:
-            return ui_analysis
-        
-        # 裁剪眼动关注区域的图像（如果有眼动数据）
-        cropped_image = None
-        if gaze_data:
-            logger.info(f"裁剪眼动点: 坐标({gaze_data['x']:.2f}, {gaze_data['y']:.2f})")
-            cropped_image = self.crop_image_at_gaze(
-                image, 
-                {"x": gaze_data['x'], "y": gaze_data['y']}, 
-                gaze_data.get('radius', 0.1)
-            )
-        
-        # 步骤2: 根据手势和UI分析推断意图，使用工具调用
-        logger.info(f"推断意图")
-        
-        # 构建提示词
-        prompt = f'''{self.user_prompt}<|image_1|>
-当前界面分析: {ui_analysis['analysis']}
-
-用户手势: {gesture}
-'''
-        
-        # 添加眼动信息（如果有）
-        if gaze_data:
-            prompt += f'''
-用户视线位置: 
-- X坐标: {gaze_data['x']:.2f}（屏幕范围0-1，0是左边缘，1是右边缘）
-- Y坐标: {gaze_data['y']:.2f}（屏幕范围0-1，0是上边缘，1是下边缘）
-'''
-        
-        prompt += f'''
-根据界面分析和用户手势（及视线位置），推断用户可能想要执行的操作，并使用合适的工具执行该操作。
-{self.user_prompt_end}
-{self.assistant_prompt}'''
+        # 步骤1: 获取UI整体分析（融合模式下只复用缓存，未命中时与意图一起生成）
+        hash_value = None
+        if mode == "fused":
+            ui_analysis, hash_value = self.lookup_ui_analysis(image)
+        else:
+            ui_analysis = self.analyze_ui(image)
+            if "error" in ui_analysis:
+                return ui_analysis
         
-        # 调用模型（使用工具）
-        intent_response, intent_time = self.call_model(prompt, image, max_new_tokens=400, use_tools=True)
+        # 裁剪眼动关注区域的图像（有眼动数据且配置了保存裁剪图像时；裁剪结果不参与推理）
+        if gaze_data and self.crop_sink is not None:
+            self.crop_gaze_regions(image, gaze_data)
         
-        # 解析工具调用
-        tool_calls = self.parse_tool_calls(intent_response)
+        # 步骤2: 根据手势和UI分析推断意图，使用工具调用
+        intent_generation = {}
+        if ui_analysis is not None:
+            logger.info(f"推断意图")
+            prompt = self._build_intent_prompt(gesture, gaze_data, ui_analysis["analysis"])
+            intent_response, intent_time = self.call_model(
+                prompt, image, max_new_tokens=400, use_tools=True,
+                stop_on_tool_call=stop_on_tool_call, generation_stats=intent_generation
+            )
+            ui_analysis_time = ui_analysis.get("response_time", 0)
+        else:
+            logger.info(f"融合推理界面分析和意图")
+            prompt = self._build_intent_prompt(gesture, gaze_data)
+            fused_response, intent_time = self.call_model(
+                prompt, image, max_new_tokens=656, use_tools=True,
+                stop_on_tool_call=stop_on_tool_call, generation_stats=intent_generation
+            )
+            analysis, intent_response = self._split_fused_response(fused_response)
+            ui_analysis = {"analysis": analysis, "response_time": intent_time}
+            ui_analysis_time = 0
+            if analysis:
+                self._store_ui_analysis(image, ui_analysis, hash_value)
         
-        # 提取意图描述（工具调用之外的文本）
-        intent_description = intent_response
-        for call in tool_calls:
-            call_json = json.dumps(call)
-            intent_description = intent_description.replace(f"{self.tool_call_start}[{call_json}]{self.tool_call_end}", "").strip()
+        # 解析工具调用，意图描述为工具调用块之外的文本
+        intent_description, tool_calls = self.split_tool_calls(intent_response)
         
         # 计算总时间
         total_time = time.time() - start_time
@@ -426,24 +963,89 @@ class PhiIntentProcessor:
             "gaze_data": gaze_data,
             "intent_description": intent_description.strip(),
             "tool_calls": tool_calls,
+            "mode": mode,
+            "generation": intent_generation,
             "response_time": {
-                "ui_analysis": ui_analysis.get("response_time", 0),
+                "ui_analysis": ui_analysis_time,
                 "intent": intent_time,
                 "total": total_time
             }
         }
         
         return result
+    
+    def _build_intent_prompt(self, gesture, gaze_data=None, ui_analysis=None):
+        """
+        构建意图推理提示词
+        
+        提供ui_analysis时为两段式的第二步；否则为融合模式，
+        要求模型先在分隔标记内输出界面分析，再输出工具调用。
+        """
+        if ui_analysis is not None:
+            prompt = f'''{self.user_prompt}<|image_1|>
+当前界面分析: {ui_analysis}
+
+用户手势: {gesture}
+'''
+        else:
+            prompt = f'''{self.user_prompt}<|image_1|>
+用户手势: {gesture}
+'''
+        
+        # 添加眼动信息（如果有）
+        if isinstance(gaze_data, dict):
+            prompt += f'''
+用户视线位置: 
+- X坐标: {gaze_data['x']:.2f}（屏幕范围0-1，0是左边缘，1是右边缘）
+- Y坐标: {gaze_data['y']:.2f}（屏幕范围0-1，0是上边缘，1是下边缘）
+'''
+        elif gaze_data:
+            prompt += "\n用户视线注视点（坐标范围0-1，(0, 0)是左上角）: \n"
+            for i, point in enumerate(gaze_data):
+                coordinates = point.get('coordinates', point)
+                prompt += f"- 注视点{i + 1}: X={coordinates['x']:.2f}, Y={coordinates['y']:.2f}\n"
+        
+        if ui_analysis is not None:
+            prompt += f'''
+根据界面分析和用户手势（及视线位置），推断用户可能想要执行的操作，并使用合适的工具执行该操作。
+{self.user_prompt_end}
+{self.assistant_prompt}'''
+        else:
+            prompt += f'''
+请按顺序完成以下两步:
+1. 分析界面: 详细描述当前页面的功能、主要UI元素及可能的交互方式，并用{self.ui_analysis_start}和{self.ui_analysis_end}包裹。
+2. 根据界面分析和用户手势（及视线位置），推断用户可能想要执行的操作，并使用合适的工具执行该操作。
+{self.user_prompt_end}
+{self.assistant_prompt}'''
+        return prompt
+    
+    def _split_fused_response(self, response):
+        """
+        拆分融合模式的输出
+        
+        Returns:
+            (界面分析文本, 其余部分)；没有找到分隔标记时界面分析为空字符串
+        """
+        start = response.find(self.ui_analysis_start)
+        end = response.find(self.ui_analysis_end, start + 1) if start >= 0 else -1
+        if start < 0 or end < 0:
+            logger.warning("融合模式输出中未找到界面分析标记")
+            return "", response
+        
+        analysis = response[start + len(self.ui_analysis_start):end].strip()
+        rest = response[:start] + response[end + len(self.ui_analysis_end):]
+        return analysis, rest.strip()
 
 
 # 单例模式获取处理器
-def get_intent_processor(model_path="/home/lab/phi4/phi4", use_local_model=True):
-    """获取意图处理器的单例实例"""
+def get_intent_processor(model_path="/home/lab/phi4/phi4", use_local_model=True, **kwargs):
+    """获取意图处理器的单例实例（kwargs透传给PhiIntentProcessor）"""
     # 使用缓存避免重复加载
     if not hasattr(get_intent_processor, "instance"):
         get_intent_processor.instance = PhiIntentProcessor(
             model_path=model_path,
-            use_local_model=use_local_model
+            use_local_model=use_local_model,
+            **kwargs
         )
     return get_intent_processor.instance
 
@@ -0,0 +1,143 @@
+import time
+import hashlib
+import logging
+import threading
+
+from lazy_import import lazy_import
+
+# 只在创建缓存（加载了本地模型）后才会用到
+torch = lazy_import("torch", optional=True)
+transformers = lazy_import("transformers", optional=True)
+
+logger = logging.getLogger("prefix_cache")
+
+
+class PrefixKVCache:
+    """
+    固定提示词前缀的KV缓存
+
+    工具模式下每个请求前面都是相同的系统提示（工具规则 + 工具定义JSON）。
+    这里对该前缀只做一次prefill，之后的请求复用其past_key_values，只需编码前缀之后的部分。
+    缓存以前缀文本的指纹为键，工具定义变化后前缀文本随之变化，会自动重建。
+
+    前缀KV由纯文本forward计算，只适用于纯文本请求：Phi-4-MM按输入模态切换视觉/语音LoRA，
+    带图像的请求在另一组适配器下计算前缀，不能复用（调用处对这类请求不查缓存）。
+    """
+
+    def __init__(self, model, tokenizer, device="cuda:0"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self._entry = None
+        self._lock = threading.Lock()
+        self._stats = {"builds": 0, "hits": 0, "mismatches": 0, "prefill_time_saved": 0.0}
+        self._measure_lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(prefix_text):
+        """前缀文本的指纹"""
+        return hashlib.sha1(prefix_text.encode("utf-8")).hexdigest()
+
+    def invalidate(self):
+        """丢弃已缓存的前缀（如更换模型或工具注册表时）"""
+        with self._lock:
+            self._entry = None
+
+    def lookup(self, prefix_text, input_ids):
+        """
+        获取可直接传给generate的前缀KV副本
+
+        每个前缀第一次命中时，用这个请求分别计时完整prefill和复用前缀后的prefill，
+        二者之差作为该前缀每次命中节省的时间。
+
+        Args:
+            prefix_text: 前缀文本（系统提示）
+            input_ids: 完整提示词的input_ids，形状(1, seq_len)
+
+        Returns:
+            (past_key_values, prefill_time_saved)；前缀token与输入不一致时返回(None, 0.0)
+        """
+        entry = self._get_or_build(prefix_text)
+        length = entry["length"]
+
+        if input_ids.shape[1] <= length or not torch.equal(input_ids[0, :length], entry["input_ids"][0]):
+            # 分词边界与单独编码的前缀不一致，不能复用
+            with self._lock:
+                self._stats["mismatches"] += 1
+            return None, 0.0
+
+        if entry["prefill_time_saved"] is None:
+            self._measure_saving(entry, input_ids)
+
+        with self._lock:
+            self._stats["hits"] += 1
+            self._stats["prefill_time_saved"] += entry["prefill_time_saved"]
+
+        return self._copy(entry["layers"]), entry["prefill_time_saved"]
+
+    def stats(self):
+        """返回缓存统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            entry = self._entry
+        stats["prefix_tokens"] = entry["length"] if entry else 0
+        stats["prefill_time"] = entry["prefill_time"] if entry else 0.0
+        stats["prefill_time_saved_per_hit"] = entry["prefill_time_saved"] if entry else None
+        return stats
+
+    @staticmethod
+    def _copy(layers):
+        """
+        为单个请求创建前缀KV缓存
+
+        DynamicCache追加新token时拼接出新的张量，不会原地修改已有张量，
+        所以新缓存直接引用前缀的KV张量，不复制数据。
+        """
+        cache = transformers.DynamicCache()
+        for layer_idx, (keys, values) in enumerate(layers):
+            cache.update(keys, values, layer_idx)
+        return cache
+
+    def _measure_saving(self, entry, input_ids):
+        """用一个请求分别计时完整prefill和复用前缀后的prefill（每个前缀只测一次）"""
+        with self._measure_lock:
+            if entry["prefill_time_saved"] is not None:
+                return
+            with torch.no_grad():
+                start_time = time.time()
+                self.model(input_ids=input_ids, past_key_values=transformers.DynamicCache(), use_cache=True)
+                full_time = time.time() - start_time
+
+                start_time = time.time()
+                self.model(input_ids=input_ids[:, entry["length"]:], past_key_values=self._copy(entry["layers"]),
+                           use_cache=True)
+                cached_time = time.time() - start_time
+            entry["prefill_time_saved"] = max(full_time - cached_time, 0.0)
+            logger.info(f"前缀KV缓存: 完整prefill {full_time:.3f}秒, 复用前缀后{cached_time:.3f}秒")
+
+    def _get_or_build(self, prefix_text):
+        fingerprint = self.fingerprint(prefix_text)
+        with self._lock:
+            if self._entry is not None and self._entry["fingerprint"] == fingerprint:
+                return self._entry
+
+            if self._entry is not None:
+                logger.info("工具系统提示已变化，重建前缀KV缓存")
+
+            input_ids = self.tokenizer(prefix_text, return_tensors="pt").input_ids.to(self.device)
+            start_time = time.time()
+            with torch.no_grad():
+                outputs = self.model(input_ids=input_ids, past_key_values=transformers.DynamicCache(), use_cache=True)
+            prefill_time = time.time() - start_time
+
+            self._entry = {
+                "fingerprint": fingerprint,
+                "input_ids": input_ids,
+                "length": input_ids.shape[1],
+                "layers": [(layer[0], layer[1]) for layer in outputs.past_key_values],
+                "prefill_time": prefill_time,
+                "prefill_time_saved": None,  # 第一次命中时实测
+            }
+            self._stats["builds"] += 1
+            logger.info(f"已构建前缀KV缓存: {input_ids.shape[1]}个token, prefill用时{prefill_time:.3f}秒")
+            return self._entry
@@ -0,0 +1,199 @@
+import copy
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger("state_store")
+
+
+class StateStore:
+    """
+    带版本号的应用状态（设备、设置）
+
+    - 每次写入使版本号加1，变更按版本记入有界的变更日志
+    - 广播窗口内的多次变更合并成一条state_delta（同一路径只保留最后的值）后再广播
+    - since(version)返回某版本之后的增量，重连的客户端只需补齐缺失的变更
+
+    状态中的字典可以直接读取，但写入必须通过set/update/apply，否则不会记录版本和广播。
+    路径为元组，如('devices', 'apple-tv', 'connected')或('settings', 'volume')。
+    """
+
+    def __init__(self, initial, max_log=1024, broadcast_window=0.05, on_delta=None):
+        """
+        Args:
+            initial: 初始状态，如{'devices': {...}, 'settings': {...}}
+            max_log: 变更日志保留的版本数
+            broadcast_window: 合并广播的时间窗口（秒），0表示每次变更立即广播
+            on_delta: 广播回调，参数为{'from_version', 'version', 'changes'}
+        """
+        self.data = initial
+        self.max_log = max_log
+        self.broadcast_window = broadcast_window
+        self.on_delta = on_delta
+
+        self._version = 0
+        self._log = deque(maxlen=max_log)  # (version, [(path, value), ...])
+        self._lock = threading.RLock()
+        self._pending = {}  # 等待广播的变更：path -> value
+        self._pending_from = None
+        self._timer = None
+        self._holds = 0  # batch()嵌套层数，大于0时暂缓广播
+        self._stats = {"writes": 0, "changes": 0, "broadcasts": 0, "coalesced": 0}
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, path=()):
+        """读取路径上的值（返回副本）"""
+        with self._lock:
+            return copy.deepcopy(self._resolve(path))
+
+    def snapshot(self):
+        """返回(版本号, 完整状态副本)"""
+        with self._lock:
+            return self._version, copy.deepcopy(self.data)
+
+    def set(self, path, value):
+        """写入单个值，返回写入后的版本号"""
+        return self.apply([(path, value)])
+
+    def update(self, path, fn):
+        """
+        按当前值计算新值并写入（读取和写入在同一把锁内，如切换设备连接状态）
+
+        Returns:
+            新值
+        """
+        with self._lock:
+            value = fn(self._resolve(path))
+            self.apply([(path, value)])
+            return value
+
+    def apply(self, changes):
+        """
+        原子地写入一组变更，整组只占一个版本号；值未变化的变更被忽略
+
+        Args:
+            changes: [(path, value), ...]
+
+        Returns:
+            写入后的版本号
+        """
+        with self._lock:
+            effective = []
+            for path, value in changes:
+                path = tuple(path)
+                parent = self._resolve(path[:-1])
+                if path[-1] not in parent:
+                    raise KeyError("/".join(path))
+                if parent[path[-1]] != value:
+                    parent[path[-1]] = value
+                    effective.append((path, value))
+
+            self._stats["writes"] += 1
+            if not effective:
+                return self._version
+
+            self._version += 1
+            self._stats["changes"] += len(effective)
+            self._log.append((self._version, effective))
+            self._queue_broadcast(effective)
+            return self._version
+
+    @contextmanager
+    def batch(self):
+        """期间的所有变更在退出时合并成一条广播（不受广播窗口限制）"""
+        with self._lock:
+            self._holds += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._holds -= 1
+                release = self._holds == 0
+            if release:
+                self.flush()
+
+    def since(self, version):
+        """
+        返回某版本之后的合并增量
+
+        Returns:
+            {'from_version', 'version', 'changes'}；无法从变更日志补齐时返回None（需要全量同步）
+        """
+        with self._lock:
+            if version == self._version:
+                return self._delta(version, [])
+            # 比当前版本还新（服务重启过）或早于日志起点，都只能全量同步
+            if version > self._version or version < 0 or not self._log or self._log[0][0] > version + 1:
+                return None
+            merged = {}
+            for entry_version, changes in self._log:
+                if entry_version > version:
+                    merged.update(changes)
+            return self._delta(version, merged.items())
+
+    def flush(self):
+        """立即广播等待中的变更"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            delta = self._delta(self._pending_from, self._pending.items())
+            self._pending = {}
+            self._pending_from = None
+            self._stats["broadcasts"] += 1
+
+        if self.on_delta is not None:
+            try:
+                self.on_delta(delta)
+            except Exception as e:
+                logger.error(f"广播状态变更失败: {str(e)}")
+
+    def stats(self):
+        """返回状态存储统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "version": self._version,
+                "log_size": len(self._log),
+                "oldest_version": self._log[0][0] - 1 if self._log else self._version,
+                "pending": len(self._pending),
+            })
+        return stats
+
+    def _resolve(self, path):
+        node = self.data
+        for key in path:
+            node = node[key]
+        return node
+
+    def _delta(self, from_version, changes):
+        return {
+            "from_version": from_version,
+            "version": self._version,
+            "changes": [{"path": list(path), "value": copy.deepcopy(value)} for path, value in changes],
+        }
+
+    def _queue_broadcast(self, changes):
+        """把变更放入广播窗口（调用方持有锁）"""
+        if self._pending_from is None:
+            self._pending_from = self._version - 1
+        for path, value in changes:
+            if path in self._pending:
+                self._stats["coalesced"] += 1
+            self._pending[path] = value
+
+        if self._holds:
+            return
+        if self.broadcast_window <= 0:
+            # RLock允许在持有锁时直接广播
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.broadcast_window, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
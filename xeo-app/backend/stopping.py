@@ -0,0 +1,120 @@
+import logging
+
+from lazy_import import lazy_import
+
+# 模拟模式下不需要真正的停止条件，torch只在生成时才导入
+torch = lazy_import("torch", optional=True)
+
+logger = logging.getLogger("stopping")
+
+# 工具调用块之后的确认语句在这些字符处结束（英文句点可能出现在数字中，不作为句末）
+SENTENCE_ENDS = "。！？!?\n"
+
+
+def trailing_sentence_end(text, start_marker="<|tool_call|>"):
+    """
+    工具调用块之后第一句话的结束位置
+
+    Returns:
+        句末字符之后的下标；句子尚未结束，或其后又开始了新的工具调用块时返回None
+    """
+    if start_marker in text:
+        return None
+    has_content = False
+    for i, char in enumerate(text):
+        if char in SENTENCE_ENDS:
+            if has_content:
+                return i + 1
+        elif not char.isspace():
+            has_content = True
+    return None
+
+
+class ToolCallStoppingCriteria:
+    """
+    工具调用完成后提前停止生成
+
+    实现transformers的StoppingCriteria接口（generate只调用__call__），
+    不继承它，以免导入本模块时就加载transformers。
+
+    每步只解码最后几个token判断是否出现结束标记；出现新的结束标记时，
+    才解码整段生成内容并用validate_fn校验最后一个工具调用块。
+    有效的工具调用块闭合后继续生成到其后第一句话结束（如"已为您将音量调整到80%。"），
+    确认语句不会被截掉；其后又开始新的工具调用块时等待该块闭合。
+    这句话之后模型可能还会再生成工具调用，停止后这些调用会丢失，因此调用处默认不启用。
+    支持批量生成，按行分别判断，返回每行是否停止。
+    """
+
+    def __init__(self, tokenizer, prompt_length, validate_fn,
+                 start_marker="<|tool_call|>", end_marker="<|/tool_call|>",
+                 enabled_rows=None, tail_tokens=16):
+        """
+        Args:
+            tokenizer: 用于解码生成内容的tokenizer
+            prompt_length: 输入（含填充）的token长度，之后的token为生成内容
+            validate_fn: 校验工具调用块文本（不含标记）的函数，返回bool
+            enabled_rows: 每行是否启用提前停止，None表示全部启用
+            tail_tokens: 每步检查结束标记时解码的末尾token数
+        """
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.validate_fn = validate_fn
+        self.start_marker = start_marker
+        self.end_marker = end_marker
+        self.enabled_rows = enabled_rows
+        self.tail_tokens = tail_tokens
+        self.stop_lengths = {}  # 行号 -> 停止时已生成的token数
+        self._ends_seen = {}
+        self._closed_at = {}  # 行号 -> 最近一个有效工具调用块闭合时已生成的token数
+
+    def __call__(self, input_ids, scores, **kwargs):
+        is_done = []
+        for row in range(input_ids.shape[0]):
+            if row in self.stop_lengths:
+                is_done.append(True)
+                continue
+            if self.enabled_rows is not None and not self.enabled_rows[row]:
+                is_done.append(False)
+                continue
+
+            generated = input_ids[row, self.prompt_length:]
+            is_done.append(self._check_row(row, generated))
+
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+    def _check_row(self, row, generated):
+        closed_at = self._closed_at.get(row)
+        if closed_at is not None:
+            trailing = self.tokenizer.decode(generated[closed_at:], skip_special_tokens=False)
+            if trailing_sentence_end(trailing, self.start_marker) is not None:
+                self.stop_lengths[row] = len(generated)
+                return True
+
+        tail = self.tokenizer.decode(generated[-self.tail_tokens:], skip_special_tokens=False)
+        if self.end_marker not in tail:
+            return False
+
+        text = self.tokenizer.decode(generated, skip_special_tokens=False)
+        ends = text.count(self.end_marker)
+        if ends <= self._ends_seen.get(row, 0):
+            return False
+        self._ends_seen[row] = ends
+
+        end = text.rfind(self.end_marker)
+        start = text.rfind(self.start_marker, 0, end)
+        if start < 0:
+            return False
+
+        if self.validate_fn(text[start + len(self.start_marker):end]):
+            self._closed_at[row] = len(generated)
+        return False
+
+
+def generation_info(generated_tokens, max_new_tokens, stopped_early):
+    """汇总单次生成的token使用情况"""
+    return {
+        "generated_tokens": generated_tokens,
+        "max_new_tokens": max_new_tokens,
+        "stopped_early": stopped_early,
+        "tokens_saved": max(0, max_new_tokens - generated_tokens) if stopped_early else 0,
+    }
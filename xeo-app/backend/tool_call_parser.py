@@ -0,0 +1,280 @@
+import re
+import json
+import logging
+
+logger = logging.getLogger("tool_call_parser")
+
+# 支持的工具调用框定格式：(起始标记, 结束标记)
+FRAMINGS = (
+    ("<|tool_call|>", "<|/tool_call|>"),
+    ("```tool_call", "```"),
+)
+
+_STRUCTURAL = re.compile(r'[\[\]{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_CLOSERS = {"}": "{", "]": "["}
+# 裸JSON模式下只把'{"'和'[{'（中间可有空白）视为JSON的开始，避免普通文本中的括号吞掉后续内容
+_BARE_START = re.compile(r'\{\s*"|\[\s*\{')
+_VALUE_START = re.compile(r'[\[{]')
+
+
+def _as_calls(value):
+    """把解析出的JSON值整理成工具调用列表（带name的对象）"""
+    items = value if isinstance(value, list) else [value]
+    return [item for item in items if isinstance(item, dict) and "name" in item]
+
+
+class _JsonScanner:
+    """
+    括号配对的增量JSON提取
+
+    逐段接收文本，跟踪字符串、转义和括号栈，每个字符只扫描一次。
+    顶层为数组时，每个元素对象一闭合就产出；顶层为对象时在对象闭合时产出。
+    只保留正在提取的对象文本，数组中已产出的元素不再占用内存。
+    """
+
+    def __init__(self, bare=False):
+        self.bare = bare
+        self.malformed = 0
+        self.reset()
+
+    def reset(self):
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._capture = None  # 正在提取的对象文本片段
+
+    @property
+    def open(self):
+        """是否有未闭合的值"""
+        return bool(self._stack)
+
+    def feed(self, segment):
+        """扫描一段文本，返回其中闭合的工具调用"""
+        calls = []
+        pos = 0
+        while pos < len(segment):
+            pos = self._scan(segment, pos, calls)
+        return calls
+
+    def finish(self):
+        """文本结束：未闭合的值记为格式错误"""
+        if self._stack:
+            self.malformed += 1
+        self.reset()
+
+    def _scan(self, segment, pos, calls):
+        """从pos开始扫描，当前顶层值结束（或因格式错误被丢弃）时返回下一个位置，否则返回len(segment)"""
+        length = len(segment)
+        if not self._stack:
+            pos = self._value_start(segment, pos)
+            if pos < 0:
+                return length
+
+        stack = self._stack
+        capture_from = pos if self._capture is not None else None
+        while pos < length:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    pos += 1
+                    continue
+                match = _STRING_SPECIAL.search(segment, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                if match.group() == "\\":
+                    self._escape = True
+                else:
+                    self._in_string = False
+                continue
+
+            match = _STRUCTURAL.search(segment, pos)
+            if match is None:
+                break
+            char = match.group()
+            index = match.start()
+            pos = match.end()
+
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                stack.append(char)
+                # 顶层对象或顶层数组的元素对象：开始提取
+                if char == "{" and (len(stack) == 1 or (len(stack) == 2 and stack[0] == "[")):
+                    self._capture = []
+                    capture_from = index
+            else:
+                if stack[-1] != _CLOSERS[char]:
+                    # 括号不匹配：丢弃当前值，从下一个字符重新寻找
+                    self.malformed += 1
+                    self.reset()
+                    return pos
+                stack.pop()
+                if char == "}" and self._capture is not None and (
+                        not stack or (len(stack) == 1 and stack[0] == "[")):
+                    self._capture.append(segment[capture_from:pos])
+                    calls.extend(self._load("".join(self._capture)))
+                    self._capture = None
+                    capture_from = None
+                if not stack:
+                    self.reset()
+                    return pos
+
+        if self._capture is not None:
+            self._capture.append(segment[capture_from:])
+        return length
+
+    def _value_start(self, segment, pos):
+        """pos之后值起始括号的位置，没有时返回-1"""
+        pattern = _BARE_START if self.bare else _VALUE_START
+        match = pattern.search(segment, pos)
+        return match.start() if match else -1
+
+    def _load(self, text):
+        try:
+            return _as_calls(json.loads(text))
+        except json.JSONDecodeError:
+            self.malformed += 1
+            logger.warning(f"无法解析工具调用JSON: {text[:200]}")
+            return []
+
+
+class ToolCallParser:
+    """
+    流式工具调用解析器
+
+    按片段喂入模型输出，返回可直接展示的普通文本和刚闭合的工具调用。
+    支持<|tool_call|>...<|/tool_call|>和```tool_call ... ```两种框定格式；
+    块内按括号配对增量提取JSON，调用对象一闭合即产出，不必等到结束标记。
+    跨片段被切开的标记会先暂存，等后续片段到达后再判断。整体为线性时间。
+    """
+
+    def __init__(self, framings=FRAMINGS):
+        self.framings = tuple(framings)
+        self._buffer = ""
+        self._framing = None  # 当前所在块的(起始标记, 结束标记)
+        self._scanner = _JsonScanner()
+        self.stats = {"blocks": 0, "calls": 0, "unclosed_blocks": 0}
+
+    @property
+    def malformed(self):
+        return self._scanner.malformed
+
+    def feed(self, chunk):
+        """
+        处理一段新文本
+
+        Returns:
+            (text, calls): 可展示的普通文本，以及本次闭合的工具调用列表
+        """
+        buffer = self._buffer + chunk
+        pos = 0
+        text_parts = []
+        calls = []
+        # 各起始标记在buffer中下一次出现的位置，避免每个块都从头查找
+        next_starts = {}
+
+        while True:
+            if self._framing is None:
+                start, framing = self._find_start(buffer, pos, next_starts)
+                if framing is not None:
+                    text_parts.append(buffer[pos:start])
+                    pos = start + len(framing[0])
+                    self._framing = framing
+                    self.stats["blocks"] += 1
+                    continue
+
+                # 保留可能是起始标记前缀的尾部，其余文本直接输出
+                split = len(buffer) - self._partial_length(buffer, pos, [start for start, _ in self.framings])
+                text_parts.append(buffer[pos:split])
+                pos = split
+                break
+
+            end_marker = self._framing[1]
+            end = buffer.find(end_marker, pos)
+            if end >= 0:
+                calls.extend(self._scanner.feed(buffer[pos:end]))
+                self._scanner.finish()
+                pos = end + len(end_marker)
+                self._framing = None
+                continue
+
+            # 结束标记可能被切开，尾部暂不扫描
+            split = len(buffer) - self._partial_length(buffer, pos, [end_marker])
+            calls.extend(self._scanner.feed(buffer[pos:split]))
+            pos = split
+            break
+
+        self._buffer = buffer[pos:]
+        self.stats["calls"] += len(calls)
+        return "".join(text_parts), calls
+
+    def flush(self):
+        """
+        生成结束时调用，返回剩余的普通文本和工具调用
+
+        未闭合的块中已闭合的调用照常返回，其余部分视为不完整输出丢弃。
+        """
+        if self._framing is not None:
+            calls = self._scanner.feed(self._buffer)
+            if self._scanner.open:
+                logger.warning("生成结束时存在未闭合的工具调用")
+            self._scanner.finish()
+            self.stats["unclosed_blocks"] += 1
+            text = ""
+        else:
+            calls = []
+            text = self._buffer
+        self._buffer = ""
+        self._framing = None
+        self.stats["calls"] += len(calls)
+        return text, calls
+
+    def _find_start(self, buffer, pos, next_starts):
+        """pos之后最早出现的起始标记位置及其格式"""
+        best, best_framing = -1, None
+        for framing in self.framings:
+            index = next_starts.get(framing)
+            if index is None or 0 <= index < pos:
+                index = buffer.find(framing[0], pos)
+                next_starts[framing] = index
+            if index >= 0 and (best < 0 or index < best):
+                best, best_framing = index, framing
+        return best, best_framing
+
+    @staticmethod
+    def _partial_length(text, pos, markers):
+        """text[pos:]末尾与任一标记前缀重合的最大长度"""
+        longest = 0
+        for marker in markers:
+            for length in range(min(len(text) - pos, len(marker) - 1), longest, -1):
+                if text.endswith(marker[:length]):
+                    longest = length
+                    break
+        return longest
+
+
+def extract_tool_calls(text, framings=FRAMINGS, bare_json=False):
+    """
+    从完整文本中提取工具调用
+
+    Args:
+        text: 模型输出
+        framings: 工具调用的框定格式
+        bare_json: 没有框定的工具调用时，是否在正文中查找带name的裸JSON对象/数组
+
+    Returns:
+        (去掉工具调用块后的文本, 工具调用列表)
+    """
+    parser = ToolCallParser(framings)
+    text_out, calls = parser.feed(text)
+    rest, more = parser.flush()
+    calls.extend(more)
+    text_out += rest
+
+    if not calls and bare_json:
+        scanner = _JsonScanner(bare=True)
+        calls = scanner.feed(text)
+        scanner.finish()
+    return text_out, calls
@@ -0,0 +1,160 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from tool_registry import tool_registry
+
+logger = logging.getLogger("tool_engine")
+
+
+def call_resource(call):
+    """
+    工具调用作用的状态路径，用于判断调用之间的依赖
+
+    作用于同一设备或同一设置的调用必须按顺序执行，其余调用互不依赖。
+    别名按注册表展开后再判断；无法识别的调用返回None，单独执行。
+    """
+    try:
+        name, arguments = tool_registry.resolve(call.get("name"), call.get("arguments", call.get("parameters")))
+    except ValueError:
+        return None
+    if name == "connect_device":
+        return ("devices", arguments["device_id"], "connected")
+    if name == "adjust_setting":
+        return ("settings", arguments["setting_id"])
+    return None
+
+
+class ToolEngine:
+    """
+    一次模型响应中多个工具调用的执行引擎
+
+    - 按作用的设备/设置建立依赖：同一资源上的调用组成一条链按原顺序执行，不同链在线程池中并发执行
+    - 所有调用产生的状态变化合并成一条state_delta广播
+    - transactional=True时全部成功才生效：任一调用失败则跳过尚未执行的调用，
+      并按各调用结果中的旧值把已生效的变化一次性回滚
+    """
+
+    def __init__(self, executor, state_store=None, max_workers=4):
+        """
+        Args:
+            executor: ToolExecutor
+            state_store: StateStore，用于合并广播和原子回滚（可选）
+            max_workers: 并发执行的调用链数上限
+        """
+        self.executor = executor
+        self.state_store = state_store
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool-engine")
+
+    def plan(self, calls):
+        """
+        把调用划分成互不依赖的调用链
+
+        Returns:
+            [[调用下标, ...], ...]，每条链内按原顺序排列
+        """
+        chains = {}
+        for index, call in enumerate(calls):
+            resource = call_resource(call)
+            key = resource if resource is not None else ("call", index)
+            chains.setdefault(key, []).append(index)
+        return list(chains.values())
+
+    def run(self, calls, transactional=False):
+        """
+        执行一组工具调用
+
+        Args:
+            calls: [{'name', 'arguments'或'parameters'}, ...]
+            transactional: 是否全部成功才生效
+
+        Returns:
+            {'success', 'rolled_back', 'results'}，results与calls一一对应，格式同ToolExecutor.execute_tool
+        """
+        if transactional and getattr(self.executor, "mode", "local") != "local":
+            # remote模式拿不到旧值，无法回滚
+            logger.warning("remote模式不支持事务执行，按非事务方式执行")
+            transactional = False
+
+        results = [None] * len(calls)
+        failed = threading.Event()
+
+        def run_chain(chain):
+            for index in chain:
+                call = calls[index]
+                arguments = call.get("arguments", call.get("parameters")) or {}
+                if transactional and failed.is_set():
+                    results[index] = self._skipped(call["name"], arguments)
+                    continue
+                try:
+                    result = self.executor.execute_tool(call["name"], arguments)
+                except Exception as e:
+                    logger.error(f"执行工具调用{call['name']}出错: {str(e)}")
+                    result = self._failed(call["name"], arguments, str(e))
+                results[index] = result
+                if not result["result"].get("success"):
+                    failed.set()
+
+        batch = self.state_store.batch() if self.state_store is not None else nullcontext()
+        with batch:
+            chains = self.plan(calls)
+            if len(chains) <= 1:
+                for chain in chains:
+                    run_chain(chain)
+            else:
+                for future in [self._pool.submit(run_chain, chain) for chain in chains]:
+                    future.result()
+
+            rolled_back = False
+            if transactional and failed.is_set():
+                rolled_back = self._rollback(results)
+
+        return {
+            "success": not failed.is_set(),
+            "rolled_back": rolled_back,
+            "results": results,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def _rollback(self, results):
+        """把已生效调用的状态恢复为执行前的值（同一路径取最早的旧值），作为一个版本写入"""
+        restore = {}
+        for output in reversed(results):
+            result = output["result"]
+            if not result.get("success"):
+                continue
+            if "old_connected" in result:
+                restore[("devices", result["device_id"], "connected")] = result["old_connected"]
+            elif "old_value" in result:
+                restore[("settings", result["setting_id"])] = result["old_value"]
+            output["rolled_back"] = True
+
+        if not restore:
+            return False
+        if self.state_store is not None:
+            self.state_store.apply(list(restore.items()))
+        else:
+            from mcp_executor import write_state
+            for path, value in restore.items():
+                write_state(path, value)
+        logger.info(f"工具调用部分失败，已回滚{len(restore)}项状态")
+        return True
+
+    @staticmethod
+    def _failed(tool_name, arguments, message):
+        return {
+            "tool_name": tool_name,
+            "arguments": arguments,
+            "result": {"success": False, "message": message},
+            "content": [{"type": "text", "text": message}]
+        }
+
+    @classmethod
+    def _skipped(cls, tool_name, arguments):
+        output = cls._failed(tool_name, arguments, "同一批中有工具调用失败，该调用未执行")
+        output["result"]["skipped"] = True
+        return output
@@ -0,0 +1,325 @@
+import json
+import logging
+
+logger = logging.getLogger("tool_registry")
+
+# XEO设备：设备ID -> 显示名称（与app.py中的设备状态一致）
+DEVICES = {
+    "about-xeo": "About XEO",
+    "apple-tv": "Apple TV",
+    "playstation": "Play Station 5",
+    "nintendo": "Nintendo Switch",
+}
+
+# 模型可能输出的设备ID别名 -> 标准ID
+DEVICE_ID_ALIASES = {
+    "xeo-about": "about-xeo",
+}
+
+# XEO设置：设置ID -> (最小值, 最大值, 单位, 说明)
+SETTINGS = {
+    "volume": (0, 100, "%", "音量大小"),
+    "ipd": (50, 80, "mm", "IPD(瞳距)"),
+    "magic": (0, 100, "%", "Magic Pulse强度"),
+    "seat": (0, 100, "", "座椅位置"),
+    "ventilation": (0, 100, "%", "通风大小"),
+}
+
+# 旧版按设备/设置拆分的工具名（mcp_tools.py）使用的后缀
+_DEVICE_ALIAS_SUFFIX = {
+    "about-xeo": "about_xeo",
+    "apple-tv": "apple_tv",
+    "playstation": "playstation",
+    "nintendo": "nintendo",
+}
+
+
+class ToolValidationError(ValueError):
+    """工具调用不符合工具定义"""
+
+
+def _type_checker(type_name):
+    """编译类型检查：严格校验，不做转换"""
+    if type_name == "int":
+        return lambda value: isinstance(value, int) and not isinstance(value, bool)
+    if type_name == "str":
+        return lambda value: isinstance(value, str)
+    if type_name == "float":
+        return lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+    if type_name == "bool":
+        return lambda value: isinstance(value, bool)
+    raise ValueError(f"不支持的参数类型: {type_name}")
+
+
+def _int_coercer(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    return int(value)
+
+
+_COERCERS = {
+    "int": _int_coercer,
+    "str": str,
+    "float": float,
+    "bool": lambda value: value if isinstance(value, bool) else str(value).lower() in ("true", "1", "yes"),
+}
+
+
+class ToolParameter:
+    """编译后的单个参数：类型检查、取值集合和范围在注册时确定"""
+
+    __slots__ = ("name", "type", "description", "enum", "aliases", "minimum", "maximum",
+                 "required", "check_type", "coerce_type", "_enum_order")
+
+    def __init__(self, name, type, description="", enum=None, aliases=None, minimum=None, maximum=None,
+                 required=True):
+        self.name = name
+        self.type = type
+        self.description = description
+        self.enum = frozenset(enum) if enum is not None else None
+        self.aliases = dict(aliases or {})
+        self.minimum = minimum
+        self.maximum = maximum
+        self.required = required
+        self.check_type = _type_checker(type)
+        self.coerce_type = _COERCERS[type]
+        # 保留enum的原始顺序用于生成提示词
+        self._enum_order = list(enum) if enum is not None else None
+
+    def is_valid(self, value):
+        if not self.check_type(value):
+            return False
+        if self.enum is not None and value not in self.enum:
+            return False
+        if self.minimum is not None and value < self.minimum:
+            return False
+        if self.maximum is not None and value > self.maximum:
+            return False
+        return True
+
+    def coerce(self, value):
+        """把模型输出的值转换为参数类型（如'80' -> 80、别名 -> 标准值），不合法时抛出ToolValidationError"""
+        if not self.check_type(value):
+            try:
+                value = self.coerce_type(value)
+            except (TypeError, ValueError):
+                raise ToolValidationError(f"参数{self.name}的类型应为{self.type}: {value!r}")
+        value = self.aliases.get(value, value)
+        if self.enum is not None and value not in self.enum:
+            raise ToolValidationError(f"参数{self.name}的取值无效: {value!r}")
+        if (self.minimum is not None and value < self.minimum) or (self.maximum is not None and value > self.maximum):
+            raise ToolValidationError(f"参数{self.name}超出范围 ({self.minimum}-{self.maximum}): {value}")
+        return value
+
+    def prompt_schema(self):
+        schema = {"description": self.description, "type": self.type}
+        if self._enum_order is not None:
+            schema["enum"] = self._enum_order
+        return schema
+
+    def json_schema(self):
+        schema = {"type": {"int": "integer", "str": "string", "float": "number", "bool": "boolean"}[self.type],
+                  "description": self.description}
+        if self._enum_order is not None:
+            schema["enum"] = self._enum_order
+        if self.minimum is not None:
+            schema["minimum"] = self.minimum
+        if self.maximum is not None:
+            schema["maximum"] = self.maximum
+        return schema
+
+
+class ToolSpec:
+    """
+    编译后的工具定义
+
+    check为可选的跨参数校验函数（参数为已转换的arguments），不合法时返回错误信息。
+    """
+
+    __slots__ = ("name", "description", "parameters", "check", "_required")
+
+    def __init__(self, name, description, parameters, check=None):
+        self.name = name
+        self.description = description
+        self.parameters = tuple(parameters)
+        self.check = check
+        self._required = tuple(p for p in self.parameters if p.required)
+
+    def is_valid(self, arguments):
+        """严格校验（不做类型转换），用于判断模型输出是否已是完整的工具调用"""
+        if not isinstance(arguments, dict):
+            return False
+        for param in self._required:
+            if param.name not in arguments:
+                return False
+        for param in self.parameters:
+            if param.name in arguments and not param.is_valid(arguments[param.name]):
+                return False
+        return self.check is None or self.check(arguments) is None
+
+    def coerce(self, arguments):
+        """转换并校验参数，返回新的arguments，不合法时抛出ToolValidationError"""
+        if not isinstance(arguments, dict):
+            raise ToolValidationError(f"工具{self.name}的参数必须是对象")
+        coerced = {}
+        for param in self.parameters:
+            if param.name in arguments:
+                coerced[param.name] = param.coerce(arguments[param.name])
+            elif param.required:
+                raise ToolValidationError(f"工具{self.name}缺少参数: {param.name}")
+        if self.check is not None:
+            error = self.check(coerced)
+            if error is not None:
+                raise ToolValidationError(error)
+        return coerced
+
+    def prompt_schema(self):
+        return {
+            "name": self.name,
+            "description": self.description,
+            "parameters": {p.name: p.prompt_schema() for p in self.parameters},
+        }
+
+
+class ToolRegistry:
+    """
+    工具注册表：工具定义在注册时编译一次，按名称O(1)查找
+
+    别名（如旧版的connect_apple_tv）映射到标准工具和固定参数，
+    提示词中的工具JSON、旧版工具列表和别名映射表都由注册表生成。
+    """
+
+    def __init__(self):
+        self._tools = {}
+        self._aliases = {}  # 别名 -> (标准工具名, 固定参数, 说明, 别名自身的参数)
+        self._prompt_json = None
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def __len__(self):
+        return len(self._tools)
+
+    def register(self, name, description, parameters, check=None):
+        """注册工具，parameters为ToolParameter列表"""
+        self._tools[name] = ToolSpec(name, description, parameters, check)
+        self._prompt_json = None
+        return self._tools[name]
+
+    def register_alias(self, alias, target, fixed_arguments, description, parameters=()):
+        """注册别名工具：调用alias等同于调用target，并附带fixed_arguments"""
+        self._aliases[alias] = (target, dict(fixed_arguments), description, tuple(parameters))
+
+    def get(self, name):
+        """按名称获取标准工具（不含别名），不存在返回None"""
+        return self._tools.get(name)
+
+    def names(self):
+        return list(self._tools)
+
+    def is_valid_call(self, call):
+        """严格校验单个工具调用{'name', 'arguments'或'parameters'}"""
+        if not isinstance(call, dict):
+            return False
+        tool = self._tools.get(call.get("name"))
+        if tool is None:
+            return False
+        return tool.is_valid(call.get("arguments", call.get("parameters", {})))
+
+    def resolve(self, name, arguments=None):
+        """
+        把工具调用解析为标准工具名和转换后的参数（别名会展开为标准工具）
+
+        Returns:
+            (工具名, arguments)
+
+        Raises:
+            ToolValidationError: 未知工具或参数不合法
+        """
+        arguments = arguments or {}
+        alias = self._aliases.get(name)
+        if alias is not None:
+            target, fixed_arguments, _, _ = alias
+            arguments = dict(arguments, **fixed_arguments)
+            name = target
+        tool = self._tools.get(name)
+        if tool is None:
+            raise ToolValidationError(f"未知工具: {name}")
+        return name, tool.coerce(arguments)
+
+    def prompt_tools(self):
+        """提示词中使用的工具定义列表"""
+        return [tool.prompt_schema() for tool in self._tools.values()]
+
+    def prompt_json(self):
+        """提示词中使用的工具定义JSON（缓存）"""
+        if self._prompt_json is None:
+            self._prompt_json = json.dumps(self.prompt_tools())
+        return self._prompt_json
+
+    def alias_tools(self):
+        """别名工具的JSON Schema定义（旧版mcp_tools格式）"""
+        tools = []
+        for alias, (_, _, description, parameters) in self._aliases.items():
+            tools.append({
+                "name": alias,
+                "description": description,
+                "parameters": {
+                    "type": "object",
+                    "properties": {p.name: p.json_schema() for p in parameters},
+                    "required": [p.name for p in parameters if p.required],
+                },
+            })
+        return tools
+
+
+def _check_setting_range(arguments):
+    """adjust_setting的取值范围取决于setting_id"""
+    minimum, maximum, _, _ = SETTINGS[arguments["setting_id"]]
+    value = arguments.get("value")
+    if value is not None and not minimum <= value <= maximum:
+        return f"设置值超出范围 ({minimum}-{maximum}): {value}"
+    return None
+
+
+def _build_registry():
+    registry = ToolRegistry()
+    device_ids = list(DEVICES)
+    setting_ids = list(SETTINGS)
+
+    registry.register("connect_device", "连接或断开XEO应用中的设备", [
+        ToolParameter(
+            "device_id", "str",
+            f"当前页面能被控制的设备，可以是{', '.join(repr(d) for d in device_ids)}中的一个",
+            enum=device_ids, aliases=DEVICE_ID_ALIASES
+        ),
+    ])
+    registry.register("adjust_setting", "调整XEO应用中的设置参数", [
+        ToolParameter(
+            "setting_id", "str",
+            f"当前页面能被控制的设置，可以是{', '.join(repr(s) for s in setting_ids)}中的一个",
+            enum=setting_ids
+        ),
+        ToolParameter("value", "int", "设置的新值"),
+    ], check=_check_setting_range)
+
+    for device_id, name in DEVICES.items():
+        registry.register_alias(
+            f"connect_{_DEVICE_ALIAS_SUFFIX[device_id]}", "connect_device", {"device_id": device_id},
+            f"连接或断开{name}设备。连接状态会切换（已连接则断开，已断开则连接）。"
+        )
+    for setting_id, (minimum, maximum, unit, label) in SETTINGS.items():
+        registry.register_alias(
+            f"adjust_{setting_id}", "adjust_setting", {"setting_id": setting_id},
+            f"调节{label}，范围为{minimum}-{maximum}{unit}",
+            [ToolParameter("value", "int", f"{label}，范围{minimum}-{maximum}", minimum=minimum, maximum=maximum)]
+        )
+    return registry
+
+
+# 模块导入时编译一次，全进程共享
+tool_registry = _build_registry()
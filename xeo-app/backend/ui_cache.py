@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import weakref
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("ui_cache")
+
+
+def content_digest(data):
+    """计算图像原始（压缩）字节的稳定摘要，跨进程、跨重启一致"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# 图像对象 -> 压缩字节的摘要。不放在image.info中：PIL会把info复制到crop()/resize()/convert()/copy()
+# 的结果，裁剪或缩放后的图像会带上原截图的摘要
+_image_digests = {}
+
+
+def set_image_digest(image, data):
+    """记录图像解码前的压缩字节摘要，只对这个图像对象有效，图像被回收时自动删除"""
+    key = id(image)
+    _image_digests[key] = content_digest(data)
+    weakref.finalize(image, _image_digests.pop, key, None)
+
+
+def image_digest(image):
+    """
+    获取PIL图像的稳定内容摘要
+
+    优先使用解码前用set_image_digest记录的压缩字节摘要；没有原始字节时（如裁剪、缩放后的图像），
+    对模式、尺寸和解码后的像素计算摘要。
+    """
+    key = id(image)
+    digest = _image_digests.get(key)
+    if digest is None:
+        digest = content_digest(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("ascii") + image.tobytes())
+        _image_digests[key] = digest
+        weakref.finalize(image, _image_digests.pop, key, None)
+    return digest
+
+
+class _CacheStats:
+    """缓存命中/未命中/淘汰计数"""
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def stats(self):
+        """返回计数器快照"""
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class UIAnalysisCache(_CacheStats):
+    """
+    进程内UI分析结果缓存
+
+    按条目数和字节预算做LRU淘汰，可选TTL过期。
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, ttl=None):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 最多缓存的条目数
+            max_bytes: 缓存值（JSON编码后）的总字节预算
+            ttl: 条目存活秒数，None表示不过期
+        """
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, created)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """获取缓存值，未命中或已过期返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[2] > self.ttl:
+                self._remove(key)
+                if count:
+                    self._count("expirations")
+                entry = None
+
+            if entry is None:
+                if count:
+                    self._count("misses")
+                return None
+
+            self._entries.move_to_end(key)
+            if count:
+                self._count("hits")
+            return entry[0]
+
+    def put(self, key, value):
+        """写入缓存，并按条目数和字节预算淘汰最久未使用的条目"""
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            logger.warning(f"缓存值过大({size}字节)，超出字节预算，不缓存")
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time())
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._count("evictions")
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+        })
+        return stats
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+class SQLiteUIAnalysisCache(_CacheStats):
+    """
+    基于SQLite的UI分析结果缓存
+
+    多个工作进程共享同一个数据库文件，服务重启后结果仍可复用。
+    LRU按最近访问时间淘汰；计数器为本进程内统计。
+    """
+
+    def __init__(self, path, max_entries=10000, max_bytes=256 * 1024 * 1024, ttl=None):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite数据库文件路径
+            max_entries: 最多缓存的条目数
+            max_bytes: 缓存值的总字节预算
+            ttl: 条目存活秒数，None表示不过期
+        """
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ui_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ui_cache_accessed ON ui_cache(accessed)")
+        logger.info(f"UI分析缓存使用SQLite存储: {path}")
+
+    def _connection(self):
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM ui_cache").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """获取缓存值，未命中或已过期返回None"""
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute("SELECT value, created FROM ui_cache WHERE key = ?", (key,)).fetchone()
+
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            with conn:
+                conn.execute("DELETE FROM ui_cache WHERE key = ?", (key,))
+            if count:
+                self._count("expirations")
+            row = None
+
+        if row is None:
+            if count:
+                self._count("misses")
+            return None
+
+        with conn:
+            conn.execute("UPDATE ui_cache SET accessed = ? WHERE key = ?", (now, key))
+        if count:
+            self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """写入缓存，并淘汰过期及超出预算的条目"""
+        encoded = json.dumps(value, ensure_ascii=False)
+        size = len(encoded.encode("utf-8"))
+        if size > self.max_bytes:
+            logger.warning(f"缓存值过大({size}字节)，超出字节预算，不缓存")
+            return
+
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ui_cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, size, now, now)
+            )
+            if self.ttl is not None:
+                expired = conn.execute("DELETE FROM ui_cache WHERE created < ?", (now - self.ttl,)).rowcount
+                if expired:
+                    self._count("expirations", expired)
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """按最近访问时间淘汰，直到条目数和字节数都在预算内"""
+        entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ui_cache").fetchone()
+        if entries <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM ui_cache ORDER BY accessed"):
+            if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            victims.append((key,))
+            entries -= 1
+            total_bytes -= size
+
+        conn.executemany("DELETE FROM ui_cache WHERE key = ?", victims)
+        self._count("evictions", len(victims))
+
+    def clear(self):
+        """清空缓存"""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM ui_cache")
+
+    def stats(self):
+        stats = super().stats()
+        entries, total_bytes = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ui_cache"
+        ).fetchone()
+        stats.update({
+            "backend": "sqlite",
+            "path": self.path,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+        })
+        return stats
+
+
+def create_ui_cache(path=None, max_entries=1024, max_bytes=16 * 1024 * 1024, ttl=None):
+    """根据是否提供路径创建SQLite或进程内缓存"""
+    if path:
+        return SQLiteUIAnalysisCache(path, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+    return UIAnalysisCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
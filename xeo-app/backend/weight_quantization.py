@@ -0,0 +1,65 @@
+import torch
+import torch.nn.functional as F
+
+
+def quantize_int8(model):
+    """对所有Linear层做动态int8量化：权重量化为int8，激活在每次前向时按批量化"""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class Int4Linear(torch.nn.Module):
+    """
+    分组int4权重量化的Linear层
+
+    每group_size个输入维度的权重共享一个缩放系数，按对称量化取[-8, 7]。组内前一半的值放在字节的低4位、
+    后一半放在高4位，反量化时只需拼接而不必交错。权重内存约为float32的1/8（另加缩放系数）；
+    前向时把权重反量化为输入的精度后做矩阵乘法，因此主要节省内存，速度比float32慢。
+    """
+
+    def __init__(self, linear, group_size=32):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        out_features, in_features = weight.shape
+        padding = -in_features % group_size
+        if padding:
+            weight = F.pad(weight, (0, padding))
+        groups = weight.reshape(out_features, -1, group_size)
+        scale = groups.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 7
+        quantized = (torch.round(groups / scale).clamp(-8, 7) + 8).to(torch.uint8)
+
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        half = group_size // 2
+        self.register_buffer("packed", quantized[..., :half] | (quantized[..., half:] << 4))
+        self.register_buffer("scale", scale.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def dequantize(self, dtype):
+        groups = torch.cat((self.packed & 0x0F, self.packed >> 4), dim=-1).to(dtype).sub_(8)
+        weight = groups.mul_(self.scale.to(dtype)).reshape(self.out_features, -1)
+        return weight[:, :self.in_features]
+
+    def forward(self, x):
+        return F.linear(x, self.dequantize(x.dtype), self.bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+def quantize_int4(model, group_size=32):
+    """
+    把模型中的Linear层原地替换为Int4Linear，返回替换的层数
+
+    输出层（lm_head）对精度最敏感，保持原始精度；group_size须为偶数（两个值打包为一个字节）。
+    """
+    if group_size % 2:
+        raise ValueError("group_size必须为偶数")
+    output_layer = model.get_output_embeddings() if hasattr(model, "get_output_embeddings") else None
+    count = 0
+    for parent in list(model.modules()):
+        for child_name, child in list(parent.named_children()):
+            if type(child) is torch.nn.Linear and child is not output_layer:
+                setattr(parent, child_name, Int4Linear(child, group_size))
+                count += 1
+    return count